@@ -0,0 +1 @@
+"""Throughput benchmarks for dwarfwrite. Run with `python -m benchmarks --help`."""
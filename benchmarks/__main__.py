@@ -0,0 +1,70 @@
+import sys
+import json
+import platform
+import argparse
+import multiprocessing
+
+from .suite import BENCHMARKS, SCALES, run_benchmark
+
+BASELINE_VERSION = 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Measure dwarfwrite throughput.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all of %s)" % ', '.join(BENCHMARKS))
+    parser.add_argument('--scale', choices=SCALES, default='default')
+    parser.add_argument('--repeat', type=int, default=3, help="report the best of this many runs")
+    parser.add_argument('--output', help="write the results to this JSON file, for use as a baseline")
+    parser.add_argument('--compare', help="compare against a baseline written by --output")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="fractional slowdown against the baseline to report as a regression")
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('version') != BASELINE_VERSION or baseline.get('scale') != args.scale:
+            parser.error("baseline was recorded with a different version or scale")
+
+    results = {}
+    regressions = []
+    # a fresh process per benchmark, so that peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_benchmark, (name, SCALES[args.scale], args.repeat))
+        if result is None:
+            print("%-30s skipped" % name)
+            continue
+        results[name] = result
+        line = "%-30s %9.3fs %12.0f items/s %12.0f bytes/s %9d KiB" % (
+            name, result['seconds'], result['items_per_sec'], result['bytes_per_sec'], result['peak_rss_kb'])
+        if baseline is not None and name in baseline['results']:
+            change = result['seconds'] / baseline['results'][name]['seconds'] - 1
+            line += " %+6.1f%%" % (change * 100)
+            if change > args.threshold:
+                regressions.append(name)
+                line += " REGRESSION"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'scale': args.scale,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
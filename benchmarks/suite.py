@@ -0,0 +1,195 @@
+import os
+import atexit
+import shutil
+import time
+import resource
+import tempfile
+
+import archinfo
+
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.serial import serialize
+from dwarfwrite.line_serial import serialize_states
+from dwarfwrite.expr_serial import DWARFExprSerializer
+from dwarfwrite.restructure import ReStructurer
+
+from . import workloads
+
+# multipliers applied to every workload's size
+SCALES = {
+    'quick': 1,
+    'default': 10,
+    'large': 100,
+}
+
+
+def result_size(result):
+    return sum(len(data) for data in result.values())
+
+
+def bench_serialize_functions(scale):
+    units = workloads.make_functions_units(4 * scale, 50, 4)
+    arch = archinfo.ArchAMD64()
+    return lambda: result_size(serialize(units, arch)), workloads.count_dies(units)
+
+
+def bench_serialize_functions_nosibling(scale):
+    units = workloads.make_functions_units(4 * scale, 50, 4)
+    arch = archinfo.ArchAMD64()
+    return lambda: result_size(serialize(units, arch, sibling='never')), workloads.count_dies(units)
+
+
+def bench_skip(scale, sibling):
+    # how fast a consumer can walk the top level of each unit, which DW_AT_sibling lets it do without parsing subtrees
+    units = workloads.make_functions_units(4 * scale, 50, 4)
+    arch = archinfo.ArchAMD64()
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    path = os.path.join(directory, 'skip.elf')
+    dump_elf(serialize(units, arch, sibling=sibling), arch, path)
+
+    def run():
+        with open(path, 'rb') as fp:
+            for cu in ELFFile(fp).get_dwarf_info().iter_CUs():
+                for _ in cu.get_top_DIE().iter_children():
+                    pass
+        return os.path.getsize(path)
+    return run, sum(len(unit['children']) for unit in units)
+
+
+def bench_serialize_types(scale):
+    units = [workloads.make_type_graph_unit(200 * scale, 8)]
+    arch = archinfo.ArchAMD64()
+    return lambda: result_size(serialize(units, arch)), workloads.count_dies(units)
+
+
+def bench_serialize_loclists(scale):
+    units = workloads.make_functions_units(scale, 50, 2, loclist_entries=16)
+    arch = archinfo.ArchAMD64()
+    return lambda: result_size(serialize(units, arch)), workloads.count_dies(units)
+
+
+def bench_serialize_states(scale):
+    states = workloads.make_line_states(10000 * scale)
+    arch = archinfo.ArchAMD64()
+    return lambda: len(serialize_states(arch, states)), len(states)
+
+
+def bench_serialize_exprs(scale):
+    exprs = workloads.make_exprs(10000 * scale)
+    serializer = DWARFExprSerializer(archinfo.ArchAMD64())
+    return lambda: sum(len(serializer.serialize_expr(expr)) for expr in exprs), len(exprs)
+
+
+def bench_structure(scale):
+    def run():
+        workloads.SyntheticStructurer(4 * scale, 50, 4).run()
+        return 0 # produces no bytes
+    return run, workloads.count_dies(workloads.SyntheticStructurer(4 * scale, 50, 4).run())
+
+
+def bench_rewrite(scale, pipeline=None):
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    binary = workloads.compile_binary(directory, 100 * scale, 3)
+    if binary is None:
+        return None
+    out = binary + '.out'
+    with open(binary, 'rb') as fp:
+        dies = sum(1 for cu in ReStructurer(fp).dwarf.iter_CUs() for _ in cu.iter_DIEs())
+
+    def run():
+        ReStructurer.rewrite_dwarf(binary, out, pipeline=pipeline)
+        return os.path.getsize(out)
+    return run, dies
+
+
+def bench_lookup(scale, address_order):
+    # symbolizer-style lookups of every function's address, in ascending order, on a rewritten binary. a cursor
+    # continues scanning where the previous lookup stopped when it can, so the bytes reported are the .debug_info
+    # bytes decoded: the fewer, the more sequential the layout
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    binary = workloads.compile_binary(directory, 100 * scale, 3)
+    if binary is None:
+        return None
+    out = binary + '.out'
+    ReStructurer.rewrite_dwarf(binary, out, address_order=address_order)
+    with open(out, 'rb') as fp:
+        dwarf = ELFFile(fp).get_dwarf_info()
+        addresses = sorted(die.attributes['DW_AT_low_pc'].value for cu in dwarf.iter_CUs() for die in cu.iter_DIEs()
+                           if die.tag == 'DW_TAG_subprogram' and 'DW_AT_low_pc' in die.attributes)
+
+    def run():
+        scanned = 0
+        with open(out, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            aranges = dwarf.get_aranges()
+            cursor = (None, None)
+            for address in addresses:
+                cu_offset = aranges.cu_offset_at_addr(address)
+                # the previous position, then if the function was not after it, the start of the unit
+                dies = cursor[1] if cursor[0] == cu_offset else None
+                for attempt in (dies, None):
+                    if attempt is None:
+                        attempt = dwarf.get_CU_at(cu_offset).iter_DIEs()
+                    for die in attempt:
+                        scanned += die.size
+                        low_pc = die.attributes.get('DW_AT_low_pc', None)
+                        if die.tag == 'DW_TAG_subprogram' and low_pc is not None and low_pc.value == address:
+                            cursor = (cu_offset, attempt)
+                            break
+                    else:
+                        continue
+                    break
+                else:
+                    raise AssertionError("No function at %#x" % address)
+        return scanned
+    return run, len(addresses)
+
+
+BENCHMARKS = {
+    'serialize_functions': bench_serialize_functions,
+    'serialize_functions_nosibling': bench_serialize_functions_nosibling,
+    'skip_sibling_always': lambda scale: bench_skip(scale, 'always'),
+    'skip_sibling_never': lambda scale: bench_skip(scale, 'never'),
+    'serialize_types': bench_serialize_types,
+    'serialize_loclists': bench_serialize_loclists,
+    'serialize_states': bench_serialize_states,
+    'serialize_exprs': bench_serialize_exprs,
+    'structure': bench_structure,
+    'rewrite': bench_rewrite,
+    'rewrite_pipeline_thread': lambda scale: bench_rewrite(scale, 'thread'),
+    'lookup': lambda scale: bench_lookup(scale, False),
+    'lookup_address_order': lambda scale: bench_lookup(scale, True),
+}
+
+
+def run_benchmark(name, scale, repeat):
+    """Run one benchmark, returning a dict of its measurements or None if it is not available here.
+
+    The best of repeat runs is reported. Peak RSS is process-wide, so run each benchmark in a fresh process for it
+    to be meaningful.
+    """
+    setup = BENCHMARKS[name](scale)
+    if setup is None:
+        return None
+    func, items = setup
+    best = None
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        'seconds': best,
+        'items': items,
+        'bytes': size,
+        'items_per_sec': items / best,
+        'bytes_per_sec': size / best,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
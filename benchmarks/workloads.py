@@ -0,0 +1,276 @@
+import os
+import random
+import subprocess
+
+from elftools.dwarf import enums, constants
+from elftools.dwarf.dwarf_expr import DWARFExprOp, DW_OP_name2opcode
+from elftools.dwarf.lineprogram import LineState
+from elftools.dwarf.ranges import RangeEntry
+
+from dwarfwrite.serial import Address, LocationEntry
+from dwarfwrite.structure import DWARFStructurer
+
+TAG = enums.ENUM_DW_TAG
+AT = enums.ENUM_DW_AT
+
+
+def op(name, *args):
+    return DWARFExprOp(DW_OP_name2opcode[name], name, list(args), 0)
+
+
+def make_base_types():
+    return [{
+        'tag': TAG['DW_TAG_base_type'],
+        AT['DW_AT_name']: name,
+        AT['DW_AT_byte_size']: size,
+        AT['DW_AT_encoding']: encoding,
+    } for name, size, encoding in (
+        ('char', 1, constants.DW_ATE_signed_char),
+        ('int', 4, constants.DW_ATE_signed),
+        ('long', 8, constants.DW_ATE_signed),
+        ('double', 8, constants.DW_ATE_float),
+    )]
+
+
+def make_lexical_block(low_pc, size, depth, types, rng, loclist_entries):
+    variables = []
+    for i in range(2):
+        if loclist_entries:
+            step = max(1, size // loclist_entries)
+            location = [LocationEntry(low_pc + j * step, low_pc + (j + 1) * step, [op('DW_OP_reg%d' % (j % 16))])
+                        for j in range(loclist_entries)]
+        else:
+            location = [op('DW_OP_fbreg', -8 * (depth * 2 + i + 1))]
+        variables.append({
+            'tag': TAG['DW_TAG_variable'],
+            AT['DW_AT_name']: 'v%d_%d' % (depth, i),
+            AT['DW_AT_type']: rng.choice(types),
+            AT['DW_AT_location']: location,
+        })
+    children = variables
+    if depth > 0:
+        children.append(make_lexical_block(low_pc + 1, size - 2, depth - 1, types, rng, loclist_entries))
+    return {
+        'tag': TAG['DW_TAG_lexical_block'],
+        AT['DW_AT_low_pc']: Address(low_pc),
+        AT['DW_AT_high_pc']: size,
+        'children': children,
+    }
+
+
+def make_functions_unit(index, functions, depth, loclist_entries=0, seed=0):
+    """A unit with the given number of functions, each with a chain of depth nested lexical blocks."""
+    rng = random.Random(seed + index)
+    types = make_base_types()
+    base = 0x100000 * (index + 1)
+    size = 0x40 + depth * 4
+    children = list(types)
+    for i in range(functions):
+        low_pc = base + i * size
+        children.append({
+            'tag': TAG['DW_TAG_subprogram'],
+            AT['DW_AT_name']: 'func_%d_%d' % (index, i),
+            AT['DW_AT_external']: True,
+            AT['DW_AT_low_pc']: Address(low_pc),
+            AT['DW_AT_high_pc']: size,
+            AT['DW_AT_frame_base']: [op('DW_OP_call_frame_cfa')],
+            AT['DW_AT_type']: rng.choice(types),
+            'children': [{
+                'tag': TAG['DW_TAG_formal_parameter'],
+                AT['DW_AT_name']: 'arg%d' % j,
+                AT['DW_AT_type']: rng.choice(types),
+                AT['DW_AT_location']: [op('DW_OP_fbreg', -8 * (j + 1))],
+            } for j in range(3)] + [make_lexical_block(low_pc + 4, size - 8, depth, types, rng, loclist_entries)],
+        })
+    return {
+        'tag': TAG['DW_TAG_compile_unit'],
+        AT['DW_AT_name']: 'unit%d.c' % index,
+        AT['DW_AT_language']: constants.DW_LANG_C99,
+        AT['DW_AT_low_pc']: Address(base),
+        AT['DW_AT_high_pc']: functions * size,
+        'children': children,
+    }
+
+
+def make_functions_units(units, functions, depth, loclist_entries=0, seed=0):
+    return [make_functions_unit(i, functions, depth, loclist_entries, seed) for i in range(units)]
+
+
+def make_type_graph_unit(structs, members, seed=0):
+    """A unit with a densely (and cyclically) connected graph of structs referring to each other through pointers."""
+    rng = random.Random(seed)
+    types = make_base_types()
+    struct_dies = [{
+        'tag': TAG['DW_TAG_structure_type'],
+        AT['DW_AT_name']: 'struct%d' % i,
+        AT['DW_AT_byte_size']: members * 8,
+        'children': [],
+    } for i in range(structs)]
+    pointers = [{
+        'tag': TAG['DW_TAG_pointer_type'],
+        AT['DW_AT_byte_size']: 8,
+        AT['DW_AT_type']: die,
+    } for die in struct_dies]
+    for die in struct_dies:
+        for j in range(members):
+            die['children'].append({
+                'tag': TAG['DW_TAG_member'],
+                AT['DW_AT_name']: 'm%d' % j,
+                AT['DW_AT_type']: rng.choice(pointers) if j % 2 else rng.choice(types),
+                AT['DW_AT_data_member_location']: j * 8,
+            })
+    return {
+        'tag': TAG['DW_TAG_compile_unit'],
+        AT['DW_AT_name']: 'types.c',
+        AT['DW_AT_language']: constants.DW_LANG_C99,
+        'children': types + struct_dies + pointers,
+    }
+
+
+def make_line_states(rows, files=16, seed=0):
+    rng = random.Random(seed)
+    paths = ['/src/dir%d/file%d.c' % (i % 4, i) for i in range(files)]
+    states = []
+    address = 0x1000
+    line = 1
+    path = paths[0]
+    for i in range(rows):
+        if i % 64 == 0:
+            path = rng.choice(paths)
+        state = LineState(True)
+        address += rng.randint(1, 12)
+        line = max(1, line + rng.randint(-3, 5))
+        state.address = address
+        state.file = path
+        state.line = line
+        state.column = rng.randint(0, 40)
+        state.end_sequence = i == rows - 1 or i % 4096 == 4095
+        states.append(state)
+    return states
+
+
+def make_exprs(count, seed=0):
+    rng = random.Random(seed)
+    shapes = [
+        lambda: [op('DW_OP_fbreg', rng.randint(-512, 512))],
+        lambda: [op('DW_OP_addr', rng.randint(0, 1 << 40))],
+        lambda: [op('DW_OP_breg6', rng.randint(-64, 64)), op('DW_OP_deref'), op('DW_OP_plus_uconst', rng.randint(0, 256))],
+        lambda: [op('DW_OP_reg0'), op('DW_OP_piece', 4), op('DW_OP_reg1'), op('DW_OP_piece', 4)],
+        lambda: [op('DW_OP_constu', rng.randint(0, 1 << 30)), op('DW_OP_stack_value')],
+        lambda: [op('DW_OP_GNU_entry_value', [op('DW_OP_reg5')]), op('DW_OP_stack_value')],
+    ]
+    return [rng.choice(shapes)() for _ in range(count)]
+
+
+def count_dies(units):
+    total = 0
+    stack = list(units)
+    while stack:
+        die = stack.pop()
+        total += 1
+        stack.extend(die.get('children', []))
+    return total
+
+
+def make_c_source(functions, depth, structs=16):
+    lines = ['struct s%d { int a; long b; struct s%d *next; double d[4]; };' % (i, (i + 1) % structs)
+             for i in range(structs)]
+    lines.insert(0, ''.join('struct s%d; ' % i for i in range(structs)))
+    for i in range(functions):
+        body = []
+        for d in range(depth):
+            body.append('{ volatile long v%d = x + %d; if (v%d & 1) ' % (d, d, d))
+        body.append('x += p->a;')
+        body.append('}' * depth)
+        lines.append('long func%d(struct s%d *p, long x) { %s return x * %d; }' % (i, i % structs, ' '.join(body), i + 1))
+    lines.append('int main(void) { struct s0 s = {0}; long r = 0;')
+    for i in range(0, functions, max(1, functions // 64)):
+        lines.append('r += func%d((void *)&s, r);' % i)
+    lines.append('return (int)r; }')
+    return '\n'.join(lines) + '\n'
+
+
+def compile_binary(directory, functions, depth, compiler=None):
+    """Compile a synthetic C program with debug info. Returns the path of the binary, or None without a compiler."""
+    compiler = compiler or os.environ.get('CC', 'cc')
+    src = os.path.join(directory, 'bench_%d_%d.c' % (functions, depth))
+    out = src[:-2]
+    with open(src, 'w') as fp:
+        fp.write(make_c_source(functions, depth))
+    try:
+        subprocess.run([compiler, '-gdwarf-4', '-O1', '-o', out, src], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out
+
+
+class SyntheticStructurer(DWARFStructurer):
+    """Structures `units` units of `functions` functions each, with depth nested lexical blocks per function.
+
+    Handlers are plain tuples, so the time measured is the structurer's own.
+    """
+
+    def __init__(self, units, functions, depth, structs=16):
+        super().__init__()
+        self.units = units
+        self.functions = functions
+        self.depth = depth
+        self.structs = structs
+
+    def root_get_units(self):
+        return range(self.units)
+    def unit_get_filename(self, handler):
+        return 'unit%d.c' % handler
+    def unit_get_ranges(self, handler):
+        base = 0x100000 * (handler + 1)
+        return [RangeEntry(None, None, base, base + self.functions * 0x40, False)]
+    def unit_get_functions(self, handler):
+        return [('func', handler, i) for i in range(self.functions)]
+    def function_get_name(self, handler):
+        return 'func_%d_%d' % handler[1:]
+    def function_get_ranges(self, handler):
+        low_pc = 0x100000 * (handler[1] + 1) + handler[2] * 0x40
+        return [RangeEntry(None, None, low_pc, low_pc + 0x40, False)]
+    def function_get_return_type(self, handler):
+        return ('basic', 'long')
+    def function_get_parameters(self, handler):
+        return [('param', i, handler[2] % self.structs) for i in range(2)]
+    def function_get_lexicalblocks(self, handler):
+        return [('block', self.depth)] if self.depth else []
+    def lexicalblock_get_variables(self, handler):
+        return [('var', handler[1])]
+    def lexicalblock_get_lexicalblocks(self, handler):
+        return [('block', handler[1] - 1)] if handler[1] > 1 else []
+    def parameter_get_name(self, handler):
+        return 'arg%d' % handler[1]
+    def parameter_get_type(self, handler):
+        return ('ptr', ('struct', handler[2])) if handler[1] == 0 else ('basic', 'long')
+    def parameter_get_location(self, handler):
+        return [op('DW_OP_fbreg', -8 * (handler[1] + 1))]
+    def variable_get_name(self, handler):
+        return 'v%d' % handler[1]
+    def variable_get_type(self, handler):
+        return ('basic', 'int')
+    def variable_get_location(self, handler):
+        return [op('DW_OP_fbreg', -32 - 8 * handler[1])]
+    def type_ptr_of(self, handler):
+        return handler[1] if handler[0] == 'ptr' else None
+    def type_struct_name(self, handler):
+        return 's%d' % handler[1] if handler[0] == 'struct' else None
+    def type_struct_size(self, handler):
+        return 24 if handler[0] == 'struct' else None
+    def type_struct_members(self, handler):
+        return [('member', handler[1], i) for i in range(3)]
+    def type_struct_member_name(self, handler):
+        return 'm%d' % handler[2]
+    def type_struct_member_type(self, handler):
+        return ('ptr', ('struct', (handler[1] + 1) % self.structs)) if handler[2] == 2 else ('basic', 'long')
+    def type_struct_member_offset(self, handler):
+        return handler[2] * 8
+    def type_basic_name(self, handler):
+        return handler[1] if handler[0] == 'basic' else None
+    def type_basic_size(self, handler):
+        return {'int': 4, 'long': 8}[handler[1]]
+    def type_basic_encoding(self, handler):
+        return constants.DW_ATE_signed
@@ -0,0 +1,92 @@
+LE = 'Iend_LE'
+BE = 'Iend_BE'
+
+# archinfo arch names and the elftools name of their ELF e_machine
+ARCH_MACHINES = {
+    'X86': 'EM_386',
+    'AMD64': 'EM_X86_64',
+    'ARMEL': 'EM_ARM',
+    'ARMHF': 'EM_ARM',
+    'ARMCortexM': 'EM_ARM',
+    'AARCH64': 'EM_AARCH64',
+    'MIPS32': 'EM_MIPS',
+    'MIPS64': 'EM_MIPS',
+    'PPC32': 'EM_PPC',
+    'PPC64': 'EM_PPC64',
+    'S390X': 'EM_S390',
+    'RISCV64': 'EM_RISCV',
+}
+
+# the reverse, for reading ELF headers. (e_machine, bits) -> archinfo name
+MACHINE_ARCHES = {
+    ('EM_386', 32): 'X86',
+    ('EM_X86_64', 64): 'AMD64',
+    ('EM_ARM', 32): 'ARMEL',
+    ('EM_AARCH64', 64): 'AARCH64',
+    ('EM_MIPS', 32): 'MIPS32',
+    ('EM_MIPS', 64): 'MIPS64',
+    ('EM_PPC', 32): 'PPC32',
+    ('EM_PPC64', 64): 'PPC64',
+    ('EM_S390', 64): 'S390X',
+    ('EM_RISCV', 64): 'RISCV64',
+}
+
+
+class Arch:
+    """The properties of an architecture the serializers need: a name, the word size and the byte order.
+
+    Anywhere one of these is accepted, an archinfo.Arch works as well, but this one doesn't need archinfo (or cle)
+    to be imported. memory_endness uses the archinfo strings, LE or BE.
+    """
+
+    def __init__(self, name, bits, memory_endness, machine=None):
+        if memory_endness not in (LE, BE):
+            raise ValueError("Invalid endness value: %r" % memory_endness)
+        self.name = name
+        self.bits = bits
+        self.bytes = bits // 8
+        self.memory_endness = memory_endness
+        self.machine = machine if machine is not None else ARCH_MACHINES.get(name, None)
+        self._struct_fmts = {}
+
+    def __repr__(self):
+        return '<Arch %s (%s-bit %s)>' % (self.name, self.bits, 'LE' if self.memory_endness == LE else 'BE')
+
+    def struct_fmt(self, size=None, signed=False):
+        # same as archinfo.Arch.struct_fmt, minus the endness override
+        key = (size, signed)
+        fmt = self._struct_fmts.get(key, None)
+        if fmt is None:
+            if size is None:
+                size = self.bytes
+            if size not in (1, 2, 4, 8):
+                raise ValueError("Invalid size: Must be a integer power of 2 less than 16")
+            fmt = ('<' if self.memory_endness == LE else '>') + {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size]
+            if signed:
+                fmt = fmt.lower()
+            self._struct_fmts[key] = fmt
+        return fmt
+
+    @classmethod
+    def from_archinfo(cls, arch):
+        return cls(arch.name, arch.bits, LE if arch.memory_endness == LE else BE)
+
+    @classmethod
+    def from_elf(cls, elf):
+        """Describe the architecture of an elftools ELFFile from its header.
+        """
+        machine = elf['e_machine']
+        name = MACHINE_ARCHES.get((machine, elf.elfclass), machine)
+        return cls(name, elf.elfclass, LE if elf.little_endian else BE, machine)
+
+    def to_archinfo(self):
+        import archinfo
+        return archinfo.arch_from_id(self.name, self.memory_endness, self.bits)
+
+
+def as_arch(arch):
+    """Return arch as an Arch, converting an archinfo.Arch.
+    """
+    if isinstance(arch, Arch):
+        return arch
+    return Arch.from_archinfo(arch)
@@ -0,0 +1,105 @@
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+# error is None on success, otherwise the formatted exception. stats is a SerializerStats.as_dict() if requested
+BatchResult = namedtuple("BatchResult", ("in_path", "out_path", "seconds", "error", "stats"))
+
+
+def rewrite_batch(jobs, workers=None, structurer=None, collect_stats=False, **options):
+    """Run rewrite_dwarf over an iterable of (in_path, out_path) pairs, yielding a BatchResult for each as it finishes.
+
+    The workers are long-lived: each imports the restructurer once and keeps its per-process caches across files,
+    which matters when the binaries are small and startup dominates. The same is available from the command line as
+    `python -m dwarfwrite.batch MANIFEST`.
+
+    workers is the number of processes, defaulting to one per CPU; 0 rewrites in this process. structurer is the
+    ReStructurer subclass to use. The remaining options are passed to rewrite_dwarf. A failing file does not stop
+    the batch; its exception is reported in its result.
+    """
+    if workers == 0:
+        _init_worker()
+        for job in jobs:
+            yield _rewrite_one((job, structurer, collect_stats, options))
+        return
+
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        tasks = ((job, structurer, collect_stats, options) for job in jobs)
+        yield from pool.imap_unordered(_rewrite_one, tasks)
+
+
+def _init_worker():
+    # the expensive imports (cle, archinfo, pyelftools) happen once per worker
+    from . import restructure
+
+
+def _rewrite_one(task):
+    (in_path, out_path), structurer, collect_stats, options = task
+    from .restructure import ReStructurer
+    from .stats import SerializerStats
+    stats = SerializerStats() if collect_stats else None
+    start = time.perf_counter()
+    try:
+        (structurer or ReStructurer).rewrite_dwarf(in_path, out_path, stats=stats, **options)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return BatchResult(in_path, out_path, time.perf_counter() - start, error,
+                       stats.as_dict() if stats is not None else None)
+
+
+def read_manifest(fp):
+    # one "in_path out_path" pair per line, separated by a tab or, if there is none, by whitespace
+    for line in fp:
+        line = line.rstrip('\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        parts = line.split('\t') if '\t' in line else line.split()
+        if len(parts) != 2:
+            raise ValueError("Bad manifest line: %r" % line)
+        yield parts[0], parts[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m dwarfwrite.batch',
+                                     description="Rewrite the DWARF of many binaries with a pool of workers.")
+    parser.add_argument('manifest', help="file of 'in_path out_path' lines, or - for stdin")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--compression', choices=('zlib', 'zstd'))
+    parser.add_argument('--compression-level', type=int)
+    parser.add_argument('--gdb-index', action='store_true')
+    parser.add_argument('--debug-names', action='store_true')
+    parser.add_argument('--merge-types', action='store_true')
+    parser.add_argument('--stats', action='store_true', help="include serializer statistics in --json output")
+    parser.add_argument('--json', action='store_true', help="print one JSON object per file instead of text")
+    args = parser.parse_args(argv)
+
+    if args.manifest == '-':
+        jobs = list(read_manifest(sys.stdin))
+    else:
+        with open(args.manifest) as fp:
+            jobs = list(read_manifest(fp))
+
+    failures = 0
+    results = rewrite_batch(jobs, workers=args.workers, collect_stats=args.stats, compression=args.compression,
+                            compression_level=args.compression_level, gdb_index=args.gdb_index,
+                            debug_names=args.debug_names, merge_types=args.merge_types)
+    for result in results:
+        failures += result.error is not None
+        if args.json:
+            print(json.dumps(result._asdict()), flush=True)
+        elif result.error is None:
+            print("ok     %8.3fs %s -> %s" % (result.seconds, result.in_path, result.out_path), flush=True)
+        else:
+            print("FAILED %8.3fs %s\n%s" % (result.seconds, result.in_path, result.error), flush=True)
+    if not args.json:
+        print("%d rewritten, %d failed" % (len(jobs) - failures, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import struct
+import hashlib
+import tempfile
+
+from . import serial
+from .describe import hash_unit
+
+# bump whenever the serialized form of a unit, or the layout of an entry, changes
+CACHE_VERSION = 5
+
+ENTRY_MAGIC = b'DWUC'
+# the sections RawUnit fixups may refer to, stored by index
+FIXUP_SECTIONS = ('.debug_str', '.debug_line', '.debug_loc', '.debug_ranges')
+
+
+class UnitCache:
+    """On-disk cache of serialized units, keyed by a structural hash of the unit dict.
+
+    Entries are RawUnits, so a hit is replayed by the serializer instead of being encoded. Entries are written
+    atomically, so several processes may share a directory; once it grows beyond max_size bytes the least recently
+    used entries are evicted. They are plain data, see encode_entry, so a damaged entry is only ever a miss.
+    """
+
+    def __init__(self, path, max_size=1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, unit, arch, options=()):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((CACHE_VERSION, arch.name, arch.memory_endness, arch.bits, options)).encode())
+        hash_unit(unit, h)
+        return h.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as fp:
+                result = decode_entry(fp.read())
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except ValueError:
+            # a damaged or outdated entry, which is replaced on the next put
+            self.misses += 1
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, raw):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(encode_entry(raw))
+            os.replace(tmp, os.path.join(self.path, key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def encode_entry(raw):
+    """Encode a RawUnit as a cache entry: a magic and CACHE_VERSION, then the info and abbrev bytes, the fixups and the
+    ranges, each list preceded by its length. All integers are little endian.
+    """
+    data = bytearray(struct.pack('<4sI', ENTRY_MAGIC, CACHE_VERSION))
+    for blob in (raw.info, raw.abbrev):
+        data.extend(struct.pack('<I', len(blob)))
+        data.extend(blob)
+    data.extend(struct.pack('<I', len(raw.fixups)))
+    for offset, section, payload in raw.fixups:
+        data.extend(struct.pack('<IBI', offset, FIXUP_SECTIONS.index(section), len(payload)))
+        data.extend(payload)
+    data.extend(struct.pack('<I', len(raw.ranges)))
+    for begin, end in raw.ranges:
+        data.extend(struct.pack('<QQ', begin, end))
+    return bytes(data)
+
+def decode_entry(data):
+    """Decode what encode_entry produced. Raises ValueError if data is not a complete entry of this version."""
+    pos = 0
+    def take(size):
+        nonlocal pos
+        if pos + size > len(data):
+            raise ValueError("Truncated cache entry")
+        pos += size
+        return data[pos - size:pos]
+    def unpack(fmt):
+        return struct.unpack(fmt, take(struct.calcsize(fmt)))
+
+    if unpack('<4sI') != (ENTRY_MAGIC, CACHE_VERSION):
+        raise ValueError("Not a cache entry of version %d" % CACHE_VERSION)
+    info = take(*unpack('<I'))
+    abbrev = take(*unpack('<I'))
+    fixups = []
+    for _ in range(*unpack('<I')):
+        offset, section, size = unpack('<IBI')
+        if section >= len(FIXUP_SECTIONS):
+            raise ValueError("Unknown section in cache entry")
+        fixups.append((offset, FIXUP_SECTIONS[section], take(size)))
+    ranges = [unpack('<QQ') for _ in range(*unpack('<I'))]
+    if pos != len(data):
+        raise ValueError("Trailing data in cache entry")
+    return serial.RawUnit(info, abbrev, fixups, ranges)
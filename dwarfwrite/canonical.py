@@ -0,0 +1,133 @@
+from collections import Counter
+
+from elftools.dwarf import enums
+
+from .serial import RawUnit
+from .describe import describe_value
+from .expr_serial import iter_die_operands
+
+TYPE_TAGS = {enums.ENUM_DW_TAG[name] for name in (
+    'DW_TAG_base_type', 'DW_TAG_pointer_type', 'DW_TAG_reference_type', 'DW_TAG_rvalue_reference_type',
+    'DW_TAG_const_type', 'DW_TAG_volatile_type', 'DW_TAG_restrict_type', 'DW_TAG_typedef', 'DW_TAG_structure_type',
+    'DW_TAG_class_type', 'DW_TAG_union_type', 'DW_TAG_enumeration_type', 'DW_TAG_array_type',
+    'DW_TAG_subroutine_type', 'DW_TAG_ptr_to_member_type', 'DW_TAG_unspecified_type',
+)}
+
+_TAG_NAMES = {v: k for k, v in enums.ENUM_DW_TAG.items()}
+
+# tags which may appear inside a type for it to be merged. types containing anything else, e.g. methods, are left alone
+TYPE_CHILD_TAGS = TYPE_TAGS | {enums.ENUM_DW_TAG[name] for name in (
+    'DW_TAG_member', 'DW_TAG_subrange_type', 'DW_TAG_enumerator', 'DW_TAG_formal_parameter', 'DW_TAG_inheritance',
+    'DW_TAG_template_type_param', 'DW_TAG_template_value_param', 'DW_TAG_unspecified_parameters',
+)}
+
+
+def canonicalize_types(units):
+    """Merge structurally identical type DIEs within each unit dict, rewriting references to the duplicates.
+
+    Types are compared by their attributes, their children and, recursively, the types they refer to, so identical
+    recursive structs are merged as well. Units are modified in place. Returns a Counter of eliminated DIEs by tag name.
+
+    References are unit-local, so types are not merged across units.
+    """
+    report = Counter()
+    for unit in units:
+        if type(unit) is not RawUnit:
+            _canonicalize_unit(unit, report)
+    return report
+
+
+def _canonicalize_unit(unit, report):
+    # find the roots of mergeable type subtrees, i.e. type DIEs whose parent is not a type
+    roots = []
+    parents = {}
+    stack = [unit]
+    while stack:
+        die = stack.pop()
+        for child in die.get('children', []):
+            if child['tag'] in TYPE_TAGS and die['tag'] not in TYPE_TAGS and _is_mergeable(child):
+                roots.append(child)
+                parents[id(child)] = die
+            else:
+                stack.append(child)
+    if len(roots) < 2:
+        return
+
+    nodes = []
+    stack = list(reversed(roots))
+    while stack:
+        die = stack.pop()
+        nodes.append(die)
+        stack.extend(reversed(die.get('children', [])))
+
+    # partition refinement: start with every node in one class and split classes by signature until stable. the
+    # result is the coarsest partition in which equal nodes have equal attributes and equal children and references
+    classes = {id(die): 0 for die in nodes}
+    fixed = {id(die): _fixed_signature(die) for die in nodes}
+    count = 1
+    while True:
+        signatures = {}
+        new_classes = {}
+        for die in nodes:
+            signature = (classes[id(die)], fixed[id(die)],
+                         tuple((x, classes[id(die[x])] if id(die[x]) in classes else ('die', id(die[x])))
+                               for x in _reference_attrs(die)),
+                         tuple(classes[id(child)] for child in die.get('children', [])))
+            new_classes[id(die)] = signatures.setdefault(signature, len(signatures))
+        classes = new_classes
+        if len(signatures) == count:
+            break
+        count = len(signatures)
+
+    # the first root of each class stands in for the rest, and so do their corresponding descendants
+    canonical = {}
+    replacements = {}
+    for root in roots:
+        first = canonical.setdefault(classes[id(root)], root)
+        if first is not root:
+            _map_subtree(root, first, replacements, report)
+    if not replacements:
+        return
+
+    stack = [unit]
+    while stack:
+        die = stack.pop()
+        for x in die:
+            if type(x) is int and type(die[x]) is dict and id(die[x]) in replacements:
+                die[x] = replacements[id(die[x])]
+            elif type(x) is int and type(die[x]) is list:
+                for args, index in iter_die_operands(die[x]):
+                    if id(args[index]) in replacements:
+                        args[index] = replacements[id(args[index])]
+        children = die.get('children', None)
+        if children:
+            die['children'] = [child for child in children if id(child) not in replacements or
+                               parents.get(id(child), None) is not die]
+            stack.extend(die['children'])
+
+
+def _is_mergeable(die):
+    stack = list(die.get('children', []))
+    while stack:
+        child = stack.pop()
+        if child['tag'] not in TYPE_CHILD_TAGS:
+            return False
+        stack.extend(child.get('children', []))
+    return True
+
+
+def _reference_attrs(die):
+    return sorted(x for x in die if type(x) is int and type(die[x]) is dict)
+
+
+def _fixed_signature(die):
+    return die['tag'], tuple((x, type(die[x]).__name__, describe_value(die[x], {}))
+                             for x in sorted(x for x in die if type(x) is int and die[x] is not None
+                                             and type(die[x]) is not dict))
+
+
+def _map_subtree(die, target, replacements, report):
+    replacements[id(die)] = target
+    report[_TAG_NAMES.get(die['tag'], die['tag'])] += 1
+    for child, target_child in zip(die.get('children', []), target.get('children', [])):
+        _map_subtree(child, target_child, replacements, report)
@@ -0,0 +1,265 @@
+import struct
+from collections import namedtuple
+
+from elftools.dwarf import constants
+from elftools.dwarf.callframe import RegisterRule
+
+from .leb128 import encode_sleb128, encode_uleb128
+from .arch import as_arch
+from .expr_serial import DWARFExprSerializer
+
+CIE_VERSION = 4
+EH_CIE_VERSION = 1
+EH_FRAME_HDR_VERSION = 1
+
+DW_EH_PE_udata4 = 0x03
+DW_EH_PE_sdata4 = 0x0b
+DW_EH_PE_pcrel = 0x10
+DW_EH_PE_datarel = 0x30
+
+# begin and end are the addresses the function covers. rows is its unwind table in the form pyelftools decodes it to
+# (see elftools.dwarf.callframe.DecodedCallFrameTable): a list of dicts, ordered by address, each with 'pc' (the
+# address from which the row applies), 'cfa' (a CFARule) and a RegisterRule for each register number which has a
+# rule. Expressions may be DWARFExprOp lists, RawExprs or raw bytes.
+FrameInfo = namedtuple("FrameInfo", ("begin", "end", "rows"))
+
+
+def serialize_frames(arch, frames, return_address_register, code_alignment_factor=1, data_alignment_factor=None,
+                     eh_frame_address=None, eh_frame_hdr_address=None):
+    """Encode a list of FrameInfo into a dict mapping section name to contents.
+
+    By default a .debug_frame section is produced. If eh_frame_address is given, an .eh_frame section meant to be
+    loaded at that address is produced instead, with pc-relative addresses. If eh_frame_hdr_address is given too,
+    an .eh_frame_hdr holding the sorted lookup table unwinders binary-search is added, meant to be loaded there.
+
+    The first row of each function becomes the initial instructions of its CIE, and identical CIEs are shared; the
+    rest is encoded as the difference from one row to the next. data_alignment_factor defaults to minus the address
+    size.
+    """
+    arch = as_arch(arch)
+    if eh_frame_hdr_address is not None and eh_frame_address is None:
+        raise ValueError("An .eh_frame_hdr needs an .eh_frame to index")
+    if data_alignment_factor is None:
+        data_alignment_factor = -arch.bytes
+    encoder = _CFIEncoder(arch, code_alignment_factor, data_alignment_factor)
+    eh = eh_frame_address is not None
+
+    data = bytearray()
+    cie_offsets = {}
+    fde_offsets = []
+    for frame in sorted(frames, key=lambda frame: frame.begin):
+        if not frame.rows:
+            continue
+        initial = frame.rows[0]
+        cie_instructions = encoder.encode_row(None, initial, {})
+        key = bytes(cie_instructions)
+        cie_offset = cie_offsets.get(key, None)
+        if cie_offset is None:
+            cie_offset = cie_offsets[key] = len(data)
+            _write_cie(arch, data, eh, code_alignment_factor, data_alignment_factor, return_address_register,
+                       cie_instructions)
+
+        instructions = bytearray()
+        state = initial
+        pc = frame.begin
+        for row in frame.rows[1:]:
+            change = encoder.encode_row(state, row, initial)
+            if not change:
+                continue
+            instructions.extend(encoder.encode_advance(row['pc'] - pc))
+            instructions.extend(change)
+            state = row
+            pc = row['pc']
+
+        fde_offsets.append((frame.begin, len(data)))
+        start = len(data)
+        if eh:
+            data.extend(struct.pack(_endness(arch) + 'II', 0, start + 4 - cie_offset))
+            data.extend(struct.pack(arch.struct_fmt(4, signed=True), frame.begin - (eh_frame_address + len(data))))
+            data.extend(struct.pack(arch.struct_fmt(4), frame.end - frame.begin))
+            data.append(0) # augmentation data length
+        else:
+            data.extend(struct.pack(_endness(arch) + 'II', 0, cie_offset))
+            data.extend(struct.pack(arch.struct_fmt(), frame.begin) + struct.pack(arch.struct_fmt(), frame.end - frame.begin))
+        data.extend(instructions)
+        _finish_entry(arch, data, start, eh)
+
+    if not eh:
+        return {'.debug_frame': data}
+    data.extend(bytes(4)) # terminator
+    result = {'.eh_frame': data}
+    if eh_frame_hdr_address is not None:
+        result['.eh_frame_hdr'] = _serialize_eh_frame_hdr(arch, eh_frame_address, eh_frame_hdr_address, fde_offsets)
+    return result
+
+
+def _write_cie(arch, data, eh, code_alignment_factor, data_alignment_factor, return_address_register, instructions):
+    start = len(data)
+    if eh:
+        # augmentation "zR": a length-prefixed augmentation data area holding the FDE pointer encoding
+        data.extend(struct.pack(_endness(arch) + 'IIB', 0, 0, EH_CIE_VERSION))
+        data.extend(b'zR\0')
+    else:
+        data.extend(struct.pack(_endness(arch) + 'IIB', 0, 0xffffffff, CIE_VERSION))
+        data.extend(b'\0')
+        data.extend(bytes([arch.bytes, 0])) # address_size, segment_size
+    data.extend(encode_uleb128(code_alignment_factor))
+    data.extend(encode_sleb128(data_alignment_factor))
+    if eh:
+        data.append(return_address_register)
+        data.extend(encode_uleb128(1))
+        data.append(DW_EH_PE_pcrel | DW_EH_PE_sdata4)
+    else:
+        data.extend(encode_uleb128(return_address_register))
+    data.extend(instructions)
+    _finish_entry(arch, data, start, eh)
+
+
+def _finish_entry(arch, data, start, eh):
+    # entries are padded with DW_CFA_nop to a multiple of the address size (.eh_frame: of 4, its pointer size), then
+    # their length filled in
+    while (len(data) - start) % (4 if eh else arch.bytes):
+        data.append(constants.DW_CFA_nop)
+    struct.pack_into(arch.struct_fmt(4), data, start, len(data) - start - 4)
+
+
+def _serialize_eh_frame_hdr(arch, eh_frame_address, hdr_address, fde_offsets):
+    data = bytearray(bytes([EH_FRAME_HDR_VERSION, DW_EH_PE_pcrel | DW_EH_PE_sdata4, DW_EH_PE_udata4,
+                            DW_EH_PE_datarel | DW_EH_PE_sdata4]))
+    data.extend(struct.pack(arch.struct_fmt(4, signed=True), eh_frame_address - (hdr_address + 4)))
+    data.extend(struct.pack(arch.struct_fmt(4), len(fde_offsets)))
+    fmt = _endness(arch) + 'ii'
+    for begin, offset in sorted(fde_offsets):
+        data.extend(struct.pack(fmt, begin - hdr_address, eh_frame_address + offset - hdr_address))
+    return data
+
+
+def _endness(arch):
+    return '<' if arch.memory_endness == 'Iend_LE' else '>'
+
+
+class _CFIEncoder:
+    def __init__(self, arch, code_alignment_factor, data_alignment_factor):
+        self.arch = arch
+        self.code_alignment_factor = code_alignment_factor
+        self.data_alignment_factor = data_alignment_factor
+        self.expr_serializer = DWARFExprSerializer(arch)
+
+    def encode_advance(self, delta):
+        delta, rem = divmod(delta, self.code_alignment_factor)
+        if rem or delta < 0:
+            raise ValueError("Unwind rows must be in address order and aligned to the code alignment factor")
+        if delta < 0x40:
+            return bytes([constants.DW_CFA_advance_loc | delta])
+        if delta <= 0xff:
+            return bytes([constants.DW_CFA_advance_loc1, delta])
+        if delta <= 0xffff:
+            return bytes([constants.DW_CFA_advance_loc2]) + struct.pack(self.arch.struct_fmt(2), delta)
+        return bytes([constants.DW_CFA_advance_loc4]) + struct.pack(self.arch.struct_fmt(4), delta)
+
+    def encode_row(self, prev, row, initial):
+        """The instructions turning the state prev (None for an empty one) into row. initial is the state the CIE
+        establishes, which DW_CFA_restore returns a register to.
+        """
+        result = bytearray()
+        cfa = self.cfa_key(row['cfa'])
+        prev_cfa = None if prev is None else self.cfa_key(prev['cfa'])
+        if cfa != prev_cfa:
+            reg, offset, expr = cfa
+            if expr is not None:
+                result.append(constants.DW_CFA_def_cfa_expression)
+                result.extend(encode_uleb128(len(expr)))
+                result.extend(expr)
+            elif prev_cfa is not None and prev_cfa[2] is None and reg == prev_cfa[0] and offset >= 0:
+                result.append(constants.DW_CFA_def_cfa_offset)
+                result.extend(encode_uleb128(offset))
+            elif prev_cfa is not None and prev_cfa[2] is None and offset == prev_cfa[1]:
+                result.append(constants.DW_CFA_def_cfa_register)
+                result.extend(encode_uleb128(reg))
+            elif offset >= 0:
+                result.append(constants.DW_CFA_def_cfa)
+                result.extend(encode_uleb128(reg))
+                result.extend(encode_uleb128(offset))
+            else:
+                result.append(constants.DW_CFA_def_cfa_sf)
+                result.extend(encode_uleb128(reg))
+                result.extend(encode_sleb128(self.factor(offset)))
+
+        prev_regs = {} if prev is None else prev
+        for reg in sorted(set(x for x in row if type(x) is int) | set(x for x in prev_regs if type(x) is int)):
+            rule = row.get(reg, None)
+            key = None if rule is None else self.rule_key(rule)
+            if key == (None if reg not in prev_regs else self.rule_key(prev_regs[reg])):
+                continue
+            initial_key = None if reg not in initial else self.rule_key(initial[reg])
+            if key == initial_key:
+                if reg < 0x40:
+                    result.append(constants.DW_CFA_restore | reg)
+                else:
+                    result.append(constants.DW_CFA_restore_extended)
+                    result.extend(encode_uleb128(reg))
+            elif key is None:
+                result.append(constants.DW_CFA_same_value)
+                result.extend(encode_uleb128(reg))
+            else:
+                result.extend(self.encode_rule(reg, *key))
+        return result
+
+    def encode_rule(self, reg, kind, arg):
+        result = bytearray()
+        if kind == RegisterRule.OFFSET:
+            factored = self.factor(arg)
+            if factored >= 0 and reg < 0x40:
+                result.append(constants.DW_CFA_offset | reg)
+                result.extend(encode_uleb128(factored))
+            else:
+                result.append(constants.DW_CFA_offset_extended if factored >= 0 else
+                              constants.DW_CFA_offset_extended_sf)
+                result.extend(encode_uleb128(reg))
+                # the _sf variants take a signed offset, which the others never need
+                result.extend(encode_sleb128(factored) if factored < 0 else encode_uleb128(factored))
+        elif kind == RegisterRule.VAL_OFFSET:
+            factored = self.factor(arg)
+            result.append(constants.DW_CFA_val_offset if factored >= 0 else constants.DW_CFA_val_offset_sf)
+            result.extend(encode_uleb128(reg))
+            result.extend(encode_sleb128(factored) if factored < 0 else encode_uleb128(factored))
+        elif kind == RegisterRule.REGISTER:
+            result.append(constants.DW_CFA_register)
+            result.extend(encode_uleb128(reg))
+            result.extend(encode_uleb128(arg))
+        elif kind in (RegisterRule.EXPRESSION, RegisterRule.VAL_EXPRESSION):
+            result.append(constants.DW_CFA_expression if kind == RegisterRule.EXPRESSION else
+                          constants.DW_CFA_val_expression)
+            result.extend(encode_uleb128(reg))
+            result.extend(encode_uleb128(len(arg)))
+            result.extend(arg)
+        elif kind == RegisterRule.UNDEFINED:
+            result.append(constants.DW_CFA_undefined)
+            result.extend(encode_uleb128(reg))
+        elif kind == RegisterRule.SAME_VALUE:
+            result.append(constants.DW_CFA_same_value)
+            result.extend(encode_uleb128(reg))
+        else:
+            raise ValueError("Cannot encode register rule %s" % kind)
+        return result
+
+    def factor(self, offset):
+        factored, rem = divmod(offset, self.data_alignment_factor)
+        if rem:
+            raise ValueError("Offset %d is not a multiple of the data alignment factor" % offset)
+        return factored
+
+    def cfa_key(self, cfa):
+        if cfa.expr is not None:
+            return None, None, self.expr_bytes(cfa.expr)
+        return cfa.reg, cfa.offset, None
+
+    def rule_key(self, rule):
+        if rule.type in (RegisterRule.EXPRESSION, RegisterRule.VAL_EXPRESSION):
+            return rule.type, self.expr_bytes(rule.arg)
+        return rule.type, rule.arg
+
+    def expr_bytes(self, expr):
+        if type(expr) is list and expr and type(expr[0]) is not int:
+            return bytes(self.expr_serializer.serialize_expr(expr))
+        return bytes(expr)
@@ -0,0 +1,54 @@
+# stable descriptions of unit dict trees, for hashing them (see cache) and comparing them (see canonical)
+
+from elftools.dwarf import dwarf_expr, lineprogram
+from elftools.dwarf.ranges import RangeEntry, BaseAddressEntry
+
+from . import serial
+
+def hash_unit(unit, h):
+    """Feed a stable description of a unit dict tree into the hashlib object h.
+
+    References between DIEs are described by the preorder index of their target, so two trees hash equally exactly
+    when they would serialize equally.
+    """
+    indexes = {}
+    order = []
+    stack = [unit]
+    while stack:
+        die = stack.pop()
+        indexes[id(die)] = len(order)
+        order.append(die)
+        stack.extend(reversed(die.get('children', [])))
+
+    for die in order:
+        attrs = sorted(x for x in die if type(x) is int and die[x] is not None)
+        h.update(repr((die['tag'], len(die.get('children', [])))).encode())
+        for x in attrs:
+            h.update(repr((x, describe_value(die[x], indexes))).encode())
+
+
+def describe_value(value, indexes):
+    kind = type(value)
+    if kind is dict:
+        if id(value) not in indexes:
+            raise Exception("Reference to object which was not included in the DIE tree")
+        return 'ref', indexes[id(value)]
+    if value is serial.VALUE_PRESENT:
+        return 'present',
+    if kind in (serial.Address, serial.SectionOffset, serial.Data8, serial.RawExpr):
+        return kind.__name__, value
+    if kind is dwarf_expr.DWARFExprOp:
+        return 'op', value.op, describe_value(value.args, indexes)
+    if kind is serial.LocationEntry:
+        return 'loc', value.begin_offset, value.end_offset, describe_value(value.location, indexes)
+    if kind is RangeEntry:
+        return 'range', value.begin_offset, value.end_offset
+    if kind is BaseAddressEntry:
+        return 'base', value.base_address
+    if isinstance(value, serial.LineRows):
+        return 'rows', value.describe()
+    if kind is lineprogram.LineState:
+        return 'line', tuple(sorted(vars(value).items()))
+    if kind in (list, tuple):
+        return tuple(describe_value(item, indexes) for item in value)
+    return value
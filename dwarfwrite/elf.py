@@ -1,48 +1,401 @@
 import os
 import shutil
-import subprocess
+import struct
 import tempfile
+import zlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-from elftools.elf.elffile import ELFFile
-
-def dump_elf(result, arch, outfile, infile=None):
-    result_update = {}
-    if infile is not None:
-        with open(infile, 'rb') as fp:
-            elf = ELFFile(fp)
-            for section in elf.iter_sections():
-                if section.name in result:
-                    result_update[section.name] = result.pop(section.name)
-
-    tmp = tempfile.mkdtemp()
-    with open(os.path.join(tmp, 'zero'), 'wb') as fp:
-        fp.write(b'\0')
-
-    for f in result:
-        with open(os.path.join(tmp, f), 'wb') as fp:
-            fp.write(result[f])
-    for f in result_update:
-        with open(os.path.join(tmp, f), 'wb') as fp:
-            fp.write(result_update[f])
-
-    # TODO add bfd_name to archinfo
-    linux_name = arch.linux_name.replace('_', '-')
-    if arch.name.startswith("ARM"):
-        linux_name = ('big' if arch.memory_endness == 'Iend_BE' else 'little') + linux_name
-    abi = 'elf%s-%s' % (arch.bits, linux_name)
-    extra_args = []
-    for f in result:
-        extra_args.append('--add-section')
-        extra_args.append('%s=%s' % (f, os.path.join(tmp, f)))
-    for f in result_update:
-        extra_args.append('--update-section')
-        extra_args.append('%s=%s' % (f, os.path.join(tmp, f)))
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from elftools.elf.enums import ENUM_E_MACHINE
+
+from .arch import as_arch
+
+SHT_NULL = 0
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+SHF_COMPRESSED = 0x800
+SHN_LORESERVE = 0xff00
+SHN_ABS = 0xfff1
+SHN_XINDEX = 0xffff
+ET_REL = 1
+EV_CURRENT = 1
+ELFCOMPRESS_ZLIB = 1
+ELFCOMPRESS_ZSTD = 2
+STB_GLOBAL = 1
+STT_FUNC = 2
+
+
+def dump_elf(result, arch, outfile, infile=None, compression=None, compression_level=None, dwo_file=None):
+    """Write the sections in result (name -> bytes) into an ELF file.
+
+    If infile is given, its contents are carried over: sections named in result are replaced and any others are
+    appended. Otherwise, a bare relocatable object holding only the given sections is produced.
+
+    compression may be 'zlib' or 'zstd', in which case the .debug_* sections are written as SHF_COMPRESSED sections,
+    compressed in parallel at the given compression_level.
+
+    Sections whose names end in .dwo (as produced by split DWARF serialization) are written to a separate object at
+    dwo_file instead.
+    """
+    if compression not in (None, 'zlib', 'zstd'):
+        raise ValueError("Unknown compression %r" % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+    dwo_result = {name: data for name, data in result.items() if name.endswith('.dwo')}
+    if dwo_result:
+        if dwo_file is None:
+            raise ValueError("Split DWARF sections were given but no dwo_file to write them to")
+        result = {name: data for name, data in result.items() if name not in dwo_result}
+        _write_elf(dwo_result, arch, dwo_file, None, compression, compression_level)
+
+    _write_elf(result, arch, outfile, infile, compression, compression_level)
+
+
+def _write_elf(result, arch, outfile, infile, compression, compression_level):
     if infile is None:
-        in_flags = ['--input-target=binary', '-S', '--remove-section=.data']
-        in_args = [os.path.join(tmp, 'zero')]
+        with open(outfile, 'wb', buffering=0) as out:
+            image = _ElfImage.empty(arch)
+            image.update(result, compression, compression_level)
+            image.write(out)
+        return
+
+    if os.path.exists(outfile) and os.path.samefile(infile, outfile):
+        fd, target = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)))
+        os.close(fd)
     else:
-        in_flags = []
-        in_args = [infile]
-    subprocess.check_call(['objcopy', '--output-target=' + abi] + in_flags + extra_args + in_args + [outfile])
+        target = outfile
+
+    try:
+        with open(infile, 'rb', buffering=0) as fp, open(target, 'wb', buffering=0) as out:
+            image = _ElfImage.read(fp)
+            image.update(result, compression, compression_level)
+            image.write(out)
+        shutil.copymode(infile, target)
+        if target != outfile:
+            os.replace(target, outfile)
+    except BaseException:
+        if target != outfile:
+            os.unlink(target)
+        raise
+
+
+def elf_object(result, arch, text=None, symbols=()):
+    """Build a minimal relocatable object holding the sections in result (name -> bytes) and return it as bytes.
+
+    This is meant for in-memory consumers such as GDB's JIT interface (__jit_debug_register_code), so nothing touches
+    the disk. text is an optional (address, size) pair describing the code the debug info refers to; it becomes a
+    .text section without contents. symbols is an iterable of (name, address, size) function symbols, placed in .text
+    if it is given.
+    """
+    arch = as_arch(arch)
+    fmt = _elf_format(arch.bits, '<' if arch.memory_endness == 'Iend_LE' else '>')
+    ptr_align = 8 if arch.bits == 64 else 4
+
+    # name, type, flags, addr, data, size, link, info, align, entsize
+    sections = [('', SHT_NULL, 0, 0, b'', 0, 0, 0, 0, 0)]
+    text_index = SHN_ABS
+    if text is not None:
+        text_index = len(sections)
+        sections.append(('.text', SHT_NOBITS, SHF_ALLOC | SHF_EXECINSTR, text[0], b'', text[1], 0, 0, 16, 0))
+    for name, data in result.items():
+        sections.append((name, SHT_PROGBITS, 0, 0, data, len(data), 0, 0, 1, 0))
+
+    symbols = list(symbols)
+    if symbols:
+        strtab = bytearray(b'\0')
+        symtab = bytearray(fmt.sym.size)
+        info = STB_GLOBAL << 4 | STT_FUNC
+        for name, address, size in symbols:
+            if type(name) is str:
+                name = name.encode('utf-8')
+            if fmt.bits == 64:
+                symtab.extend(fmt.sym.pack(len(strtab), info, 0, text_index, address, size))
+            else:
+                symtab.extend(fmt.sym.pack(len(strtab), address, size, info, 0, text_index))
+            strtab.extend(name)
+            strtab.append(0)
+        # sh_link of .symtab is the index of .strtab, sh_info one past the last local symbol
+        sections.append(('.symtab', SHT_SYMTAB, 0, 0, symtab, len(symtab), len(sections) + 1, 1, ptr_align,
+                         fmt.sym.size))
+        sections.append(('.strtab', SHT_STRTAB, 0, 0, strtab, len(strtab), 0, 0, 1, 0))
+
+    shstrtab = bytearray(b'\0')
+    name_offsets = []
+    for section in sections[1:]:
+        name_offsets.append(len(shstrtab))
+        shstrtab.extend(section[0].encode())
+        shstrtab.append(0)
+    name_offsets.append(len(shstrtab))
+    shstrtab.extend(b'.shstrtab\0')
+    sections.append(('.shstrtab', SHT_STRTAB, 0, 0, shstrtab, len(shstrtab), 0, 0, 1, 0))
+
+    out = bytearray(fmt.ehdr.size)
+    headers = bytearray(fmt.shdr.size)
+    for section, name_offset in zip(sections[1:], name_offsets):
+        _, kind, flags, addr, data, size, link, info, align, entsize = section
+        if align > 1 and len(out) % align:
+            out.extend(bytes(align - len(out) % align))
+        headers.extend(fmt.shdr.pack(name_offset, kind, flags, addr, len(out), size, link, info, align, entsize))
+        out.extend(data)
+    if len(out) % ptr_align:
+        out.extend(bytes(ptr_align - len(out) % ptr_align))
+
+    fmt.ehdr.pack_into(out, 0, fmt.ident, ET_REL, ENUM_E_MACHINE.get(arch.machine, 0), EV_CURRENT, 0, 0, len(out), 0,
+                       fmt.ehdr.size, 0, 0, fmt.shdr.size, len(sections), len(sections) - 1)
+    out.extend(headers)
+    return bytes(out)
+
+
+@functools.lru_cache(maxsize=None)
+def _elf_format(bits, endness):
+    return _ElfFormat(bits, endness)
+
+
+class _ElfFormat:
+    def __init__(self, bits, endness):
+        self.bits = bits
+        self.endness = endness
+        if bits == 64:
+            self.ehdr = struct.Struct(endness + '16sHHIQQQIHHHHHH')
+            self.phdr = struct.Struct(endness + 'IIQQQQQQ')
+            self.phdr_offset_idx, self.phdr_filesz_idx = 2, 5
+        else:
+            self.ehdr = struct.Struct(endness + '16sHHIIIIIHHHHHH')
+            self.phdr = struct.Struct(endness + 'IIIIIIII')
+            self.phdr_offset_idx, self.phdr_filesz_idx = 1, 4
+        self.chdr = struct.Struct(endness + ('IIQQ' if bits == 64 else 'III'))
+        self.sym = struct.Struct(endness + ('IBBHQQ' if bits == 64 else 'IIIBBH'))
+        ident = b'\x7fELF' + bytes([2 if bits == 64 else 1, 1 if endness == '<' else 2, EV_CURRENT])
+        self.ident = ident.ljust(16, b'\0')
+        # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize
+        self.shdr = struct.Struct(endness + ('IIQQQQIIQQ' if bits == 64 else 'IIIIIIIIII'))
+
+
+class _Section:
+    __slots__ = ('name', 'header', 'data')
+
+    def __init__(self, name, header, data=None):
+        self.name = name
+        self.header = header
+        # None means the contents still live in the input file at the original header offset
+        self.data = data
+
+    type = property(lambda self: self.header[1])
+    flags = property(lambda self: self.header[2])
+    offset = property(lambda self: self.header[4])
+    size = property(lambda self: self.header[5])
+
+
+class _ElfImage:
+    def __init__(self, fmt, ehdr, sections, shstrndx, fixed_end, src=None):
+        self.fmt = fmt
+        self.ehdr = ehdr
+        self.sections = sections
+        self.shstrndx = shstrndx
+        # everything before fixed_end (headers, segments, allocated sections) is copied verbatim
+        self.fixed_end = fixed_end
+        self.src = src
+
+    @classmethod
+    def empty(cls, arch):
+        endness = '<' if arch.memory_endness == 'Iend_LE' else '>'
+        fmt = _elf_format(arch.bits, endness)
+        machine = ENUM_E_MACHINE.get(as_arch(arch).machine, 0)
+        ehdr = [fmt.ident, ET_REL, machine, EV_CURRENT, 0, 0, 0, 0, fmt.ehdr.size, 0, 0, fmt.shdr.size,
+                0, 0]
+        sections = [
+            _Section('', [0] * 10, b''),
+            _Section('.shstrtab', [1, SHT_STRTAB, 0, 0, 0, 0, 0, 0, 1, 0], bytearray(b'\0.shstrtab\0')),
+        ]
+        return cls(fmt, ehdr, sections, 1, fmt.ehdr.size)
+
+    @classmethod
+    def read(cls, fp):
+        ident = fp.read(16)
+        if ident[:4] != b'\x7fELF':
+            raise ValueError("Not an ELF file")
+        fmt = _ElfFormat(64 if ident[4] == 2 else 32, '<' if ident[5] == 1 else '>')
+        src = fp.fileno()
+        ehdr = list(fmt.ehdr.unpack(os.pread(src, fmt.ehdr.size, 0)))
+        phoff, shoff = ehdr[5], ehdr[6]
+        phentsize, phnum, shentsize, shnum, shstrndx = ehdr[9:14]
+
+        headers = []
+        if shoff:
+            first = list(fmt.shdr.unpack(os.pread(src, fmt.shdr.size, shoff)))
+            if shnum == 0:
+                shnum = first[5]
+            if shstrndx == SHN_XINDEX:
+                shstrndx = first[6]
+            raw = os.pread(src, shentsize * shnum, shoff)
+            headers = [list(fmt.shdr.unpack_from(raw, i * shentsize)) for i in range(shnum)]
+
+        fixed_end = max(fmt.ehdr.size, phoff + phentsize * phnum)
+        if phnum:
+            raw = os.pread(src, phentsize * phnum, phoff)
+            for i in range(phnum):
+                phdr = fmt.phdr.unpack_from(raw, i * phentsize)
+                fixed_end = max(fixed_end, phdr[fmt.phdr_offset_idx] + phdr[fmt.phdr_filesz_idx])
+        for header in headers:
+            if header[2] & SHF_ALLOC and header[1] != SHT_NOBITS:
+                fixed_end = max(fixed_end, header[4] + header[5])
+
+        strtab = b''
+        if 0 < shstrndx < len(headers):
+            strtab = os.pread(src, headers[shstrndx][5], headers[shstrndx][4])
+        sections = [_Section(strtab[h[0]:strtab.find(b'\0', h[0])].decode(), h) for h in headers]
+        if not sections:
+            sections.append(_Section('', [0] * 10, b''))
+        if 0 < shstrndx < len(sections):
+            sections[shstrndx].data = bytearray(strtab)
+        else:
+            shstrndx = len(sections)
+            sections.append(_Section('.shstrtab', [1, SHT_STRTAB, 0, 0, 0, 0, 0, 0, 1, 0],
+                                     bytearray(b'\0.shstrtab\0')))
+        return cls(fmt, ehdr, sections, shstrndx, fixed_end, src)
+
+    def update(self, result, compression=None, compression_level=None):
+        existing = {section.name: section for section in self.sections if section.name}
+        replaced = {i for i, section in enumerate(self.sections) if section.name in result}
+        for name, data in result.items():
+            section = existing.get(name, None)
+            if section is None:
+                strtab = self.sections[self.shstrndx].data
+                section = _Section(name, [len(strtab), SHT_PROGBITS, 0, 0, 0, 0, 0, 0, 1, 0])
+                strtab.extend(name.encode())
+                strtab.append(0)
+                self.sections.append(section)
+                existing[name] = section
+            elif section.flags & SHF_ALLOC:
+                raise ValueError("Cannot replace allocated section %s" % name)
+            elif section.type == SHT_NOBITS:
+                section.header[1] = SHT_PROGBITS
+            section.header[2] &= ~SHF_COMPRESSED
+            section.data = data
+
+        if compression is not None:
+            targets = [existing[name] for name in result if name.startswith('.debug_')]
+            with ThreadPoolExecutor() as pool:
+                compressed = list(pool.map(lambda section: self.compress(section.data, section.header[8],
+                                                                          compression, compression_level), targets))
+            for section, data in zip(targets, compressed):
+                section.data = data
+                section.header[2] |= SHF_COMPRESSED
+                section.header[8] = 8 if self.fmt.bits == 64 else 4
+
+        # relocations against the old contents of a replaced section no longer apply (objcopy drops them too)
+        for section in self.sections:
+            if section.type in (SHT_REL, SHT_RELA) and section.header[7] in replaced and section.name not in result:
+                section.data = b''
+
+    def compress(self, data, align, compression, level):
+        if compression == 'zstd':
+            kind = ELFCOMPRESS_ZSTD
+            payload = zstandard.ZstdCompressor(level=3 if level is None else level).compress(bytes(data))
+        else:
+            kind = ELFCOMPRESS_ZLIB
+            payload = zlib.compress(data, -1 if level is None else level)
+        if self.fmt.bits == 64:
+            header = self.fmt.chdr.pack(kind, 0, len(data), max(align, 1))
+        else:
+            header = self.fmt.chdr.pack(kind, len(data), max(align, 1))
+        return header + payload
+
+    def write(self, out):
+        dst = out.fileno()
+        pos = 0
+        if self.src is not None:
+            _copy_range(self.src, dst, 0, self.fixed_end)
+            pos = self.fixed_end
+        else:
+            _write_all(dst, bytes(self.fixed_end))
+            pos = self.fixed_end
+
+        for section in self.sections[1:]:
+            if section.data is None and section.offset + section.size <= self.fixed_end:
+                continue
+            if section.data is None and section.type == SHT_NOBITS:
+                section.header[4] = pos
+                continue
+            if section.flags & SHF_ALLOC and section.data is None:
+                continue
+            align = section.header[8]
+            if align > 1 and pos % align:
+                pad = align - pos % align
+                _write_all(dst, bytes(pad))
+                pos += pad
+            if section.data is None:
+                _copy_range(self.src, dst, section.offset, section.size)
+            else:
+                _write_all(dst, section.data)
+                section.header[5] = len(section.data)
+            section.header[4] = pos
+            pos += section.size
+
+        align = 8 if self.fmt.bits == 64 else 4
+        if pos % align:
+            _write_all(dst, bytes(align - pos % align))
+            pos += align - pos % align
+
+        shnum = len(self.sections)
+        self.sections[0].header[5] = shnum if shnum >= SHN_LORESERVE else 0
+        self.sections[0].header[6] = self.shstrndx if self.shstrndx >= SHN_LORESERVE else 0
+        table = bytearray()
+        for section in self.sections:
+            table.extend(self.fmt.shdr.pack(*section.header))
+        _write_all(dst, table)
+
+        ehdr = list(self.ehdr)
+        ehdr[6] = pos
+        ehdr[11] = self.fmt.shdr.size
+        ehdr[12] = shnum if shnum < SHN_LORESERVE else 0
+        ehdr[13] = self.shstrndx if self.shstrndx < SHN_LORESERVE else SHN_XINDEX
+        os.pwrite(dst, self.fmt.ehdr.pack(*ehdr), 0)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_range(src, dst, offset, count):
+    # copy count bytes at offset in src to the current position of dst, in-kernel where the platform allows it
+    end = offset + count
+    for copier in (getattr(os, 'copy_file_range', None), _sendfile):
+        if copier is None:
+            continue
+        try:
+            while offset < end:
+                n = copier(src, dst, end - offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            continue
+        if offset >= end:
+            return
+    while offset < end:
+        chunk = os.pread(src, min(end - offset, 1 << 20), offset)
+        if not chunk:
+            raise ValueError("Input ELF is truncated")
+        _write_all(dst, chunk)
+        offset += len(chunk)
+
 
-    shutil.rmtree(tmp)
+def _sendfile(src, dst, count, offset):
+    if not hasattr(os, 'sendfile'):
+        raise OSError("sendfile unavailable")
+    return os.sendfile(dst, src, offset, count)
@@ -1,11 +1,35 @@
 import struct
 
-from elftools.dwarf.dwarf_expr import DW_OP_name2opcode
+from elftools.dwarf.dwarf_expr import DW_OP_name2opcode, DWARFExprOp
 
 from . import serial
+from .leb128 import encode_sleb128, encode_uleb128
 
 ULEB128 = object()
 SLEB128 = object()
+REF4 = object()
+REF_ADDR = object()
+
+# ops with a DIE offset operand, which may also be given as the DIE dict: opcode -> (index of the operand, its encoding).
+# REF4 offsets are relative to the unit, REF_ADDR ones to the section
+DIE_OPERANDS = {DW_OP_name2opcode[name]: (index, fmt) for name, index, fmt in (
+    ('DW_OP_GNU_const_type', 0, ULEB128),
+    ('DW_OP_GNU_regval_type', 1, ULEB128),
+    ('DW_OP_GNU_deref_type', 1, ULEB128),
+    ('DW_OP_GNU_convert', 0, ULEB128),
+    ('DW_OP_call4', 0, REF4),
+    ('DW_OP_call_ref', 0, REF_ADDR),
+    ('DW_OP_GNU_implicit_pointer', 0, REF_ADDR),
+    ('DW_OP_GNU_parameter_ref', 0, REF4),
+)}
+
+ENTRY_VALUE_OPS = {DW_OP_name2opcode['DW_OP_entry_value'], DW_OP_name2opcode['DW_OP_GNU_entry_value']}
+
+# the ops serialize_expr looks at before going to the dispatch table
+_REF_OPS = DIE_OPERANDS.keys() | ENTRY_VALUE_OPS
+
+# dispatch tables only depend on the arch's struct formats, so they are built once per process
+_dispatch_tables = {}
 
 class DWARFExprSerializer:
     """DWARF expression serializer.
@@ -15,20 +39,59 @@ class DWARFExprSerializer:
     """
 
     def __init__(self, arch):
-        self._dispatch_table = _init_dispatch_table(arch)
+        key = (arch.name, arch.memory_endness, arch.bits)
+        table = _dispatch_tables.get(key, None)
+        if table is None:
+            table = _dispatch_tables[key] = _init_dispatch_table(arch)
+        self._dispatch_table = table
 
-    def serialize_expr(self, expr):
-        """ Serializes a list of DWARFExprOp.
+    def serialize_expr(self, expr, refs=None):
+        """ Serializes a list of DWARFExprOp. A serial.RawExpr is passed through as-is.
+
+        The operands listed in DIE_OPERANDS may be DIE dicts. Their offsets are left as four zero bytes - padded, where
+        the operand is a ULEB128 - and (position, encoding, DIE) is appended to refs for the caller to fill in.
         """
+        if type(expr) is serial.RawExpr:
+            return expr
         serialized = bytearray()
 
         for op in expr:
             serialized.append(op.op)
-            arg_serializer = self._dispatch_table[op.op]
-            serialized.extend(arg_serializer(op))
+            if op.op not in _REF_OPS:
+                arg_serializer = self._dispatch_table[op.op]
+                serialized.extend(arg_serializer(op))
+            elif op.op in DIE_OPERANDS and type(op.args[DIE_OPERANDS[op.op][0]]) is dict:
+                self._serialize_die_operand(op, serialized, refs)
+            elif op.op in ENTRY_VALUE_OPS and refs is not None:
+                nested_refs = []
+                nested = self.serialize_expr(op.args[0], nested_refs)
+                serialized.extend(struct_parse(ULEB128, len(nested)))
+                refs.extend((len(serialized) + pos, fmt, die) for pos, fmt, die in nested_refs)
+                serialized.extend(nested)
+            else:
+                serialized.extend(self._dispatch_table[op.op](op))
 
         return serialized
 
+    @staticmethod
+    def _serialize_die_operand(op, serialized, refs):
+        index, fmt = DIE_OPERANDS[op.op]
+        if refs is None:
+            raise TypeError("%s refers to a DIE, which can only be serialized as part of a unit" % op.op_name)
+        # DW_OP_GNU_regval_type has a register number before the DIE and DW_OP_GNU_deref_type a size, while
+        # DW_OP_GNU_const_type has the constant after it and DW_OP_GNU_implicit_pointer an offset
+        if op.op == DW_OP_name2opcode['DW_OP_GNU_regval_type']:
+            serialized.extend(struct_parse(ULEB128, op.args[0]))
+        elif op.op == DW_OP_name2opcode['DW_OP_GNU_deref_type']:
+            serialized.append(op.args[0])
+        refs.append((len(serialized), fmt, op.args[index]))
+        serialized.extend(bytes(4))
+        if op.op == DW_OP_name2opcode['DW_OP_GNU_const_type']:
+            serialized.append(len(op.args[1]))
+            serialized.extend(bytes(op.args[1]))
+        elif op.op == DW_OP_name2opcode['DW_OP_GNU_implicit_pointer']:
+            serialized.extend(struct_parse(SLEB128, op.args[1]))
+
 
 def _init_dispatch_table(arch):
     """Creates a dispatch table for parsing args of an op.
@@ -73,9 +136,9 @@ def _init_dispatch_table(arch):
     # ULEB128 with datatype DIE offset, then byte, then a blob of that size
     def parse_typedblob():
         def parse(stream):
-            raise NotImplementedError("not yet supported")
+            blob = bytearray(stream.args[1])
+            return struct_parse(ULEB128, stream.args[0]) + bytes([len(blob)]) + blob
         return parse
-        #return lambda stream: [struct_parse(ULEB128, stream), read_blob(stream, struct_parse(arch.struct_fmt(size=1), stream))]
 
     add('DW_OP_addr', parse_op_addr())
     add('DW_OP_const1u', parse_arg_struct(arch.struct_fmt(size=1)))
@@ -121,7 +184,8 @@ def _init_dispatch_table(arch):
     add('DW_OP_xderef_size', parse_arg_struct(arch.struct_fmt(size=1, signed=True)))
     add('DW_OP_call2', parse_arg_struct(arch.struct_fmt(size=2)))
     add('DW_OP_call4', parse_arg_struct(arch.struct_fmt(size=4)))
-    add('DW_OP_call_ref', parse_arg_struct(arch.struct_fmt()))
+    # DIE offsets in the rest of .debug_info are four bytes in 32-bit DWARF, whatever the address size
+    add('DW_OP_call_ref', parse_arg_struct(arch.struct_fmt(size=4)))
     add('DW_OP_implicit_value', parse_blob())
     add('DW_OP_GNU_entry_value', parse_nestedexpr())
     add('DW_OP_GNU_const_type', parse_typedblob())
@@ -129,14 +193,46 @@ def _init_dispatch_table(arch):
                                                    ULEB128))
     add('DW_OP_GNU_deref_type', parse_arg_struct2(arch.struct_fmt(size=1),
                                                   ULEB128))
-    add('DW_OP_GNU_implicit_pointer', parse_arg_struct2(arch.struct_fmt(),
+    add('DW_OP_GNU_implicit_pointer', parse_arg_struct2(arch.struct_fmt(size=4),
                                                         SLEB128))
-    add('DW_OP_GNU_parameter_ref', parse_arg_struct(arch.struct_fmt()))
+    add('DW_OP_GNU_parameter_ref', parse_arg_struct(arch.struct_fmt(size=4)))
     add('DW_OP_GNU_convert', parse_arg_struct(ULEB128))
 
     return table
 
 def struct_parse(fmt, data):
-    if fmt in (ULEB128, SLEB128):
-        return serial._Serializer.encode_leb128(data)
+    if fmt is ULEB128:
+        return encode_uleb128(data)
+    if fmt is SLEB128:
+        return encode_sleb128(data)
     return struct.pack(fmt, data)
+
+def pack_die_operand(arch, fmt, buf, pos, offset):
+    """Fills in the DIE offset left blank at pos by serialize_expr."""
+    if fmt is ULEB128:
+        if offset >= 1 << 28:
+            raise ValueError("DIE offset 0x%x does not fit in the space left for it" % offset)
+        buf[pos:pos + 4] = bytes([offset & 0x7f | 0x80, offset >> 7 & 0x7f | 0x80, offset >> 14 & 0x7f | 0x80,
+                                  offset >> 21])
+    else:
+        struct.pack_into(arch.struct_fmt(size=4), buf, pos, offset)
+
+def iter_die_operands(value):
+    """Yields (args, index) for each DIE dict operand in an attribute value, if it is an expression or a location list.
+    """
+    if type(value) is not list or not value:
+        return
+    if type(value[0]) is serial.LocationEntry:
+        stack = [entry.location for entry in value if type(entry.location) is list]
+    elif type(value[0]) is DWARFExprOp:
+        stack = [value]
+    else:
+        return
+    while stack:
+        for op in stack.pop():
+            if op.op in DIE_OPERANDS:
+                index = DIE_OPERANDS[op.op][0]
+                if type(op.args[index]) is dict:
+                    yield op.args, index
+            elif op.op in ENTRY_VALUE_OPS:
+                stack.append(op.args[0])
@@ -0,0 +1,209 @@
+import struct
+from collections import namedtuple, defaultdict
+
+from elftools.dwarf import enums
+
+from .leb128 import encode_uleb128
+
+NAMES_VERSION = 5
+GDB_INDEX_VERSION = 8
+
+DW_IDX_compile_unit = 1
+DW_IDX_die_offset = 3
+
+GDB_INDEX_KIND_TYPE = 1
+GDB_INDEX_KIND_VARIABLE = 2
+GDB_INDEX_KIND_FUNCTION = 3
+GDB_INDEX_KIND_OTHER = 4
+
+# name: bytes, tag: DW_TAG_* int, cu_index: index into the unit list, die_offset: offset relative to the unit,
+# is_static: whether the name is not visible outside its unit
+NameEntry = namedtuple("NameEntry", ("name", "tag", "cu_index", "die_offset", "is_static"))
+
+INDEX_KINDS = {
+    enums.ENUM_DW_TAG['DW_TAG_subprogram']: GDB_INDEX_KIND_FUNCTION,
+    enums.ENUM_DW_TAG['DW_TAG_variable']: GDB_INDEX_KIND_VARIABLE,
+    enums.ENUM_DW_TAG['DW_TAG_enumerator']: GDB_INDEX_KIND_VARIABLE,
+    enums.ENUM_DW_TAG['DW_TAG_base_type']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_structure_type']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_class_type']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_union_type']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_enumeration_type']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_typedef']: GDB_INDEX_KIND_TYPE,
+    enums.ENUM_DW_TAG['DW_TAG_namespace']: GDB_INDEX_KIND_TYPE,
+}
+
+# children of these are indexed as well, e.g. enumerators
+INDEX_CONTAINER_TAGS = {
+    enums.ENUM_DW_TAG['DW_TAG_enumeration_type'],
+    enums.ENUM_DW_TAG['DW_TAG_namespace'],
+}
+
+
+def collect_names(unit, cu_index, reference_cache):
+    """Gather the NameEntry list for a unit dict which has just been serialized.
+
+    reference_cache maps id() of each DIE dict to its unit-relative offset, as the serializer records it.
+    """
+    result = []
+    name_attrs = (enums.ENUM_DW_AT['DW_AT_name'], enums.ENUM_DW_AT['DW_AT_linkage_name'])
+    queue = list(unit.get('children', []))
+    while queue:
+        die = queue.pop()
+        tag = die['tag']
+        if tag not in INDEX_KINDS or die.get(enums.ENUM_DW_AT['DW_AT_declaration'], None) is not None:
+            continue
+        if tag in INDEX_CONTAINER_TAGS:
+            queue.extend(die.get('children', []))
+        if INDEX_KINDS[tag] in (GDB_INDEX_KIND_FUNCTION, GDB_INDEX_KIND_VARIABLE):
+            is_static = die.get(enums.ENUM_DW_AT['DW_AT_external'], None) is None
+        else:
+            is_static = True
+        for attr in name_attrs:
+            name = die.get(attr, None)
+            if name is None:
+                continue
+            if type(name) is str:
+                name = name.encode('utf-8')
+            result.append(NameEntry(bytes(name), tag, cu_index, reference_cache[id(die)], is_static))
+    return result
+
+
+def djb_hash(name):
+    h = 5381
+    for c in name.lower():
+        h = (h * 33 + c) & 0xffffffff
+    return h
+
+
+def serialize_debug_names(arch, cu_offsets, entries, lookup_string):
+    """Build a DWARF 5 .debug_names section.
+
+    cu_offsets is the list of .debug_info offsets of each unit, entries the NameEntry list and lookup_string a
+    function returning the .debug_str offset of a name.
+    """
+    endness = '<' if arch.memory_endness == 'Iend_LE' else '>'
+    by_name = defaultdict(list)
+    for entry in entries:
+        by_name[entry.name].append(entry)
+
+    name_count = len(by_name)
+    bucket_count = max(1, name_count // 2)
+    names = sorted(by_name, key=lambda name: (djb_hash(name) % bucket_count, djb_hash(name), name))
+
+    cu_form, cu_size = (enums.ENUM_DW_FORM['DW_FORM_data1'], 'B') if len(cu_offsets) <= 0xff else \
+        (enums.ENUM_DW_FORM['DW_FORM_data2'], 'H') if len(cu_offsets) <= 0xffff else \
+        (enums.ENUM_DW_FORM['DW_FORM_data4'], 'I')
+    abbrev_codes = {}
+    abbrevs = bytearray()
+    for tag in sorted(set(entry.tag for entry in entries)):
+        code = len(abbrev_codes) + 1
+        abbrev_codes[tag] = code
+        abbrevs.extend(encode_uleb128(code))
+        abbrevs.extend(encode_uleb128(tag))
+        abbrevs.extend(encode_uleb128(DW_IDX_compile_unit))
+        abbrevs.extend(encode_uleb128(cu_form))
+        abbrevs.extend(encode_uleb128(DW_IDX_die_offset))
+        abbrevs.extend(encode_uleb128(enums.ENUM_DW_FORM['DW_FORM_ref4']))
+        abbrevs.extend(bytes(2))
+    abbrevs.append(0)
+
+    buckets = [0] * bucket_count
+    hashes = bytearray()
+    str_offsets = bytearray()
+    entry_offsets = bytearray()
+    pool = bytearray()
+    for i, name in enumerate(names):
+        h = djb_hash(name)
+        if buckets[h % bucket_count] == 0:
+            buckets[h % bucket_count] = i + 1
+        hashes.extend(struct.pack(endness + 'I', h))
+        str_offsets.extend(struct.pack(endness + 'I', lookup_string(name)))
+        entry_offsets.extend(struct.pack(endness + 'I', len(pool)))
+        for entry in by_name[name]:
+            pool.extend(encode_uleb128(abbrev_codes[entry.tag]))
+            pool.extend(struct.pack(endness + cu_size + 'I', entry.cu_index, entry.die_offset))
+        pool.append(0)
+
+    data = bytearray(struct.pack(endness + 'IHHIIIIIII', 0, NAMES_VERSION, 0, len(cu_offsets), 0, 0, bucket_count,
+                                 name_count, len(abbrevs), 0))
+    for offset in cu_offsets:
+        data.extend(struct.pack(endness + 'I', offset))
+    data.extend(struct.pack(endness + '%dI' % bucket_count, *buckets))
+    data.extend(hashes)
+    data.extend(str_offsets)
+    data.extend(entry_offsets)
+    data.extend(abbrevs)
+    data.extend(pool)
+    struct.pack_into(endness + 'I', data, 0, len(data) - 4)
+    return data
+
+
+def gdb_index_hash(name):
+    # mapped_index_string_hash from gdb, index version >= 5
+    h = 0
+    for c in name.lower():
+        h = (h * 67 + c - 113) & 0xffffffff
+    return h
+
+
+def serialize_gdb_index(cu_list, unit_ranges, entries):
+    """Build a version 8 .gdb_index section. This format is always little-endian.
+
+    cu_list is a list of (.debug_info offset, length) per unit and unit_ranges a list of (cu index, [(begin, end)]).
+    """
+    cu_area = bytearray()
+    for offset, length in cu_list:
+        cu_area.extend(struct.pack('<QQ', offset, length))
+
+    address_area = bytearray()
+    for cu_index, ranges in unit_ranges:
+        for begin, end in ranges:
+            address_area.extend(struct.pack('<QQI', begin, end, cu_index))
+
+    symbols = defaultdict(list)
+    for entry in entries:
+        value = entry.cu_index | INDEX_KINDS[entry.tag] << 28 | int(entry.is_static) << 31
+        if value not in symbols[entry.name]:
+            symbols[entry.name].append(value)
+
+    size = 32
+    while size * 3 < len(symbols) * 4:
+        size *= 2
+    slots = [(0, 0)] * size
+
+    constant_pool = bytearray()
+    vector_offsets = {}
+    for name in sorted(symbols):
+        vector = tuple(symbols[name])
+        if vector not in vector_offsets:
+            vector_offsets[vector] = len(constant_pool)
+            constant_pool.extend(struct.pack('<%dI' % (len(vector) + 1), len(vector), *vector))
+        name_offset = len(constant_pool)
+        constant_pool.extend(name)
+        constant_pool.append(0)
+
+        h = gdb_index_hash(name)
+        index = h & (size - 1)
+        step = ((h * 17) & (size - 1)) | 1
+        while slots[index] != (0, 0):
+            index = (index + step) & (size - 1)
+        slots[index] = (name_offset, vector_offsets[vector])
+
+    symbol_table = bytearray()
+    for name_offset, vector_offset in slots:
+        symbol_table.extend(struct.pack('<II', name_offset, vector_offset))
+
+    cu_list_offset = 6 * 4
+    types_offset = cu_list_offset + len(cu_area)
+    address_offset = types_offset
+    symbol_offset = address_offset + len(address_area)
+    pool_offset = symbol_offset + len(symbol_table)
+    data = bytearray(struct.pack('<6I', GDB_INDEX_VERSION, cu_list_offset, types_offset, address_offset, symbol_offset,
+                                 pool_offset))
+    data.extend(cu_area)
+    data.extend(address_area)
+    data.extend(symbol_table)
+    data.extend(constant_pool)
+    return data
+
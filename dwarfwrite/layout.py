@@ -0,0 +1,89 @@
+from elftools.dwarf import enums
+
+from .serial import RawUnit, die_address_ranges, unit_address_ranges
+from .expr_serial import iter_die_operands
+
+TYPE_PLACEMENTS = ('first-use', 'block')
+
+_SUBPROGRAM = enums.ENUM_DW_TAG['DW_TAG_subprogram']
+_VARIABLE = enums.ENUM_DW_TAG['DW_TAG_variable']
+
+
+def order_by_address(units, type_placement='first-use'):
+    """Reorder unit dicts so that .debug_info can be read front to back in address order.
+
+    Units are sorted by their lowest address, and within each unit the functions with code by their start address.
+    Whatever those refer to at the top level of the unit - types, and abstract instances of inlined functions - is
+    placed right before its first user with type_placement='first-use', or gathered, in order of first use, in a
+    block at the start of the unit with 'block'. Variables come first, followed by their own types; top-level DIEs
+    nothing refers to keep their relative order at the start.
+
+    Units are modified in place; the sorted list is returned. Pass a single unit at a time to keep the unit order.
+    """
+    if type_placement not in TYPE_PLACEMENTS:
+        raise ValueError("type_placement must be one of %s" % ', '.join(TYPE_PLACEMENTS))
+    units = list(units)
+    for unit in units:
+        if type(unit) is not RawUnit:
+            order_unit(unit, type_placement)
+    return sorted(units, key=_unit_key)
+
+
+def _unit_key(unit):
+    ranges = unit.ranges if type(unit) is RawUnit else unit_address_ranges(unit)
+    # units covering no code go last, in their original order
+    return (0, ranges[0][0]) if ranges else (1, 0)
+
+
+def order_unit(unit, type_placement='first-use'):
+    children = unit.get('children', [])
+    if not children:
+        return
+    top = {id(child): child for child in children}
+
+    variables = []
+    functions = []
+    rest = []
+    for child in children:
+        ranges = die_address_ranges(child) if child['tag'] == _SUBPROGRAM else []
+        if ranges:
+            functions.append((ranges[0][0], len(functions), child))
+        elif child['tag'] == _VARIABLE:
+            variables.append(child)
+        else:
+            rest.append(child)
+    functions.sort(key=lambda item: item[:2])
+    anchors = variables + [child for _, _, child in functions]
+
+    # which of the remaining top-level DIEs each anchor needs, in order of first reference
+    placed = {id(die) for die in anchors}
+    groups = []
+    for anchor in anchors:
+        group = []
+        stack = [anchor]
+        while stack:
+            die = stack.pop()
+            refs = [value for key, value in die.items() if type(key) is int and type(value) is dict]
+            # and the ones its expressions refer to
+            refs.extend(args[index] for key, value in die.items() if type(key) is int and type(value) is list
+                        for args, index in iter_die_operands(value))
+            for ref in reversed(refs):
+                # references to DIEs nested in another top-level DIE, e.g. a member, pull in nothing by themselves
+                if id(ref) in top and id(ref) not in placed:
+                    placed.add(id(ref))
+                    group.append(ref)
+                    stack.append(ref)
+            stack.extend(reversed(die.get('children', [])))
+        groups.append(group)
+
+    result = [die for die in rest if id(die) not in placed]
+    if type_placement == 'block':
+        for group in groups:
+            result.extend(group)
+        result.extend(anchors)
+    else:
+        for anchor, group in zip(anchors, groups):
+            result.extend(group)
+            result.append(anchor)
+    assert len(result) == len(children)
+    unit['children'] = result
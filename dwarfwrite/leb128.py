@@ -0,0 +1,42 @@
+# the variable-length integers used throughout DWARF. encoders return a bytearray, decoders take the position to start
+# at and return (value, position past it)
+
+def encode_uleb128(num):
+    if num < 0:
+        raise ValueError("%d can't be encoded as an unsigned LEB128" % num)
+    result = bytearray()
+    while True:
+        byte = num & 0x7f
+        num >>= 7
+        if num:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return result
+
+def encode_sleb128(num):
+    result = bytearray()
+    while True:
+        byte = num & 0x7f
+        num >>= 7
+        if (num == 0 and not byte & 0x40) or (num == -1 and byte & 0x40):
+            result.append(byte)
+            return result
+        result.append(byte | 0x80)
+
+def decode_uleb128(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+def decode_sleb128(data, pos):
+    result, end = decode_uleb128(data, pos)
+    if data[end - 1] & 0x40:
+        result -= 1 << (7 * (end - pos))
+    return result, end
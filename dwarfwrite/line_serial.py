@@ -2,15 +2,25 @@ import struct
 import typing
 import copy
 import os
+from collections import Counter
 
 from elftools.dwarf.lineprogram import LineState
 from elftools.dwarf import constants
 
-from . import serial
+from .leb128 import encode_sleb128, encode_uleb128
 
 SECTION_VERSION = 4
 
-def serialize_states(arch, states: typing.List[LineState]):
+def serialize_states(arch, states: typing.Iterable[LineState], compact=False):
+    """Encode LineStates, whose file is a path, into a line program. With compact, compact_states is applied first.
+    states is iterated over twice, so it may be a list or a serial.LineRows, but not an iterator.
+
+    The output only depends on the states: files are numbered by how many rows refer to them, busiest first (ties in
+    order of first use), so that the common DW_LNS_set_file operands are short and the busiest file needs none at the
+    start of a sequence.
+    """
+    rows = compact_states if compact else iter
+
     # step 0: assemble constants and mappings
     endness = '<' if arch.memory_endness == 'Iend_LE' else '>'
     data = bytearray()
@@ -21,14 +31,20 @@ def serialize_states(arch, states: typing.List[LineState]):
     line_range = 1
     opcode_base = 13
 
-    filepaths = set(state.file for state in states)
-    dirpaths = set(os.path.dirname(filename) for filename in filepaths)
-    dirpaths.discard('')
-    dirs = list(dirpaths)
-    dirs_map = {dirpath: i + 1 for i, dirpath in enumerate(dirs)}
-    dirs_map[''] = 0
+    counts = Counter()
+    for (filepath, end_sequence), count in Counter((state.file, state.end_sequence) for state in rows(states)).items():
+        counts[filepath] += 0 if end_sequence else count
+    filepaths = sorted(counts, key=lambda path: -counts[path])
+    dirs = []
+    dirs_map = {'': 0}
+    for filepath in filepaths:
+        dirpath = os.path.dirname(filepath)
+        if dirpath not in dirs_map:
+            dirs_map[dirpath] = len(dirs) + 1
+            dirs.append(dirpath)
     files = [(os.path.basename(filepath), dirs_map[os.path.dirname(filepath)], 0, 0) for filepath in filepaths]
     files_map = {filepath: i + 1 for i, filepath in enumerate(filepaths)}
+    initial_file = filepaths[0] if filepaths else 1
 
     # step 1: header
     data.extend(struct.pack(
@@ -51,39 +67,39 @@ def serialize_states(arch, states: typing.List[LineState]):
     for (filename, dir_idx, mtime, length) in files:
         data.extend(filename.encode())
         data.append(0)
-        data.extend(serial._Serializer.encode_leb128(dir_idx))
-        data.extend(serial._Serializer.encode_leb128(mtime))
-        data.extend(serial._Serializer.encode_leb128(length))
+        data.extend(encode_uleb128(dir_idx))
+        data.extend(encode_uleb128(mtime))
+        data.extend(encode_uleb128(length))
     data.append(0)
     struct.pack_into(endness + 'I', data, 6, len(data) - 10)
 
-    prev_state = LineState(default_is_stmt)
-    for target_state in states:
+    prev_state = _initial_state(default_is_stmt, initial_file)
+    sequence_start = True
+    for target_state in rows(states):
         # step 2: compute diff between states
         # TODO use special opcodes for compression
-        if prev_state.address != target_state.address:
-            if target_state.address < prev_state.address:
-                data.append(0)
-                subdata = bytearray()
-                subdata.extend(serial._Serializer.encode_leb128(constants.DW_LNE_set_address))
-                subdata.extend(serial._Serializer.encode_leb128(target_state.address))
-                data.extend(serial._Serializer.encode_leb128(len(subdata)))
-                data.extend(subdata)
-            else:
-                data.append(constants.DW_LNS_advance_pc)
-                data.extend(serial._Serializer.encode_leb128(target_state.address - prev_state.address))
+        if sequence_start or target_state.address < prev_state.address:
+            data.append(0)
+            data.extend(encode_uleb128(1 + arch.bits // 8))
+            data.append(constants.DW_LNE_set_address)
+            data.extend(struct.pack(endness + ('Q' if arch.bits == 64 else 'I'), target_state.address))
             prev_state.address = target_state.address
+        elif prev_state.address != target_state.address:
+            data.append(constants.DW_LNS_advance_pc)
+            data.extend(encode_uleb128(target_state.address - prev_state.address))
+            prev_state.address = target_state.address
+        sequence_start = False
         if prev_state.file != target_state.file:
             data.append(constants.DW_LNS_set_file)
-            data.extend(serial._Serializer.encode_leb128(files_map[target_state.file]))
+            data.extend(encode_uleb128(files_map[target_state.file]))
             prev_state.file = target_state.file
         if prev_state.line != target_state.line:
             data.append(constants.DW_LNS_advance_line)
-            data.extend(serial._Serializer.encode_leb128(target_state.line - prev_state.line))
+            data.extend(encode_sleb128(target_state.line - prev_state.line))
             prev_state.line = target_state.line
         if prev_state.column != target_state.column:
             data.append(constants.DW_LNS_set_column)
-            data.extend(serial._Serializer.encode_leb128(target_state.column))
+            data.extend(encode_uleb128(target_state.column))
             prev_state.column = target_state.column
         if prev_state.is_stmt != target_state.is_stmt:
             data.append(constants.DW_LNS_negate_stmt)
@@ -103,23 +119,24 @@ def serialize_states(arch, states: typing.List[LineState]):
             assert prev_state.epilogue_begin == target_state.epilogue_begin
         if prev_state.isa != target_state.isa:
             data.append(constants.DW_LNS_set_isa)
-            data.extend(serial._Serializer.encode_leb128(target_state.isa))
+            data.extend(encode_uleb128(target_state.isa))
             prev_state.isa = target_state.isa
         if prev_state.discriminator != target_state.discriminator:
             data.append(0)
             subdata = bytearray()
             subdata.append(constants.DW_LNE_set_discriminator)
-            subdata.extend(serial._Serializer.encode_leb128(target_state.discriminator))
-            data.extend(serial._Serializer.encode_leb128(len(subdata)))
+            subdata.extend(encode_uleb128(target_state.discriminator))
+            data.extend(encode_uleb128(len(subdata)))
             data.extend(subdata)
             prev_state.discriminator = target_state.discriminator
 
         # step 3: now prev_state == target_state. emit and reset.
         if target_state.end_sequence:
             data.append(0)
-            data.extend(serial._Serializer.encode_leb128(1))
+            data.extend(encode_uleb128(1))
             data.append(constants.DW_LNE_end_sequence)
-            prev_state = LineState(default_is_stmt)
+            prev_state = _initial_state(default_is_stmt, initial_file)
+            sequence_start = True
         else:
             data.append(constants.DW_LNS_copy)
             prev_state.discriminator = 0
@@ -130,3 +147,34 @@ def serialize_states(arch, states: typing.List[LineState]):
     # step n: fixup length field
     struct.pack_into(endness + 'I', data, 0, len(data) - 4)
     return data
+
+
+def _initial_state(default_is_stmt, initial_file):
+    # the registers at the start of a sequence, with file 1 spelled as its path
+    state = LineState(default_is_stmt)
+    state.file = initial_file
+    return state
+
+
+def compact_states(states: typing.Iterable[LineState]):
+    """Drop rows which add nothing to a line table: a row repeating the previous row's position (file, line,
+    column, statement flag, isa, discriminator) without setting any flag, and whole sequences which cover no
+    addresses. Yields the remaining states, holding back no more than one sequence.
+    """
+    sequence = []
+    for state in states:
+        if sequence and not state.end_sequence and not (state.basic_block or state.prologue_end or
+                                                        state.epilogue_begin) and \
+                _position(state) == _position(sequence[-1]):
+            continue
+        sequence.append(state)
+        if state.end_sequence:
+            if sequence[-1].address > sequence[0].address:
+                yield from sequence
+            sequence = []
+    yield from sequence
+
+
+def _position(state):
+    return state.file, state.line, state.column, state.is_stmt, state.isa, state.discriminator
+
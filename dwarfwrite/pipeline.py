@@ -0,0 +1,103 @@
+import queue
+import pickle
+import logging
+import threading
+import traceback
+import multiprocessing
+
+l = logging.getLogger(__name__)
+
+_ITEM = 0
+_DONE = 1
+_ERROR = 2
+
+
+def prefetch(iterable, depth=2):
+    """Iterate over iterable on a background thread, keeping up to depth items ready ahead of the consumer.
+
+    Exceptions raised by the iterable are re-raised in the consumer. If the consumer stops early, the thread stops
+    at its next item.
+    """
+    channel = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                channel.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((_ITEM, item)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_ERROR, e))
+
+    thread = threading.Thread(target=worker, name='dwarfwrite-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = channel.get()
+            if kind == _DONE:
+                break
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+def prefetch_process(func, args=(), depth=2):
+    """Run the generator function func(*args) in a child process, yielding its items as they arrive.
+
+    Items are pickled across, so the references between unit dicts survive as long as each unit is one item. At most
+    depth items are in flight. Exceptions are re-raised in the parent, and the child is terminated if the consumer
+    stops early.
+    """
+    channel = multiprocessing.Queue(depth)
+    process = multiprocessing.Process(target=_process_worker, args=(channel, func, args), name='dwarfwrite-prefetch',
+                                      daemon=True)
+    process.start()
+    done = False
+    try:
+        while True:
+            try:
+                kind, value = channel.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError("Pipeline process exited with code %s" % process.exitcode)
+                continue
+            if kind == _DONE:
+                done = True
+                break
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        if not done:
+            process.terminate()
+        process.join()
+        channel.close()
+
+
+def _process_worker(channel, func, args):
+    try:
+        for item in func(*args):
+            channel.put((_ITEM, item))
+        channel.put((_DONE, None))
+    except BaseException as e:
+        l.debug("Pipeline process failed", exc_info=True)
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(traceback.format_exc())
+        channel.put((_ERROR, e))
+    channel.close()
+    channel.join_thread()
@@ -1,48 +1,285 @@
 import os
+import bisect
+import elftools
+import struct
 import logging
 
 from elftools.dwarf.compileunit import CompileUnit
 from elftools.dwarf.die import DIE, AttributeValue
 from elftools.elf.elffile import ELFFile
-from elftools.dwarf.dwarf_expr import DWARFExprParser
-from elftools.dwarf import locationlists
-
-from cle.backends.elf import ELF
+from elftools.dwarf.dwarf_expr import DWARFExprParser, DW_OP_name2opcode
+from elftools.dwarf.lineprogram import LineState
+from elftools.dwarf import locationlists, enums, constants
+from elftools.dwarf.ranges import BaseAddressEntry
 
+from .arch import Arch
 from .structure import DWARFStructurer
-from .serial import Address, LocationEntry, serialize, RangeEntry
+from .expr_serial import ENTRY_VALUE_OPS
+from .serial import Address, LineRows, LocationEntry, serialize, RangeEntry, RawUnit, RawExpr, normalize_ranges, \
+    resolve_ranges
 from .elf import dump_elf
+from .canonical import canonicalize_types
+from .layout import order_by_address
+from .stats import SerializerStats, current_rss, peak_rss_kb, phase
+from .leb128 import decode_sleb128, decode_uleb128
+from .pipeline import prefetch, prefetch_process
 
 l = logging.getLogger(__name__)
 
 VOID = object()
 
+# attributes whose sec_offset values (or data4 values, before DWARF 4) point into another section
+SECTION_POINTER_ATTRS = {
+    enums.ENUM_DW_AT['DW_AT_stmt_list']: '.debug_line',
+    enums.ENUM_DW_AT['DW_AT_ranges']: '.debug_ranges',
+}
+for _name in ('DW_AT_location', 'DW_AT_frame_base', 'DW_AT_string_length', 'DW_AT_return_addr',
+              'DW_AT_data_member_location', 'DW_AT_segment', 'DW_AT_static_link', 'DW_AT_use_location',
+              'DW_AT_vtable_elem_location'):
+    SECTION_POINTER_ATTRS[enums.ENUM_DW_AT[_name]] = '.debug_loc'
+
+# the sections whose contents rewrite_dwarf replaces. Those it does not produce are left empty, since they index or
+# are indexed by the old .debug_info
+SERIALIZED_SECTIONS = ('.debug_info', '.debug_abbrev', '.debug_str', '.debug_line', '.debug_loc', '.debug_ranges',
+                       '.debug_aranges', '.debug_addr', '.debug_names', '.gdb_index', '.debug_pubnames',
+                       '.debug_pubtypes', '.debug_gnu_pubnames', '.debug_gnu_pubtypes')
+
+FIXED_FORM_SIZES = {enums.ENUM_DW_FORM[name]: size for name, size in (
+    ('DW_FORM_data1', 1), ('DW_FORM_ref1', 1), ('DW_FORM_flag', 1),
+    ('DW_FORM_data2', 2), ('DW_FORM_ref2', 2),
+    ('DW_FORM_data4', 4), ('DW_FORM_ref4', 4),
+    ('DW_FORM_data8', 8), ('DW_FORM_ref8', 8), ('DW_FORM_ref_sig8', 8),
+    ('DW_FORM_flag_present', 0),
+)}
+LEB_FORMS = {enums.ENUM_DW_FORM[name] for name in ('DW_FORM_sdata', 'DW_FORM_udata', 'DW_FORM_ref_udata')}
+BLOCK_FORMS = {enums.ENUM_DW_FORM[name]: size for name, size in (
+    ('DW_FORM_block1', 1), ('DW_FORM_block2', 2), ('DW_FORM_block4', 4),
+    ('DW_FORM_block', None), ('DW_FORM_exprloc', None),
+)}
+
+# expression ops whose operand is the offset of a base type DIE in the unit: opcode -> (index of the operand, the op to
+# emit, which for the DWARF 5 ones is the GNU extension they were standardized from)
+TYPE_OPERAND_OPS = {DW_OP_name2opcode[name]: (index, DW_OP_name2opcode[out], out) for name, index, out in (
+    ('DW_OP_const_type', 0, 'DW_OP_GNU_const_type'),
+    ('DW_OP_GNU_const_type', 0, 'DW_OP_GNU_const_type'),
+    ('DW_OP_regval_type', 1, 'DW_OP_GNU_regval_type'),
+    ('DW_OP_GNU_regval_type', 1, 'DW_OP_GNU_regval_type'),
+    ('DW_OP_deref_type', 1, 'DW_OP_GNU_deref_type'),
+    ('DW_OP_GNU_deref_type', 1, 'DW_OP_GNU_deref_type'),
+    ('DW_OP_convert', 0, 'DW_OP_GNU_convert'),
+    ('DW_OP_GNU_convert', 0, 'DW_OP_GNU_convert'),
+)}
+# ops whose first operand is the offset of a DIE other than a type, relative to the section or else to the unit:
+# variables and parameters, and for calls DWARF procedures. the callee is always in the same unit, so calls become
+# DW_OP_call4
+DIE_REFERENCE_OPS = {DW_OP_name2opcode[name]: (section_relative, DW_OP_name2opcode[out], out)
+                     for name, section_relative, out in (
+    ('DW_OP_implicit_pointer', True, 'DW_OP_GNU_implicit_pointer'),
+    ('DW_OP_GNU_implicit_pointer', True, 'DW_OP_GNU_implicit_pointer'),
+    ('DW_OP_GNU_parameter_ref', False, 'DW_OP_GNU_parameter_ref'),
+    ('DW_OP_call2', False, 'DW_OP_call4'),
+    ('DW_OP_call4', False, 'DW_OP_call4'),
+    ('DW_OP_call_ref', True, 'DW_OP_call4'),
+)}
+# any expression containing one of these bytes might refer to a DIE, so is decoded to find out
+DIE_OPERAND_BYTES = bytes(sorted(TYPE_OPERAND_OPS.keys() | DIE_REFERENCE_OPS.keys()))
+# what resolve_die_operands returns for an expression referring to a DIE which can't be restructured
+UNRESOLVED = object()
+
 class ReStructurer(DWARFStructurer):
-    def __init__(self, fp, **kwargs):
+    def __init__(self, fp, rewrite_units=None, decode_expressions=False, streaming=False, max_rss=None,
+                 select_addresses=None, select_names=None, **kwargs):
+        """
+        rewrite_units selects an incremental rewrite: units it does not match are copied verbatim from the input rather
+        than restructured. It may be a predicate on a CompileUnit or a collection of unit offsets and/or names.
+
+        By default expressions are passed through as RawExpr bytes; decode_expressions makes get_attribute return
+        parsed DWARFExprOp lists instead, for subclasses which want to modify them. Expressions referring to DIEs are
+        always decoded, with the offsets replaced by the restructured DIEs, and DWARF procedures they call are brought
+        along. Expressions referring to anything else, which isn't restructured or lies in another unit, are left out
+        with a warning.
+
+        streaming makes root_get_units lazy and drops pyelftools' parsed DIEs for each unit once it has been
+        structured, so that with iter_units() memory stays bounded by the largest unit rather than the whole program.
+        max_rss is a budget in bytes: MemoryError is raised if the process grows beyond it after any unit.
+
+        select_addresses (an iterable of (begin, end) pairs) and select_names (function and variable names) restrict
+        the output to the functions which overlap those addresses or carry one of those names, plus the types they
+        refer to. Units which can't contain a match, judged by .debug_aranges where present, are dropped without
+        their DIEs being parsed. Selected units are always restructured, never copied verbatim.
+
+        self.arch describes the input as a dwarfwrite.arch.Arch, read from its ELF header. It used to be an
+        archinfo.Arch; code which needs one can call self.arch.to_archinfo().
+        """
         super().__init__()
 
         self.elf = ELFFile(fp)
         self.dwarf = self.elf.get_dwarf_info()
         self.expr_parser = DWARFExprParser(self.dwarf.structs)
         self.loc_parser = self.dwarf.location_lists()
-        self.arch = ELF.extract_arch(self.elf)
+        self.arch = Arch.from_elf(self.elf)
+        self.rewrite_units = rewrite_units
+        self.decode_expressions = decode_expressions
+        self.section_cache = {}
+        self.streaming = streaming
+        self.max_rss = max_rss
+        self.select_ranges = None if select_addresses is None else normalize_ranges(select_addresses)
+        self.select_names = None if select_names is None else \
+            {name.encode() if type(name) is str else bytes(name) for name in select_names}
+        self.unit_index = None # cu offset -> address ranges, from .debug_aranges
+        self.file_names = {} # (directory, name) -> path, shared by the line tables of all units
+        self.missing_caches = set() # the pyelftools caches unit_done has found missing, and warned about
 
     @classmethod
-    def rewrite_dwarf(cls, in_path, out_path, **kwargs):
+    def rewrite_dwarf(cls, in_path, out_path, compression=None, compression_level=None, dwo_path=None,
+                      debug_names=False, gdb_index=False, cache=None, stats=None, sibling='always',
+                      merge_types=False, streaming=False, max_rss=None, pipeline=None, pipeline_depth=2,
+                      address_order=False, type_placement='first-use', compact_lines=False, **kwargs):
+        """Restructure and serialize the DWARF of in_path, writing the result to out_path.
+
+        With streaming, each unit is structured, serialized and released before the next is read, bounding memory by
+        the largest unit. Structuring time is then counted in the serialize phase of stats. See __init__ for max_rss.
+
+        pipeline may be 'thread' or 'process' to structure units concurrently with serializing them, keeping at most
+        pipeline_depth structured units queued in between. It implies streaming. With 'process' the structurer runs
+        in a child process (so cls must be importable there) and max_rss applies to that process. Its structure,
+        canonicalize and layout phases are added to stats, and the peak RSS reported is the larger of the two
+        processes'.
+
+        address_order lays .debug_info out in address order, see layout.order_by_address for type_placement. When
+        streaming, units keep their order and only their contents are reordered.
+
+        compact_lines drops line table rows which add nothing, see line_serial.compact_states.
+        """
+        if pipeline not in (None, 'thread', 'process'):
+            raise ValueError("pipeline must be None, 'thread' or 'process'")
+        serialize_options = dict(dwo_name=dwo_path, debug_names=debug_names, gdb_index=gdb_index, cache=cache,
+                                 stats=stats, sibling=sibling, compact_lines=compact_lines)
+
+        if pipeline == 'process':
+            items = prefetch_process(cls._structure_units,
+                                     (in_path, merge_types, address_order and type_placement, stats is not None,
+                                      max_rss, kwargs), pipeline_depth)
+            try:
+                arch = next(items)
+                serial = serialize(cls._child_units(items, stats), arch, **serialize_options)
+            finally:
+                items.close()
+        else:
+            streaming = streaming or pipeline is not None
+            with open(in_path, 'rb') as fp:
+                # when streaming, structuring is interleaved with everything else and not timed on its own
+                with phase(None if streaming else stats, 'structure'):
+                    structurer = cls(fp, streaming=streaming, max_rss=max_rss, **kwargs)
+                    arch = structurer.arch
+                    if streaming:
+                        structure = structurer.iter_units()
+                    else:
+                        structure = structurer.run()
+
+                if merge_types:
+                    structure = cls._merge_types(structure, stats)
+                    if not streaming:
+                        structure = list(structure)
+
+                if address_order:
+                    structure = cls._order_units(structure, type_placement, stats, streaming)
+
+                if pipeline == 'thread':
+                    structure = prefetch(structure, pipeline_depth)
+                try:
+                    serial = serialize(structure, arch, **serialize_options)
+                finally:
+                    if pipeline == 'thread':
+                        structure.close()
+
+        # serialize leaves out empty sections, but the input's versions of them must not survive
         with open(in_path, 'rb') as fp:
-            structurer = cls(fp, **kwargs)
-            structure = structurer.run()
+            present = {section.name for section in ELFFile(fp).iter_sections()}
+        for name in SERIALIZED_SECTIONS:
+            if name in present:
+                serial.setdefault(name, b'')
+
+        if stats is not None:
+            # with a pipeline process, the larger of its peak and this process's
+            stats.peak_rss_kb = max((peak for peak in (stats.peak_rss_kb, peak_rss_kb()) if peak is not None),
+                                    default=None)
+        with phase(stats, 'write'):
+            dump_elf(serial, arch, out_path, in_path,
+                     compression=compression, compression_level=compression_level, dwo_file=dwo_path)
+
+    @staticmethod
+    def _merge_types(units, stats):
+        for unit in units:
+            with phase(stats, 'canonicalize'):
+                eliminated = canonicalize_types([unit])
+            l.debug("Merged duplicate types, eliminating %d DIEs", sum(eliminated.values()))
+            if stats is not None:
+                stats.eliminated_dies.update(eliminated)
+            yield unit
+
+    @staticmethod
+    def _order_units(units, type_placement, stats, streaming):
+        if not streaming:
+            with phase(stats, 'layout'):
+                return order_by_address(units, type_placement)
+        return ReStructurer._order_each(units, type_placement, stats)
+
+    @staticmethod
+    def _order_each(units, type_placement, stats):
+        for unit in units:
+            with phase(stats, 'layout'):
+                order_by_address([unit], type_placement)
+            yield unit
 
-        serial = serialize(structure, structurer.arch)
-        dump_elf(serial, structurer.arch, out_path, in_path)
+    @classmethod
+    def _structure_units(cls, in_path, merge_types, type_placement, collect_stats, max_rss, kwargs):
+        # runs in the pipeline process: yields the arch, then each unit, then the stats gathered there
+        stats = SerializerStats() if collect_stats else None
+        with open(in_path, 'rb') as fp:
+            with phase(stats, 'structure'):
+                structurer = cls(fp, streaming=True, max_rss=max_rss, **kwargs)
+            yield structurer.arch
+            units = cls._time_units(structurer.iter_units(), stats, 'structure')
+            if merge_types:
+                units = cls._merge_types(units, stats)
+            if type_placement:
+                units = cls._order_each(units, type_placement, stats)
+            yield from units
+        if stats is not None:
+            stats.peak_rss_kb = peak_rss_kb()
+            yield stats
+
+    @staticmethod
+    def _time_units(units, stats, name):
+        # counts the time spent producing each unit as phase name
+        units = iter(units)
+        while True:
+            with phase(stats, name):
+                unit = next(units, None)
+            if unit is None:
+                return
+            yield unit
+
+    @staticmethod
+    def _child_units(items, stats):
+        for item in items:
+            if type(item) is SerializerStats:
+                stats.eliminated_dies.update(item.eliminated_dies)
+                stats.phases.update(item.phases)
+                stats.peak_rss_kb = item.peak_rss_kb
+            else:
+                yield item
 
     def get_attribute(self, die: DIE, name):
         attr = die.attributes.get(name, None)
         if attr is None:
             return None
         result = attr.value
-        if attr.form == 'DW_FORM_exprloc':
-            result = self.expr_parser.parse_expr(result)
+        if attr.form == 'DW_FORM_exprloc' or \
+                (attr.form in ('DW_FORM_block1', 'DW_FORM_block2', 'DW_FORM_block4', 'DW_FORM_block') and
+                 name in ('DW_AT_location', 'DW_AT_frame_base')):
+            result = self.make_expr(result, die.cu)
         elif name == 'DW_AT_location' and attr.form == 'DW_FORM_sec_offset':
             base_addr = 0
             low_pc = die.cu.get_top_DIE().attributes.get('DW_AT_low_pc', None)
@@ -52,14 +289,15 @@ class ReStructurer(DWARFStructurer):
             result = []
             for item in loc_list:
                 if type(item) is locationlists.LocationEntry:
-                    result.append(LocationEntry(
-                        base_addr + item.begin_offset,
-                        base_addr + item.end_offset,
-                        self.expr_parser.parse_expr(item.loc_expr)))
+                    location = self.make_expr(item.loc_expr, die.cu)
+                    if location is not None:
+                        result.append(LocationEntry(base_addr + item.begin_offset, base_addr + item.end_offset,
+                                                    location))
                 elif type(item) is locationlists.BaseAddressEntry:
                     base_addr = item.base_address
                 else:
                     raise TypeError("What kind of loclist entry is this?")
+            result = result or None
         elif attr.form == 'DW_FORM_addr':
             result = Address(result)
         elif name == 'DW_AT_type':
@@ -72,20 +310,91 @@ class ReStructurer(DWARFStructurer):
             if child.tag == tag:
                 yield child
 
-    def get_expression_attribute(self, die, tag):
-        expr_list = self.get_attribute(die, tag)
-        if expr_list is None:
+    def make_expr(self, expr, cu):
+        # returns None for an expression which can't be carried over
+        data = bytes(expr)
+        if not self.decode_expressions and len(data.translate(None, DIE_OPERAND_BYTES)) == len(data):
+            return RawExpr(data)
+        parsed = self.expr_parser.parse_expr(data)
+        resolved = self.resolve_die_operands(parsed, cu)
+        if resolved is UNRESOLVED:
             return None
-        return self.expr_parser.parse_expr(expr_list)
+        if resolved is not None:
+            return resolved
+        return parsed if self.decode_expressions else RawExpr(data)
+
+    def resolve_die_operands(self, expr, cu):
+        # DIE offsets in expressions are relative to the input, so they can't be copied through. returns the
+        # expression referring to the restructured DIEs instead, None if it refers to none, or UNRESOLVED
+        result = []
+        changed = False
+        for op in expr:
+            if op.op in TYPE_OPERAND_OPS:
+                index, opcode, name = TYPE_OPERAND_OPS[op.op]
+                args = list(op.args)
+                # a conversion to type 0 is to the generic type
+                if args[index] != 0:
+                    args[index] = self.process_type(cu.get_DIE_from_refaddr(cu.cu_offset + args[index]))
+                op = op._replace(op=opcode, op_name=name, args=args)
+                changed = True
+            elif op.op in ENTRY_VALUE_OPS:
+                nested = self.resolve_die_operands(op.args[0], cu)
+                if nested is UNRESOLVED:
+                    return UNRESOLVED
+                if nested is not None:
+                    op = op._replace(args=[nested])
+                    changed = True
+            elif op.op in DIE_REFERENCE_OPS:
+                section_relative, opcode, name = DIE_REFERENCE_OPS[op.op]
+                offset = op.args[0] if section_relative else cu.cu_offset + op.args[0]
+                if not cu.cu_offset <= offset < cu.cu_offset + cu.size:
+                    l.warning("Leaving out an expression of unit at %#x, in which %s refers to another unit",
+                              cu.cu_offset, op.op_name)
+                    return UNRESOLVED
+                target = cu.get_DIE_from_refaddr(offset)
+                if target.tag == 'DW_TAG_dwarf_procedure':
+                    reference = self.process_dwarf_procedure(target)
+                else:
+                    reference = self.process_die_reference(target)
+                op = op._replace(op=opcode, op_name=name, args=[reference] + op.args[1:])
+                changed = True
+            result.append(op)
+        return result if changed else None
+
+    def process_dwarf_procedure(self, die: DIE):
+        # procedures are only there to be called from expressions, so are structured on their first call
+        result = self.process_die_reference(die)
+        if 'tag' not in result:
+            # tagged first, so that a procedure calling itself finds itself
+            result['tag'] = enums.ENUM_DW_TAG['DW_TAG_dwarf_procedure']
+            result[enums.ENUM_DW_AT['DW_AT_location']] = self.get_attribute(die, 'DW_AT_location')
+            self.current_unit['children'].insert(0, result)
+        return result
+
+    def get_expression_attribute(self, die, tag):
+        # always returns a parsed expression, regardless of decode_expressions
+        expr = self.get_attribute(die, tag)
+        if type(expr) is RawExpr:
+            return self.expr_parser.parse_expr(expr)
+        return expr
 
     def get_ranges(self, die):
+        # returns absolute ranges. range list entries are relative to the unit's base address unless it is overridden
         ranges = die.attributes.get('DW_AT_ranges', None)
         if ranges is not None:
-            return self.dwarf.range_lists().get_range_list_at_offset(ranges.value)
+            low_pc = die.cu.get_top_DIE().attributes.get('DW_AT_low_pc', None)
+            base = 0 if low_pc is None else low_pc.value
+            result = []
+            for item in self.dwarf.range_lists().get_range_list_at_offset(ranges.value):
+                if type(item) is BaseAddressEntry:
+                    base = item.base_address
+                else:
+                    offset = 0 if item.is_absolute else base
+                    result.append(RangeEntry(None, None, offset + item.begin_offset, offset + item.end_offset, True))
+            return result
         low_pc = die.attributes.get('DW_AT_low_pc', None)
         high_pc = die.attributes.get('DW_AT_high_pc', None)
         if low_pc is not None and high_pc is not None:
-            # TODO base addresses???
             fixed_high_pc = high_pc.value if high_pc.form == 'DW_FORM_addr' else low_pc.value + high_pc.value
             return [RangeEntry(None, None, low_pc.value, fixed_high_pc, False)]
         if low_pc is not None or high_pc is not None:
@@ -100,7 +409,220 @@ class ReStructurer(DWARFStructurer):
         return die.cu.get_DIE_from_refaddr(die.cu.cu_offset + r)
 
     def root_get_units(self):
-        return list(self.dwarf.iter_CUs())
+        units = self.dwarf.iter_CUs()
+        if self.filtering:
+            units = self.filter_units(units)
+        if self.streaming:
+            return units
+        return list(units)
+
+    @property
+    def filtering(self):
+        return self.select_ranges is not None or self.select_names is not None
+
+    def filter_units(self, units):
+        for handler in units:
+            if self.unit_selected(handler):
+                yield handler
+            else:
+                l.debug("Skipping unit at %#x, which contains nothing selected", handler.cu_offset)
+                self.unit_done(handler)
+
+    def unit_selected(self, handler: CompileUnit):
+        if self.select_ranges is not None:
+            ranges = self.unit_address_ranges(handler)
+            if ranges and _intersects(self.select_ranges, ranges):
+                return True
+            if ranges and self.select_names is None:
+                return False
+        # no names to look for, or no idea where the unit lies: look at what it holds
+        return any(self.die_selected(die) for die in handler.get_top_DIE().iter_children()
+                   if die.tag in ('DW_TAG_subprogram', 'DW_TAG_variable'))
+
+    def unit_address_ranges(self, handler: CompileUnit):
+        if self.unit_index is None:
+            self.unit_index = {}
+            aranges = self.dwarf.get_aranges()
+            if aranges is not None:
+                for entry in aranges.entries:
+                    self.unit_index.setdefault(entry.info_offset, []).append(
+                        (entry.begin_addr, entry.begin_addr + entry.length))
+                for offset, ranges in self.unit_index.items():
+                    self.unit_index[offset] = normalize_ranges(ranges)
+        ranges = self.unit_index.get(handler.cu_offset, None)
+        if ranges is None:
+            ranges = normalize_ranges(resolve_ranges(self.get_ranges(handler.get_top_DIE())))
+        return ranges
+
+    def die_selected(self, die: DIE):
+        if self.select_names is not None:
+            for name in ('DW_AT_name', 'DW_AT_linkage_name', 'DW_AT_MIPS_linkage_name'):
+                attr = die.attributes.get(name, None)
+                if attr is not None and attr.value in self.select_names:
+                    return True
+        if self.select_ranges is not None and die.tag == 'DW_TAG_subprogram':
+            return _intersects(self.select_ranges, normalize_ranges(resolve_ranges(self.get_ranges(die))))
+        return False
+
+    def unit_done(self, handler: CompileUnit):
+        if self.streaming:
+            # pyelftools keeps every CU it has parsed, each CU all of its DIEs, and every line program
+            stmt_list = handler.get_top_DIE().attributes.get('DW_AT_stmt_list', None)
+            line_programs = self.pyelftools_cache(self.dwarf, '_linetable_cache')
+            if stmt_list is not None and line_programs is not None:
+                line_programs.pop(stmt_list.value, None)
+            for name in ('_dielist', '_diemap'):
+                if self.pyelftools_cache(handler, name) is not None:
+                    setattr(handler, name, [])
+            offsets = self.pyelftools_cache(self.dwarf, '_cu_offsets_map')
+            units = self.pyelftools_cache(self.dwarf, '_cu_cache')
+            if offsets is not None and units is not None:
+                i = bisect.bisect_left(offsets, handler.cu_offset)
+                if i < len(offsets) and offsets[i] == handler.cu_offset:
+                    del offsets[i]
+                    del units[i]
+        if self.max_rss is not None:
+            rss = current_rss()
+            l.debug("RSS after unit at 0x%x: %s", handler.cu_offset, rss)
+            if rss is not None and rss > self.max_rss:
+                raise MemoryError("RSS of %d bytes exceeds the budget of %d after unit at 0x%x" %
+                                  (rss, self.max_rss, handler.cu_offset))
+
+    def pyelftools_cache(self, obj, name):
+        # one of the private pyelftools caches unit_done empties. should a pyelftools version not have it, memory
+        # would quietly grow with each unit again, so that is warned about
+        cache = getattr(obj, name, None)
+        if cache is None and name not in self.missing_caches:
+            self.missing_caches.add(name)
+            l.warning("pyelftools %s has no %s.%s; streaming can't release it, so memory may grow with each unit",
+                      elftools.__version__, type(obj).__name__, name)
+        return cache
+
+    def should_rewrite(self, handler: CompileUnit):
+        if self.rewrite_units is None or self.filtering:
+            return True
+        if callable(self.rewrite_units):
+            return self.rewrite_units(handler)
+        if handler.cu_offset in self.rewrite_units:
+            return True
+        name = self.unit_get_filename(handler)
+        return name is not None and name.decode() in self.rewrite_units
+
+    def unit_get_raw(self, handler: CompileUnit):
+        if self.should_rewrite(handler):
+            return None
+        raw = self.copy_unit(handler)
+        if raw is None:
+            l.warning("Unit at %#x cannot be copied verbatim, restructuring it instead", handler.cu_offset)
+        return raw
+
+    def section_data(self, name):
+        data = self.section_cache.get(name, None)
+        if data is None:
+            section = {
+                '.debug_info': self.dwarf.debug_info_sec,
+                '.debug_abbrev': self.dwarf.debug_abbrev_sec,
+                '.debug_str': self.dwarf.debug_str_sec,
+                '.debug_line': self.dwarf.debug_line_sec,
+                '.debug_loc': self.dwarf.debug_loc_sec,
+                '.debug_ranges': self.dwarf.debug_ranges_sec,
+            }[name]
+            data = b''
+            if section is not None:
+                section.stream.seek(0)
+                data = section.stream.read()
+            self.section_cache[name] = data
+        return data
+
+    def copy_unit(self, handler: CompileUnit):
+        # returns a RawUnit for handler, or None if it uses something that can't be relocated
+        if handler.dwarf_format() != 32 or not 2 <= handler['version'] <= 4:
+            return None
+        info = self.section_data('.debug_info')
+        start = handler.cu_offset
+        end = start + handler['unit_length'] + 4
+        addr_size = handler['address_size']
+        endness = '<' if self.dwarf.config.little_endian else '>'
+        abbrevs, abbrev_end = _parse_abbrevs(self.section_data('.debug_abbrev'), handler['debug_abbrev_offset'])
+
+        fixups = []
+        pos = start + 11
+        while pos < end:
+            code, pos = decode_uleb128(info, pos)
+            if code == 0:
+                continue
+            views = None
+            location = None
+            for attr, form in abbrevs[code]:
+                while form == enums.ENUM_DW_FORM['DW_FORM_indirect']:
+                    form, pos = decode_uleb128(info, pos)
+                if form == enums.ENUM_DW_FORM['DW_FORM_strp']:
+                    str_offset = struct.unpack_from(endness + 'I', info, pos)[0]
+                    strings = self.section_data('.debug_str')
+                    fixups.append((pos - start, '.debug_str', strings[str_offset:strings.index(b'\0', str_offset)]))
+                    pos += 4
+                elif form == enums.ENUM_DW_FORM['DW_FORM_sec_offset'] or \
+                        (form == enums.ENUM_DW_FORM['DW_FORM_data4'] and handler['version'] < 4 and
+                         attr in SECTION_POINTER_ATTRS):
+                    offset = struct.unpack_from(endness + 'I', info, pos)[0]
+                    section = SECTION_POINTER_ATTRS.get(attr, None)
+                    if attr == enums.ENUM_DW_AT['DW_AT_GNU_locviews']:
+                        views = (pos - start, offset)
+                    elif section is None:
+                        return None
+                    else:
+                        fixup = (pos - start, section, self.section_slice(section, offset, addr_size, endness))
+                        if attr == enums.ENUM_DW_AT['DW_AT_location']:
+                            location = (fixup, offset)
+                        else:
+                            fixups.append(fixup)
+                    pos += 4
+                elif form == enums.ENUM_DW_FORM['DW_FORM_addr']:
+                    pos += addr_size
+                elif form in FIXED_FORM_SIZES:
+                    pos += FIXED_FORM_SIZES[form]
+                elif form in LEB_FORMS:
+                    _, pos = decode_uleb128(info, pos)
+                elif form == enums.ENUM_DW_FORM['DW_FORM_string']:
+                    pos = info.index(b'\0', pos) + 1
+                elif form in BLOCK_FORMS:
+                    size = BLOCK_FORMS[form]
+                    if size is None:
+                        length, pos = decode_uleb128(info, pos)
+                    else:
+                        length = int.from_bytes(info[pos:pos + size], 'little' if endness == '<' else 'big')
+                        pos += size
+                    pos += length
+                else:
+                    # notably DW_FORM_ref_addr, which would need to know where every other unit ends up
+                    return None
+            if views is not None:
+                # gcc's location view list sits right before the location list, and must stay there
+                if location is None or location[1] < views[1]:
+                    return None
+                fixups.append((views[0], '.debug_loc', self.section_data('.debug_loc')[views[1]:location[1]]))
+            if location is not None:
+                fixups.append(location[0])
+
+        ranges = resolve_ranges(self.get_ranges(handler.get_top_DIE()))
+        return RawUnit(info[start:end], self.section_data('.debug_abbrev')[handler['debug_abbrev_offset']:abbrev_end],
+                       fixups, normalize_ranges(ranges))
+
+    def section_slice(self, section, offset, addr_size, endness):
+        # the bytes of the line program, location list or range list at offset
+        data = self.section_data(section)
+        if section == '.debug_line':
+            return data[offset:offset + 4 + struct.unpack_from(endness + 'I', data, offset)[0]]
+        fmt = endness + ('Q' if addr_size == 8 else 'I')
+        max_addr = (1 << (8 * addr_size)) - 1
+        pos = offset
+        while True:
+            begin, end = struct.unpack_from(fmt + fmt[-1], data, pos)
+            pos += 2 * addr_size
+            if begin == 0 and end == 0:
+                return data[offset:pos]
+            if section == '.debug_loc' and begin != max_addr:
+                pos += 2 + struct.unpack_from(endness + 'H', data, pos)[0]
 
     def unit_get_filename(self, handler: CompileUnit):
         return self.get_attribute(handler.get_top_DIE(), 'DW_AT_name')
@@ -109,10 +631,25 @@ class ReStructurer(DWARFStructurer):
         return self.get_attribute(handler.get_top_DIE(), 'DW_AT_language')
 
     def unit_get_variables(self, handler: CompileUnit):
-        return self.filter_children(handler.get_top_DIE(), 'DW_TAG_variable')
+        variables = self.filter_children(handler.get_top_DIE(), 'DW_TAG_variable')
+        if not self.filtering:
+            return variables
+        return [var for var in variables if self.die_selected(var)]
 
     def unit_get_functions(self, handler: CompileUnit):
-        return self.filter_children(handler.get_top_DIE(), 'DW_TAG_subprogram')
+        functions = self.filter_children(handler.get_top_DIE(), 'DW_TAG_subprogram')
+        if not self.filtering:
+            return functions
+        # the abstract instances of selected inlined functions have to come along
+        functions = list(functions)
+        keep = set()
+        for func in functions:
+            if self.die_selected(func):
+                keep.add(func.offset)
+                origin = self.get_abstract_origin(func)
+                if origin is not None:
+                    keep.add(origin.offset)
+        return [func for func in functions if func.offset in keep]
 
     def unit_get_ranges(self, handler):
         return self.get_ranges(handler.get_top_DIE())
@@ -125,28 +662,28 @@ class ReStructurer(DWARFStructurer):
         if lineprog is None:
             return None
 
-        entries = lineprog.get_entries()
-        states = [entry.state for entry in entries if entry.state is not None]
-        if not states:
+        # only the encoded program is kept, and decoded by the serializer as it goes
+        lineprog.stream.seek(lineprog.program_start_offset)
+        program = lineprog.stream.read(lineprog.program_end_offset - lineprog.program_start_offset)
+        if not program:
             return None
 
-        file_cache = {}
-        for state in states:
-            if state.file in file_cache:
-                filename = file_cache[state.file]
-            else:
-                file_entry = lineprog.header['file_entry'][state.file - 1]
-                if file_entry["dir_index"] == 0:
-                    filename = file_entry.name.decode()
-                else:
-                    filename = os.path.join(
-                        lineprog.header["include_directory"][file_entry["dir_index"] - 1].decode(),
-                        file_entry.name.decode())
-                file_cache[state.file] = filename
-
-            state.file = filename
-
-        return states
+        # before DWARF 5, file and directory numbers start at 1 and directory 0 means none
+        dirs = list(lineprog.header['include_directory'])
+        files = list(lineprog.header['file_entry'])
+        if lineprog.header['version'] < 5:
+            dirs.insert(0, None)
+            files.insert(0, None)
+        files = [None if entry is None else self.file_name(dirs[entry.dir_index], entry.name) for entry in files]
+        return LineProgramRows(program, lineprog.header, files, dirs, lineprog.structs.little_endian)
+
+    def file_name(self, directory, name):
+        # interned, since units mostly share their headers' paths
+        key = (directory, name)
+        result = self.file_names.get(key, None)
+        if result is None:
+            result = self.file_names[key] = _file_name(directory, name)
+        return result
 
     def unit_get_producer(self, handler: CompileUnit):
         result = self.get_attribute(handler.get_top_DIE(), 'DW_AT_producer')
@@ -384,3 +921,146 @@ class ReStructurer(DWARFStructurer):
 
     def type_is_void(self, handler):
         return handler is VOID
+
+
+def _parse_abbrevs(data, offset):
+    # returns ({code: [(attr, form)]}, offset just past the table)
+    result = {}
+    pos = offset
+    while True:
+        code, pos = decode_uleb128(data, pos)
+        if code == 0:
+            return result, pos
+        _, pos = decode_uleb128(data, pos)  # tag
+        pos += 1  # children flag
+        attrs = []
+        while True:
+            attr, pos = decode_uleb128(data, pos)
+            form, pos = decode_uleb128(data, pos)
+            if attr == 0 and form == 0:
+                break
+            attrs.append((attr, form))
+        result[code] = attrs
+
+def _intersects(a, b):
+    # whether two normalized range lists overlap anywhere
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i][0] < b[j][1] and b[j][0] < a[i][1]:
+            return True
+        if a[i][1] <= b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return False
+
+def _file_name(directory, name):
+    if directory is None:
+        return name.decode()
+    return os.path.join(directory.decode(), name.decode())
+
+class LineProgramRows(LineRows):
+    """The rows of a .debug_line program, kept encoded and decoded into LineStates each time they are iterated over,
+    the way pyelftools' LineProgram decodes them. files maps each value of the file register to its path, and dirs
+    each directory number to its path, for files added by DW_LNE_define_file.
+    """
+
+    def __init__(self, program, header, files, dirs, little_endian):
+        self.program = program
+        self.files = files
+        self.dirs = dirs
+        self.byteorder = 'little' if little_endian else 'big'
+        self.minimum_instruction_length = header['minimum_instruction_length']
+        self.maximum_operations_per_instruction = header.get('maximum_operations_per_instruction', None) or 1
+        self.default_is_stmt = header['default_is_stmt']
+        self.line_base = header['line_base']
+        self.line_range = header['line_range']
+        self.opcode_base = header['opcode_base']
+        self.standard_opcode_lengths = list(header['standard_opcode_lengths'])
+
+    def describe(self):
+        # the program and everything it is decoded with
+        return tuple(sorted(vars(self).items()))
+
+    def __iter__(self):
+        data = self.program
+        files = self.files
+        opcode_base = self.opcode_base
+        line_base = self.line_base
+        line_range = self.line_range
+        min_length = self.minimum_instruction_length
+        max_ops = self.maximum_operations_per_instruction
+        state = LineState(self.default_is_stmt)
+        pos = 0
+        while pos < len(data):
+            opcode = data[pos]
+            pos += 1
+            emit = False
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                advance = adjusted // line_range
+                state.address += min_length * ((state.op_index + advance) // max_ops)
+                state.op_index = (state.op_index + advance) % max_ops
+                state.line += line_base + adjusted % line_range
+                emit = True
+            elif opcode == 0:
+                length, pos = decode_uleb128(data, pos)
+                end = pos + length
+                ex_opcode = data[pos]
+                if ex_opcode == constants.DW_LNE_end_sequence:
+                    state.end_sequence = True
+                    state.is_stmt = 0
+                    emit = True
+                elif ex_opcode == constants.DW_LNE_set_address:
+                    state.address = int.from_bytes(data[pos + 1:end], self.byteorder)
+                elif ex_opcode == constants.DW_LNE_define_file:
+                    name_end = data.index(0, pos + 1)
+                    dir_index, _ = decode_uleb128(data, name_end + 1)
+                    files = files + [_file_name(self.dirs[dir_index], data[pos + 1:name_end])]
+                elif ex_opcode == constants.DW_LNE_set_discriminator:
+                    state.discriminator, _ = decode_uleb128(data, pos + 1)
+                pos = end
+            elif opcode == constants.DW_LNS_copy:
+                emit = True
+            elif opcode == constants.DW_LNS_advance_pc:
+                operand, pos = decode_uleb128(data, pos)
+                state.address += operand * min_length
+            elif opcode == constants.DW_LNS_advance_line:
+                operand, pos = decode_sleb128(data, pos)
+                state.line += operand
+            elif opcode == constants.DW_LNS_set_file:
+                state.file, pos = decode_uleb128(data, pos)
+            elif opcode == constants.DW_LNS_set_column:
+                state.column, pos = decode_uleb128(data, pos)
+            elif opcode == constants.DW_LNS_negate_stmt:
+                state.is_stmt = not state.is_stmt
+            elif opcode == constants.DW_LNS_set_basic_block:
+                state.basic_block = True
+            elif opcode == constants.DW_LNS_const_add_pc:
+                state.address += (255 - opcode_base) // line_range * min_length
+            elif opcode == constants.DW_LNS_fixed_advance_pc:
+                state.address += int.from_bytes(data[pos:pos + 2], self.byteorder)
+                pos += 2
+            elif opcode == constants.DW_LNS_set_prologue_end:
+                state.prologue_end = True
+            elif opcode == constants.DW_LNS_set_epilogue_begin:
+                state.epilogue_begin = True
+            elif opcode == constants.DW_LNS_set_isa:
+                state.isa, pos = decode_uleb128(data, pos)
+            else:
+                # unknown standard opcodes say how many LEB128 operands to skip
+                for _ in range(self.standard_opcode_lengths[opcode - 1]):
+                    _, pos = decode_uleb128(data, pos)
+
+            if emit:
+                row = LineState.__new__(LineState)
+                row.__dict__.update(state.__dict__)
+                row.file = files[state.file]
+                yield row
+                if state.end_sequence:
+                    state = LineState(self.default_is_stmt)
+                else:
+                    state.discriminator = 0
+                    state.basic_block = False
+                    state.prologue_end = False
+                    state.epilogue_begin = False
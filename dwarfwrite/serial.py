@@ -1,39 +1,181 @@
+import abc
 import struct
+import hashlib
 from collections import namedtuple
+from operator import itemgetter
 import pprint
 
-import archinfo
-
 from elftools.dwarf import enums, dwarf_expr, lineprogram
 from elftools.dwarf.ranges import RangeEntry, BaseAddressEntry
 
-from .expr_serial import DWARFExprSerializer
+from .arch import LE, as_arch
+from .expr_serial import DWARFExprSerializer, REF_ADDR, pack_die_operand
 from .line_serial import serialize_states
+from .index_serial import collect_names, serialize_debug_names, serialize_gdb_index
+from .stats import phase
+from .leb128 import encode_sleb128, encode_uleb128
 
 DWARF_VERSION = 4
-VALUE_PRESENT = object()
+
+class _ValuePresent:
+    # a singleton which stays one through pickling, e.g. into a pipeline process
+    def __reduce__(self):
+        return 'VALUE_PRESENT'
+
+    def __repr__(self):
+        return 'VALUE_PRESENT'
+
+VALUE_PRESENT = _ValuePresent()
 
 class Address(int):
     pass
 
-# distinct from the elftools LocationEntry - no entry_offset and the loc is a parsed expr
-LocationEntry = namedtuple("LocationEntry", ("begin_offset", "end_offset", "location"))
+class SectionOffset(int):
+    # a raw offset into some other debug section, written as DW_FORM_sec_offset
+    pass
 
+class Data8(int):
+    # an 8-byte constant, e.g. DW_AT_GNU_dwo_id
+    pass
+
+class RawExpr(bytes):
+    # an already-encoded DWARF expression, usable anywhere a list of DWARFExprOp is. it is written out unchanged.
+    pass
+
+class LineRows(abc.ABC):
+    # a line table kept in some compact form and decoded into LineStates afresh on each iteration, usable anywhere a
+    # list of LineStates is
+    @abc.abstractmethod
+    def __iter__(self):
+        pass
 
-def serialize(units, arch: archinfo.Arch):
-    s = _Serializer(arch)
+    def describe(self):
+        # a stable value which is equal for equal rows, for cache keys. subclasses may describe their compact form
+        # instead of decoding it
+        return tuple(tuple(sorted(vars(state).items())) for state in self)
+
+# distinct from the elftools LocationEntry - no entry_offset and the loc is a parsed expr
+LocationEntry = namedtuple("LocationEntry", ("begin_offset", "end_offset", "location"))
 
-    for unit in units:
-        s.write_unit(unit)
+# a unit copied verbatim from existing DWARF in place of a unit dict. info is the whole unit including its header and
+# abbrev its abbreviation table. fixups are (offset in info, section name, payload) - the payload is appended to the
+# section (or for .debug_str, interned into it) and the resulting section offset written over the 4 bytes at offset.
+# ranges are the normalized address ranges of the unit, for .debug_aranges.
+RawUnit = namedtuple("RawUnit", ("info", "abbrev", "fixups", "ranges"))
+
+
+def normalize_ranges(ranges):
+    """Sort a list of (begin, end) address pairs, dropping empty ones and merging adjacent or overlapping ones.
+    """
+    result = []
+    for begin, end in sorted(ranges):
+        if begin >= end:
+            continue
+        if result and begin <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((begin, end))
+    return result
+
+def resolve_ranges(ranges):
+    """Turn a list of RangeEntry and BaseAddressEntry into (begin, end) address pairs. A BaseAddressEntry sets the
+    base which following entries are relative to, starting from 0, unless they are marked is_absolute.
+    """
+    result = []
+    base = 0
+    for item in ranges:
+        if type(item) is RangeEntry:
+            offset = 0 if item.is_absolute else base
+            result.append((offset + item.begin_offset, offset + item.end_offset))
+        elif type(item) is BaseAddressEntry:
+            base = item.base_address
+    return result
+
+def unit_address_ranges(unit):
+    """Collect the address ranges covered by a unit dict, falling back to its subprograms if it has none itself.
+    """
+    ranges = die_address_ranges(unit)
+    if not ranges:
+        for child in unit.get('children', []):
+            if child['tag'] == enums.ENUM_DW_TAG['DW_TAG_subprogram']:
+                ranges.extend(die_address_ranges(child))
+    return normalize_ranges(ranges)
+
+def die_address_ranges(die):
+    low_pc = die.get(enums.ENUM_DW_AT['DW_AT_low_pc'], None)
+    high_pc = die.get(enums.ENUM_DW_AT['DW_AT_high_pc'], None)
+    if low_pc is not None and high_pc is not None:
+        return [(int(low_pc), int(high_pc) if type(high_pc) is Address else low_pc + high_pc)]
+    return resolve_ranges(die.get(enums.ENUM_DW_AT['DW_AT_ranges'], None) or [])
+
+
+def serialize(units, arch, dwo_name=None, debug_names=False, gdb_index=False, cache=None, stats=None,
+              sibling='always', compact_lines=False):
+    """Serialize a list of unit dicts into a dict mapping section name to contents. arch is an arch.Arch or an
+    archinfo.Arch. units may be any iterable; each unit is dropped once written, so a generator such as
+    DWARFStructurer.iter_units() keeps only one unit tree alive at a time.
+
+    If dwo_name is given, split DWARF is produced: the main sections hold only a skeleton unit (plus .debug_addr,
+    .debug_line and .debug_ranges) and the full DIE trees go into sections suffixed with .dwo, which belong in the file
+    named by dwo_name.
+
+    debug_names and gdb_index request the corresponding name index sections.
+
+    cache may be a cache.UnitCache, through which units that were serialized before are reused instead of encoded.
+
+    stats may be a stats.SerializerStats, which is filled in with counts, sizes and timings.
+
+    sibling controls which DIEs with children get a DW_AT_sibling, letting consumers skip over their subtrees: 'always',
+    'never', or an int to only give it to DIEs with at least that many descendants.
+
+    compact_lines drops line table rows which add nothing, see line_serial.compact_states.
+    """
+    arch = as_arch(arch)
+    if sibling not in ('always', 'never') and not (type(sibling) is int and sibling >= 0):
+        raise ValueError("sibling must be 'always', 'never' or a descendant count")
+    if dwo_name is not None and (debug_names or gdb_index):
+        raise ValueError("Name indexes are not supported for split DWARF")
+    if (dwo_name is not None or debug_names or gdb_index) and cache is not None:
+        raise ValueError("Raw or cached units cannot be combined with split DWARF or name indexes")
+    s = _Serializer(arch, dwo_name)
+    s.collect_names = debug_names or gdb_index
+    s.cache = cache
+    s.sibling = sibling
+    s.compact_lines = compact_lines
+    s.stats = stats
+    if stats is not None and cache is not None:
+        cache_hits, cache_misses = cache.hits, cache.misses
+
+    with phase(stats, 'serialize'):
+        for unit in units:
+            if type(unit) is RawUnit and (dwo_name is not None or debug_names or gdb_index):
+                raise ValueError("Raw or cached units cannot be combined with split DWARF or name indexes")
+            s.write_unit(unit)
+
+    if debug_names or gdb_index:
+        with phase(stats, 'index'):
+            if debug_names:
+                s.result['.debug_names'] = serialize_debug_names(arch, [offset for offset, _ in s.unit_list],
+                                                                 s.name_entries, s.lookup_string)
+            if gdb_index:
+                s.result['.gdb_index'] = serialize_gdb_index(s.unit_list, s.unit_ranges, s.name_entries)
+    if cache is not None:
+        cache.evict()
+        if stats is not None:
+            stats.cache_hits += cache.hits - cache_hits
+            stats.cache_misses += cache.misses - cache_misses
 
     for name, data in list(s.result.items()):
         if not data:
             s.result.pop(name)
+    if stats is not None:
+        stats.section_sizes.update((name, len(data)) for name, data in s.result.items())
 
     return s.result
 
 class _Serializer:
-    def __init__(self, arch):
+    def __init__(self, arch, dwo_name=None):
         self.result = {
             '.debug_info': bytearray(),
             '.debug_abbrev': bytearray(),
@@ -41,7 +183,22 @@ class _Serializer:
             '.debug_loc': bytearray(),
             '.debug_line': bytearray(),
             '.debug_ranges': bytearray(),
+            '.debug_aranges': bytearray(),
         }
+        self.dwo_name = dwo_name
+        if dwo_name is not None:
+            self.result.update({
+                '.debug_addr': bytearray(),
+                '.debug_info.dwo': bytearray(),
+                '.debug_abbrev.dwo': bytearray(),
+                '.debug_str.dwo': bytearray(),
+                '.debug_str_offsets.dwo': bytearray(),
+                '.debug_loc.dwo': bytearray(),
+            })
+        # which set of sections the unit currently being written goes to
+        self.in_dwo = False
+        self.info_section = '.debug_info'
+        self.abbrev_section = '.debug_abbrev'
         self.arch = arch
         self.expr_serializer = DWARFExprSerializer(arch)
 
@@ -53,45 +210,201 @@ class _Serializer:
 
         self.reference_cache = {} # id -> offset
         self.info_offset = 0
-        self.pending_references = {} # id -> (object, [offset to insert reference])
-
+        self.referenced = None # id -> object, of everything the unit being laid out refers to
+
+        self.dwo_string_cache = {}
+        self.abbrev_table_cache = {} # (section, abbrev table bytes) -> offset, to share identical tables
+        self.addr_cache = {} # address -> index into this unit's .debug_addr table
+        self.addr_base = 0
+        self.ranges_base = 0
+        self.dwo_id_offset = None
+
+        self.unit_list = [] # (.debug_info offset, length) of each unit
+        self.unit_ranges = [] # (unit index, normalized address ranges)
+        self.collect_names = False
+        self.name_entries = []
+
+        self.cache = None
+        self.sibling = 'always'
+        self.compact_lines = False
+        self.subtree_sizes = None # id -> number of descendants, for a threshold sibling policy
+        self.unit_fixups = None # while filling the cache, the RawUnit fixups of the current unit
+        self.abbrev_table = b''
+
+        self.stats = None
         self.current_unit = None
-
-    @property
-    def current_offset(self):
-        return len(self.result['.debug_info']) - self.info_offset
+        self.base_address = 0 # DW_AT_low_pc of the unit being written, which range and location lists are relative to
 
     def write_unit(self, unit):
-        self.current_unit = unit
-        self.info_offset = len(self.result['.debug_info'])
-        abbrev_offset = len(self.result['.debug_abbrev'])
-        endness = '<' if self.arch.memory_endness == archinfo.Endness.LE else '>'
+        if type(unit) is RawUnit:
+            self.write_raw_unit(unit)
+            return
+        if self.cache is not None:
+            self.write_cached_unit(unit)
+            return
+        if self.dwo_name is None:
+            self.write_cu(unit)
+            self.write_aranges(unit_address_ranges(unit))
+            if self.collect_names:
+                self.name_entries.extend(collect_names(unit, len(self.unit_list) - 1, self.reference_cache))
+            return
+
+        self.addr_base = len(self.result['.debug_addr'])
+        self.addr_cache = {}
+        self.ranges_base = len(self.result['.debug_ranges'])
+
+        # the full unit goes to the dwo, minus what the skeleton carries
+        skeleton_attrs = [enums.ENUM_DW_AT[x] for x in ('DW_AT_stmt_list', 'DW_AT_low_pc', 'DW_AT_high_pc',
+                                                        'DW_AT_ranges')]
+        dwo_unit = {k: v for k, v in unit.items() if k not in skeleton_attrs}
+        dwo_unit[enums.ENUM_DW_AT['DW_AT_GNU_dwo_id']] = Data8(0)
+        # the dwo's range lists are relative to the skeleton's base address
+        self.base_address = int(unit.get(enums.ENUM_DW_AT['DW_AT_low_pc'], None) or 0)
+        self.in_dwo = True
+        self.info_section = '.debug_info.dwo'
+        self.abbrev_section = '.debug_abbrev.dwo'
+        self.write_cu(dwo_unit)
+
+        # the dwo id is a hash of the unit contents, patched in once they are known
+        info = self.result['.debug_info.dwo']
+        dwo_id = int.from_bytes(hashlib.blake2b(info[self.info_offset:], digest_size=8).digest(), 'little')
+        struct.pack_into(self.arch.struct_fmt(8), info, self.dwo_id_offset, dwo_id)
+
+        skeleton = {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+            enums.ENUM_DW_AT['DW_AT_GNU_dwo_name']: self.dwo_name,
+            enums.ENUM_DW_AT['DW_AT_GNU_dwo_id']: Data8(dwo_id),
+            enums.ENUM_DW_AT['DW_AT_comp_dir']: unit.get(enums.ENUM_DW_AT['DW_AT_comp_dir'], None),
+            enums.ENUM_DW_AT['DW_AT_GNU_addr_base']: SectionOffset(self.addr_base),
+            enums.ENUM_DW_AT['DW_AT_GNU_ranges_base']: SectionOffset(self.ranges_base),
+        }
+        skeleton.update({k: unit[k] for k in skeleton_attrs if k in unit})
+        self.in_dwo = False
+        self.info_section = '.debug_info'
+        self.abbrev_section = '.debug_abbrev'
+        self.write_cu(skeleton)
+        self.write_aranges(unit_address_ranges(unit))
+
+    def write_cached_unit(self, unit):
+        key = self.cache.key(unit, self.arch, (self.sibling, self.compact_lines))
+        raw = self.cache.get(key)
+        if raw is not None:
+            self.write_raw_unit(raw)
+            return
+
+        self.unit_fixups = []
+        self.write_cu(unit)
+        ranges = unit_address_ranges(unit)
+        self.write_aranges(ranges)
+        if self.unit_fixups is None:
+            return
+        raw = RawUnit(bytes(self.result['.debug_info'][self.info_offset:]),
+                      self.abbrev_table, self.unit_fixups, ranges)
+        self.unit_fixups = None
+        self.cache.put(key, raw)
+
+    def write_raw_unit(self, unit):
+        info = bytearray(unit.info)
+
+        abbrev_offset = self.abbrev_table_cache.get(('.debug_abbrev', unit.abbrev), None)
+        if self.stats is not None:
+            self.stats.raw_units += 1
+            self.note_abbrev_table(unit.abbrev, abbrev_offset is None)
+        if abbrev_offset is None:
+            abbrev_offset = len(self.result['.debug_abbrev'])
+            self.abbrev_table_cache[('.debug_abbrev', unit.abbrev)] = abbrev_offset
+            self.result['.debug_abbrev'].extend(unit.abbrev)
+        struct.pack_into(self.arch.struct_fmt(4), info, 6, abbrev_offset)
+
+        for offset, section, payload in unit.fixups:
+            if section == '.debug_str':
+                value = self.lookup_string(payload)
+            else:
+                value = len(self.result[section])
+                self.result[section].extend(payload)
+            struct.pack_into(self.arch.struct_fmt(4), info, offset, value)
 
-        # allocate header
-        self.result['.debug_info'].extend(bytes(0xb))
+        self.info_offset = len(self.result['.debug_info'])
+        self.result['.debug_info'].extend(info)
+        self.unit_list.append((self.info_offset, len(info)))
+        self.write_aranges(unit.ranges)
 
+    def write_cu(self, unit):
+        self.current_unit = unit
+        if not self.in_dwo:
+            self.base_address = int(unit.get(enums.ENUM_DW_AT['DW_AT_low_pc'], None) or 0)
+        self.info_offset = len(self.result[self.info_section])
+        abbrev_offset = len(self.result[self.abbrev_section])
+        endness = '<' if self.arch.memory_endness == LE else '>'
+
+        # a layout pass settles the abbreviations and the size of every DIE, so that each one's offset is known before
+        # anything is written. the write pass then fills in a buffer of the unit's size, references and all
         self.abbrev_cache = {}
         self.abbrev_ctr = 1
         self.reference_cache = {}
-        self.pending_references = {}
-        self.write_die(unit, True)
-        self.result['.debug_abbrev'].append(0)
-
-        if len(self.pending_references) != 0:
-            raise Exception("Reference to object(s) which were not included in the DIE tree: \n" + '\n'.join(pprint.pformat(obj[0]) for obj in self.pending_references.values()))
-
-        # fill header
-        info_end = len(self.result['.debug_info'])
-        info_size = info_end - self.info_offset - 4
-        struct.pack_into(endness + 'IHIB', self.result['.debug_info'], self.info_offset, info_size, DWARF_VERSION, abbrev_offset, self.arch.bytes)
-
-    def write_die(self, unit, is_last_sibling):
-        # a unit is a dict with entries for attributes, an entry for children, and an entry for the tag
-        self.reference_cache[id(unit)] = self.current_offset
-        if id(unit) in self.pending_references:
-            targets = self.pending_references.pop(id(unit))[1]
-            for target in targets:
-                struct.pack_into(self.arch.struct_fmt(4), self.result['.debug_info'], target, self.current_offset)
+        self.referenced = {}
+        if type(self.sibling) is int:
+            self.subtree_sizes = self.count_descendants(unit)
+        entries = []
+        unit_size = self.layout_die(unit, True, entries, 0xb)
+        self.result[self.abbrev_section].append(0)
+
+        # share identical abbreviation tables between units
+        abbrevs = self.result[self.abbrev_section]
+        self.abbrev_table = bytes(abbrevs[abbrev_offset:])
+        existing = self.abbrev_table_cache.setdefault((self.abbrev_section, self.abbrev_table), abbrev_offset)
+        if self.stats is not None:
+            self.note_abbrev_table(self.abbrev_table, existing == abbrev_offset)
+        if existing != abbrev_offset:
+            del abbrevs[abbrev_offset:]
+            abbrev_offset = existing
+
+        missing = [obj for key, obj in self.referenced.items() if key not in self.reference_cache]
+        if len(missing) != 0:
+            raise Exception("Reference to object(s) which were not included in the DIE tree: \n" +
+                            '\n'.join(pprint.pformat(obj) for obj in missing))
+
+        info = self.result[self.info_section]
+        info.extend(bytes(unit_size))
+        with memoryview(info) as view:
+            struct.pack_into(endness + 'IHIB', view, self.info_offset, unit_size - 4, DWARF_VERSION, abbrev_offset,
+                             self.arch.bytes)
+            end = self.write_dies(view, self.info_offset + 0xb, entries)
+        assert end == len(info)
+        self.referenced = None
+        self.current_unit = None
+        if not self.in_dwo:
+            self.unit_list.append((self.info_offset, unit_size))
+
+    def note_abbrev_table(self, table, is_new):
+        self.stats.abbrev_tables += 1
+        if is_new:
+            self.stats.abbrev_bytes += len(table)
+        else:
+            self.stats.abbrev_tables_shared += 1
+
+    def write_aranges(self, ranges):
+        # one address range set for the unit most recently written to .debug_info
+        if not ranges:
+            return
+        self.unit_ranges.append((len(self.unit_list) - 1, ranges))
+
+        endness = '<' if self.arch.memory_endness == LE else '>'
+        data = bytearray(struct.pack(endness + 'IHIBB', 0, 2, self.info_offset, self.arch.bytes, 0))
+        data.extend(bytes(-len(data) % (2 * self.arch.bytes)))
+        for begin, end in ranges:
+            data.extend(struct.pack(self.arch.struct_fmt(), begin))
+            data.extend(struct.pack(self.arch.struct_fmt(), end - begin))
+        data.extend(bytes(2 * self.arch.bytes))
+        struct.pack_into(endness + 'I', data, 0, len(data) - 4)
+        self.result['.debug_aranges'].extend(data)
+
+    def layout_die(self, unit, is_last_sibling, entries, offset):
+        # a unit is a dict with entries for attributes, an entry for children, and an entry for the tag. appends
+        # [pieces, offset of the next sibling or None] for it to entries, followed by its children and a None for their
+        # null entry, and returns the offset past all of them. the pieces are encoded bytes, and (form, value) for
+        # attributes which can only be written once the offsets of DIEs or section contents are known
+        self.reference_cache[id(unit)] = offset
 
         tag = unit['tag']
         children = unit.get('children', [])
@@ -100,33 +413,91 @@ class _Serializer:
         attr_set = frozenset(attr_forms.items())
         assert len(attr_set) == len(attrs)
 
-        code, new = self.lookup_form(tag, bool(children), bool(children) and not is_last_sibling, attr_set)
-
-        self.result['.debug_info'].extend(self.encode_leb128(code))
+        has_sibling = bool(children) and not is_last_sibling and self.sibling != 'never' and \
+            (self.sibling == 'always' or self.subtree_sizes[id(unit)] >= self.sibling)
+        code, new = self.lookup_form(tag, bool(children), has_sibling, attr_set)
+        if self.stats is not None:
+            self.stats.dies_by_tag[tag] += 1
+            self.stats.attributes_by_form.update(attr_forms.values())
+            self.stats.abbreviations += new
 
+        chunk = encode_uleb128(code)
+        abbrevs = self.result[self.abbrev_section]
         if new:
-            self.result['.debug_abbrev'].extend(self.encode_leb128(code))
-            self.result['.debug_abbrev'].extend(self.encode_leb128(tag))
-            self.result['.debug_abbrev'].append(int(bool(children)))
+            abbrevs.extend(chunk)
+            abbrevs.extend(encode_uleb128(tag))
+            abbrevs.append(int(bool(children)))
 
+        pieces = [chunk]
         for x in attrs:
-            self.write_attribute(x, unit[x], attr_forms[x], new)
-
-        ref_offset = len(self.result['.debug_info'])
-        if children and not is_last_sibling:
-            self.write_attribute(enums.ENUM_DW_AT['DW_AT_sibling'], None, enums.ENUM_DW_FORM['DW_FORM_ref4'], new)
+            form = attr_forms[x]
+            if new:
+                abbrevs.extend(encode_uleb128(x))
+                abbrevs.extend(encode_uleb128(form))
+            size = len(chunk)
+            pending = self.layout_attribute(chunk, offset + size, x, unit[x], form)
+            if pending is not None:
+                offset += size + pending[1]
+                pieces.append((form, pending[0]))
+                chunk = bytearray()
+                pieces.append(chunk)
+        offset += len(chunk)
+
+        if has_sibling:
+            offset += 4
+            if new:
+                abbrevs.extend(encode_uleb128(enums.ENUM_DW_AT['DW_AT_sibling']))
+                abbrevs.extend(encode_uleb128(enums.ENUM_DW_FORM['DW_FORM_ref4']))
 
         # null attribute terminator
         if new:
-            self.result['.debug_abbrev'].extend(bytes(2))
+            abbrevs.extend(bytes(2))
 
+        entry = [pieces, None]
+        entries.append(entry)
         for i, child in enumerate(children):
-            self.write_die(child, i == len(children) - 1)
+            offset = self.layout_die(child, i == len(children) - 1, entries, offset)
         if children:
-            self.result['.debug_info'].append(0)
+            entries.append(None)
+            offset += 1
+
+        if has_sibling:
+            entry[1] = offset
+        return offset
 
-        if children and not is_last_sibling:
-            struct.pack_into(self.arch.struct_fmt(4), self.result['.debug_info'], ref_offset, self.current_offset)
+    def write_dies(self, view, pos, entries):
+        # writes the entries of layout_die from pos on, returning the position past them
+        ref_fmt = self.arch.struct_fmt(4)
+        for entry in entries:
+            if entry is None:
+                # the null entry ending a list of children. the buffer starts out zeroed
+                pos += 1
+                continue
+            pieces, sibling = entry
+            for piece in pieces:
+                if type(piece) is bytearray:
+                    view[pos:pos + len(piece)] = piece
+                    pos += len(piece)
+                else:
+                    pos = self.write_attribute(view, pos, *piece)
+            if sibling is not None:
+                struct.pack_into(ref_fmt, view, pos, sibling)
+                pos += 4
+        return pos
+
+    @staticmethod
+    def count_descendants(unit):
+        result = {}
+        stack = [(unit, False)]
+        while stack:
+            die, done = stack.pop()
+            children = die.get('children', [])
+            if done:
+                result[id(die)] = sum(result[id(child)] + 1 for child in children)
+            else:
+                stack.append((die, True))
+                stack.extend((child, False) for child in children)
+        return result
 
     def lookup_form(self, tag, has_children, has_sibling_attr, attrs: frozenset):
         # if this function returns True as the second parameter, you must write the abbreviation immediately
@@ -146,6 +517,9 @@ class _Serializer:
         assert b'\0' not in string
 
         offset = self.string_cache.get(string, None)
+        if self.stats is not None:
+            self.stats.string_lookups += 1
+            self.stats.string_hits += offset is not None
         if offset is None:
             offset = self.string_ctr
             self.string_cache[string] = offset
@@ -156,12 +530,40 @@ class _Serializer:
         return offset
 
 
+    def lookup_dwo_string(self, string):
+        assert b'\0' not in string
+
+        index = self.dwo_string_cache.get(string, None)
+        if index is None:
+            index = len(self.dwo_string_cache)
+            self.dwo_string_cache[string] = index
+            self.result['.debug_str_offsets.dwo'].extend(struct.pack(self.arch.struct_fmt(4), len(self.result['.debug_str.dwo'])))
+            self.result['.debug_str.dwo'].extend(string)
+            self.result['.debug_str.dwo'].append(0)
+
+        return index
+
+    def lookup_address(self, addr):
+        index = self.addr_cache.get(addr, None)
+        if index is None:
+            index = len(self.addr_cache)
+            self.addr_cache[addr] = index
+            self.result['.debug_addr'].extend(struct.pack(self.arch.struct_fmt(), addr))
+
+        return index
+
     def get_attribute_form(self, attr):
         if type(attr) is Address:
+            if self.in_dwo:
+                return enums.ENUM_DW_FORM['DW_FORM_GNU_addr_index']
             return enums.ENUM_DW_FORM['DW_FORM_addr']
+        if type(attr) is SectionOffset:
+            return enums.ENUM_DW_FORM['DW_FORM_sec_offset']
+        if type(attr) is Data8:
+            return enums.ENUM_DW_FORM['DW_FORM_data8']
         if type(attr) is list and attr and type(attr[0]) is LocationEntry:
             return enums.ENUM_DW_FORM['DW_FORM_sec_offset']
-        if type(attr) is list and attr and type(attr[0]) is lineprogram.LineState:
+        if type(attr) is list and attr and type(attr[0]) is lineprogram.LineState or isinstance(attr, LineRows):
             return enums.ENUM_DW_FORM['DW_FORM_sec_offset']
         if type(attr) is list and attr and type(attr[0]) in (RangeEntry, BaseAddressEntry):
             return enums.ENUM_DW_FORM['DW_FORM_sec_offset']
@@ -176,9 +578,13 @@ class _Serializer:
         if type(attr) is bool:
             return enums.ENUM_DW_FORM['DW_FORM_flag']
         if type(attr) in (str, bytes, bytearray):
+            if self.in_dwo:
+                return enums.ENUM_DW_FORM['DW_FORM_GNU_str_index']
             return enums.ENUM_DW_FORM['DW_FORM_strp']
         if type(attr) is list and len(attr) > 0 and type(attr[0]) is dwarf_expr.DWARFExprOp:
             return enums.ENUM_DW_FORM['DW_FORM_exprloc']
+        if type(attr) is RawExpr:
+            return enums.ENUM_DW_FORM['DW_FORM_exprloc']
         if type(attr) is dict and 'tag' in attr:
             return enums.ENUM_DW_FORM['DW_FORM_ref4']
         if attr is VALUE_PRESENT:
@@ -186,96 +592,177 @@ class _Serializer:
         # None is explicitly removed from the attribute dict above here
         raise TypeError("Can't handle attribute %s" % attr)
 
-    def write_attribute(self, name, attr, form, building_abbrev):
-        if building_abbrev:
-            self.result['.debug_abbrev'].extend(self.encode_leb128(name))
-            self.result['.debug_abbrev'].extend(self.encode_leb128(form))
-
+    def layout_attribute(self, out, offset, name, attr, form):
+        # encodes the attribute at unit offset into out. if that has to wait for the write pass, returns
+        # (what write_attribute needs, encoded size) instead
         if form == enums.ENUM_DW_FORM['DW_FORM_addr']:
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(), int(attr)))
-        if form == enums.ENUM_DW_FORM['DW_FORM_data1']:
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(1, True), attr))
-        if form == enums.ENUM_DW_FORM['DW_FORM_data2']:
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(2, True), attr))
-        if form == enums.ENUM_DW_FORM['DW_FORM_data4']:
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(4, True), attr))
-        if form == enums.ENUM_DW_FORM['DW_FORM_sdata']:
-            self.result['.debug_info'].extend(self.encode_leb128(attr))
-        if form == enums.ENUM_DW_FORM['DW_FORM_flag']:
-            self.result['.debug_info'].extend(bytes([int(attr)]))
-        if form == enums.ENUM_DW_FORM['DW_FORM_strp']:
+            out.extend(struct.pack(self.arch.struct_fmt(), int(attr)))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_GNU_addr_index']:
+            out.extend(encode_uleb128(self.lookup_address(int(attr))))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_data8']:
+            if name == enums.ENUM_DW_AT['DW_AT_GNU_dwo_id']:
+                self.dwo_id_offset = self.info_offset + offset
+            out.extend(struct.pack(self.arch.struct_fmt(8), attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_data1']:
+            out.extend(struct.pack(self.arch.struct_fmt(1, True), attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_data2']:
+            out.extend(struct.pack(self.arch.struct_fmt(2, True), attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_data4']:
+            out.extend(struct.pack(self.arch.struct_fmt(4, True), attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_sdata']:
+            out.extend(encode_sleb128(attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_flag']:
+            out.append(int(attr))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_strp']:
             if type(attr) is str:
                 attr = attr.encode('utf-8')
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(4), self.lookup_string(attr)))
-        if form == enums.ENUM_DW_FORM['DW_FORM_ref4']:
-            if attr is None:
-                self.result['.debug_info'].extend(bytes(4))
-            elif id(attr) in self.reference_cache:
-                self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(4), self.reference_cache[id(attr)]))
-            elif id(attr) in self.pending_references:
-                self.pending_references[id(attr)][1].append(len(self.result['.debug_info']))
-                self.result['.debug_info'].extend(bytes(4))
-            else:
-                self.pending_references[id(attr)] = (attr, [len(self.result['.debug_info'])])
-                self.result['.debug_info'].extend(bytes(4))
-        if form == enums.ENUM_DW_FORM['DW_FORM_exprloc']:
-            seq = self.expr_serializer.serialize_expr(attr)
-            self.result['.debug_info'].extend(self.encode_leb128(len(seq)))
-            self.result['.debug_info'].extend(seq)
-        if form == enums.ENUM_DW_FORM['DW_FORM_flag_present']:
+            if self.unit_fixups is not None:
+                self.unit_fixups.append((offset, '.debug_str', bytes(attr)))
+            out.extend(struct.pack(self.arch.struct_fmt(4), self.lookup_string(attr)))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_GNU_str_index']:
+            if type(attr) is str:
+                attr = attr.encode('utf-8')
+            out.extend(encode_uleb128(self.lookup_dwo_string(attr)))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_ref4']:
+            if self.stats is not None:
+                self.stats.references += 1
+                self.stats.forward_references += id(attr) not in self.reference_cache
+            self.referenced[id(attr)] = attr
+            return attr, 4
+        elif form == enums.ENUM_DW_FORM['DW_FORM_exprloc']:
+            refs = []
+            seq = self.serialize_expr(attr, refs)
+            if not refs:
+                out.extend(encode_uleb128(len(seq)))
+                out.extend(seq)
+                return None
+            data = encode_uleb128(len(seq))
+            refs = [(len(data) + pos, fmt, die) for pos, fmt, die in refs]
+            data.extend(seq)
+            self.referenced.update((id(die), die) for _, _, die in refs)
+            return (data, refs), len(data)
+        elif form == enums.ENUM_DW_FORM['DW_FORM_flag_present']:
             pass
-        if form == enums.ENUM_DW_FORM['DW_FORM_sec_offset']:
-            if type(attr) is list and type(attr[0]) is LocationEntry:
-                section = '.debug_loc'
-                data = bytearray()
-                offset = 0
-                for item in attr:
-                    low_pc = self.current_unit.get(enums.ENUM_DW_AT['DW_AT_low_pc'], 0)
-                    data.extend(struct.pack(self.arch.struct_fmt(), item.begin_offset - low_pc))
-                    data.extend(struct.pack(self.arch.struct_fmt(), item.end_offset - low_pc))  # TODO is this right?
-                    seq = self.expr_serializer.serialize_expr(item.location)
-                    data.extend(struct.pack(self.arch.struct_fmt(2), len(seq)))
-                    data.extend(seq)
-                data.extend(struct.pack(self.arch.struct_fmt(), 0))
-                data.extend(struct.pack(self.arch.struct_fmt(), 0))
-            elif type(attr) is list and type(attr[0]) is lineprogram.LineState:
-                section = '.debug_line'
-                offset = 0
-                data = serialize_states(self.arch, attr)
-            elif type(attr) is list and type(attr[0]) in (BaseAddressEntry, RangeEntry):
-                section = '.debug_ranges'
-                offset = 0
-                data = bytearray()
-                for item in attr:
-                    if type(item) is RangeEntry:
-                        # ummmm TODO base addresses
-                        data.extend(struct.pack(self.arch.struct_fmt(), item.begin_offset))
-                        data.extend(struct.pack(self.arch.struct_fmt(), item.end_offset))
-                    elif type(item) is BaseAddressEntry:
-                        data.extend(struct.pack(self.arch.struct_fmt(signed=True), -1))
-                        data.extend(struct.pack(self.arch.struct_fmt(), item.base_address))
-                data.extend(struct.pack(self.arch.struct_fmt(), 0))
-                data.extend(struct.pack(self.arch.struct_fmt(), 0))
+        elif form == enums.ENUM_DW_FORM['DW_FORM_sec_offset']:
+            if type(attr) is SectionOffset:
+                out.extend(struct.pack(self.arch.struct_fmt(4), attr))
             else:
-                raise TypeError("Not sure what kind of section reference this is")
-
-            self.result['.debug_info'].extend(struct.pack(self.arch.struct_fmt(4), len(self.result[section]) + offset))
-            self.result[section].extend(data)
-
-    @staticmethod
-    def encode_leb128(num):
-        # roughly from wikipedia
-        more = True
-        result = bytearray()
-        while more:
-            byte = num & 0x7f
-            num >>= 7
-
-            if (num == 0 and (byte & 0x40) == 0) or (num == -1 and (byte & 0x40) == 0x40):
-                more = False
-            else:
-                byte |= 0x80
-
-            result.append(byte)
-
-        return result
+                # appended in the write pass, so that sections stay in the same order as the unit
+                return self.layout_section_data(attr), 4
+        else:
+            raise TypeError("Can't encode form %s" % form)
+        return None
+
+    def layout_section_data(self, attr):
+        # returns (section, bias of the offset written, contents, DIE operands to fill in), for data which goes in
+        # another section
+        refs = [] # (position in data, encoding, referenced object)
+        if type(attr) is list and type(attr[0]) is LocationEntry and self.in_dwo:
+            # pre-standard split dwarf location list: DW_LLE_GNU_start_length_entry with address indexes
+            section = '.debug_loc.dwo'
+            data = bytearray()
+            offset = 0
+            for begin, end, seq, seq_refs in self.compact_locations(attr):
+                data.append(3)
+                data.extend(encode_uleb128(self.lookup_address(begin)))
+                data.extend(struct.pack(self.arch.struct_fmt(4), end - begin))
+                data.extend(struct.pack(self.arch.struct_fmt(2), len(seq)))
+                if seq_refs:
+                    refs.extend((len(data) + pos, fmt, die) for pos, fmt, die in seq_refs)
+                data.extend(seq)
+            data.append(0)
+        elif type(attr) is list and type(attr[0]) is LocationEntry:
+            section = '.debug_loc'
+            data = bytearray()
+            offset = 0
+            entries = self.compact_locations(attr)
+            # entries are relative to the unit's DW_AT_low_pc. any lying below it need a base address selection
+            # entry, which then may as well be the lowest address
+            base = self.base_address
+            if entries and entries[0][0] < base:
+                base = entries[0][0]
+                data.extend(struct.pack(self.arch.struct_fmt(), (1 << self.arch.bits) - 1))
+                data.extend(struct.pack(self.arch.struct_fmt(), base))
+            for begin, end, seq, seq_refs in entries:
+                data.extend(struct.pack(self.arch.struct_fmt(), begin - base))
+                data.extend(struct.pack(self.arch.struct_fmt(), end - base))
+                data.extend(struct.pack(self.arch.struct_fmt(2), len(seq)))
+                if seq_refs:
+                    refs.extend((len(data) + pos, fmt, die) for pos, fmt, die in seq_refs)
+                data.extend(seq)
+            data.extend(struct.pack(self.arch.struct_fmt(), 0))
+            data.extend(struct.pack(self.arch.struct_fmt(), 0))
+        elif isinstance(attr, LineRows) or type(attr) is list and type(attr[0]) is lineprogram.LineState:
+            section = '.debug_line'
+            offset = 0
+            data = serialize_states(self.arch, attr, self.compact_lines)
+        elif type(attr) is list and type(attr[0]) in (BaseAddressEntry, RangeEntry):
+            section = '.debug_ranges'
+            # within a dwo, range list offsets are relative to the skeleton's DW_AT_GNU_ranges_base
+            offset = -self.ranges_base if self.in_dwo else 0
+            data = bytearray()
+            ranges = normalize_ranges(resolve_ranges(attr))
+            # like location lists, relative to the unit's base address unless a base address selection entry
+            # is needed
+            base = self.base_address
+            if ranges and ranges[0][0] < base:
+                base = ranges[0][0]
+                data.extend(struct.pack(self.arch.struct_fmt(), (1 << self.arch.bits) - 1))
+                data.extend(struct.pack(self.arch.struct_fmt(), base))
+            for begin, end in ranges:
+                data.extend(struct.pack(self.arch.struct_fmt(), begin - base))
+                data.extend(struct.pack(self.arch.struct_fmt(), end - base))
+            data.extend(struct.pack(self.arch.struct_fmt(), 0))
+            data.extend(struct.pack(self.arch.struct_fmt(), 0))
+        else:
+            raise TypeError("Not sure what kind of section reference this is")
+        self.referenced.update((id(die), die) for _, _, die in refs)
+        return section, offset, data, refs
+
+    def write_attribute(self, view, pos, form, value):
+        # writes a value left by layout_attribute at pos, returning the position past it
+        if form == enums.ENUM_DW_FORM['DW_FORM_ref4']:
+            struct.pack_into(self.arch.struct_fmt(4), view, pos, self.reference_cache[id(value)])
+            return pos + 4
+        if form == enums.ENUM_DW_FORM['DW_FORM_exprloc']:
+            data, refs = value
+            self.fill_die_operands(data, refs)
+            view[pos:pos + len(data)] = data
+            return pos + len(data)
+        section, offset, data, refs = value
+        self.fill_die_operands(data, refs)
+        if self.unit_fixups is not None:
+            self.unit_fixups.append((pos - self.info_offset, section, bytes(data)))
+        struct.pack_into(self.arch.struct_fmt(4), view, pos, len(self.result[section]) + offset)
+        self.result[section].extend(data)
+        return pos + 4
+
+    def fill_die_operands(self, data, refs):
+        # writes the offsets of the DIEs which an expression, or the expressions of a location list, refer to
+        for pos, fmt, die in refs:
+            offset = self.reference_cache[id(die)]
+            if fmt is REF_ADDR:
+                offset += self.info_offset
+                # which ties the unit to where it is in the section, so it isn't cached
+                self.unit_fixups = None
+            pack_die_operand(self.arch, fmt, data, pos, offset)
+
+    def compact_locations(self, entries):
+        # merge entries with equal expressions which touch or overlap and drop empty ones. returns (begin, end,
+        # encoded expression, DIE operands to fill in) in address order
+        by_expr = {}
+        for item in entries:
+            refs = []
+            seq = bytes(self.serialize_expr(item.location, refs))
+            # until they are filled in, expressions differing only in the DIEs they refer to encode the same
+            key = (seq, tuple((pos, id(die)) for pos, _, die in refs)) if refs else seq
+            by_expr.setdefault(key, (seq, refs, []))[2].append((item.begin_offset, item.end_offset))
+        return sorted(((begin, end, seq, refs) for seq, refs, ranges in by_expr.values()
+                       for begin, end in normalize_ranges(ranges)), key=itemgetter(0, 1, 2))
+
+    def serialize_expr(self, expr, refs=None):
+        seq = self.expr_serializer.serialize_expr(expr, refs)
+        if self.stats is not None:
+            self.stats.expressions += 1
+            self.stats.expression_bytes += len(seq)
+        return seq
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import contextlib
+from collections import Counter
+
+from elftools.dwarf import enums
+
+_TAG_NAMES = {v: k for k, v in enums.ENUM_DW_TAG.items()}
+_FORM_NAMES = {v: k for k, v in enums.ENUM_DW_FORM.items()}
+
+
+class SerializerStats:
+    """Counters filled in by serialize() and ReStructurer.rewrite_dwarf when one is passed as their stats parameter.
+
+    Counters are keyed by raw DWARF constants while running; as_dict() translates them to names.
+    """
+
+    def __init__(self):
+        self.section_sizes = {}
+        self.dies_by_tag = Counter()
+        self.attributes_by_form = Counter()
+        self.abbreviations = 0
+        self.abbrev_tables = 0
+        self.abbrev_tables_shared = 0
+        self.abbrev_bytes = 0
+        self.string_lookups = 0
+        self.string_hits = 0
+        self.expressions = 0
+        self.expression_bytes = 0
+        self.references = 0
+        self.forward_references = 0
+        self.raw_units = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.eliminated_dies = Counter() # by tag name, from canonical.canonicalize_types
+        self.phases = Counter()
+        self.peak_rss_kb = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'section_sizes': dict(self.section_sizes),
+            'dies': sum(self.dies_by_tag.values()),
+            'dies_by_tag': {_TAG_NAMES.get(k, hex(k)): v for k, v in self.dies_by_tag.items()},
+            'attributes': sum(self.attributes_by_form.values()),
+            'attributes_by_form': {_FORM_NAMES.get(k, hex(k)): v for k, v in self.attributes_by_form.items()},
+            'abbreviations': self.abbreviations,
+            'abbrev_tables': self.abbrev_tables,
+            'abbrev_tables_shared': self.abbrev_tables_shared,
+            'abbrev_bytes': self.abbrev_bytes,
+            'string_lookups': self.string_lookups,
+            'string_hit_rate': self.string_hits / self.string_lookups if self.string_lookups else 0.,
+            'expressions': self.expressions,
+            'expression_bytes': self.expression_bytes,
+            'references': self.references,
+            'forward_references': self.forward_references,
+            'raw_units': self.raw_units,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'eliminated_dies': dict(self.eliminated_dies),
+            'phases': dict(self.phases),
+            'peak_rss_kb': self.peak_rss_kb,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+@contextlib.contextmanager
+def _no_phase():
+    # contextlib.nullcontext needs python 3.7
+    yield
+
+
+def phase(stats, name):
+    """stats.phase(name), or a context which does nothing if stats is None.
+    """
+    return _no_phase() if stats is None else stats.phase(name)
+
+
+def current_rss():
+    """The resident set size of this process in bytes, or None where it can't be determined.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_kb():
+    """The peak resident set size of this process in kB, or None where it can't be determined.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # which macOS reports in bytes, and Linux and the BSDs in kB
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
@@ -1,9 +1,15 @@
+import logging
+
 from elftools.dwarf import enums
+from elftools.dwarf.ranges import RangeEntry
 from collections import defaultdict
 
-from .serial import VALUE_PRESENT, Address
+from .serial import VALUE_PRESENT, Address, LocationEntry, normalize_ranges, resolve_ranges
+from .expr_serial import iter_die_operands
 from . import __version__
 
+l = logging.getLogger(__name__)
+
 class DWARFStructurer:
     def __init__(self):
         self.handlers = defaultdict(lambda: lambda *a, **kw: None)
@@ -12,9 +18,16 @@ class DWARFStructurer:
         self.type_id_cache = {}
         self.type_cache = {}
         self.func_cache = {}
+        self.die_cache = {}
 
     def root_get_units(self):
         return []
+    def unit_done(self, handler):
+        # called by iter_units once the result for this unit has been consumed
+        pass
+    def unit_get_raw(self, handler):
+        # returns a serial.RawUnit to use verbatim instead of structuring this unit
+        return None
     def unit_get_filename(self, handler):
         return None
     def unit_get_functions(self, handler):
@@ -153,9 +166,19 @@ class DWARFStructurer:
         return False
 
     def run(self):
-        result = []
+        return list(self.iter_units())
+
+    def iter_units(self):
+        # yields each unit as it is structured. nothing here refers to a unit once the next one is requested, so a
+        # consumer which doesn't keep them only holds one unit in memory at a time
         for unit in self.root_get_units():
+            raw = self.unit_get_raw(unit)
+            if raw is not None:
+                yield raw
+                self.unit_done(unit)
+                continue
             self.func_cache = {}
+            self.die_cache = {}
             unit_result = {
                 "tag": enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
                 enums.ENUM_DW_AT['DW_AT_name']: self.unit_get_filename(unit),
@@ -175,10 +198,15 @@ class DWARFStructurer:
 
             unit_result['children'].extend(self.process_variable(var) for var in self.unit_get_variables(unit))
             unit_result['children'].extend(self.process_function(func) for func in self.unit_get_functions(unit))
+            self.drop_unresolved_references(unit_result)
 
-            result.append(unit_result)
-
-        return result
+            yield unit_result
+            self.current_unit = None
+            self.type_id_cache = {}
+            self.type_cache = {}
+            self.func_cache = {}
+            self.die_cache = {}
+            self.unit_done(unit)
 
     def process_function(self, func):
         func_result = {
@@ -192,12 +220,13 @@ class DWARFStructurer:
         }
 
         for func_param in self.function_get_parameters(func):
-            param_result = {
+            param_result = self.process_die_reference(func_param)
+            param_result.update({
                 "tag": enums.ENUM_DW_TAG['DW_TAG_formal_parameter'],
                 enums.ENUM_DW_AT['DW_AT_name']: self.parameter_get_name(func_param),
                 enums.ENUM_DW_AT['DW_AT_type']: self.process_type(self.parameter_get_type(func_param)),
                 enums.ENUM_DW_AT['DW_AT_location']: self.parameter_get_location(func_param),
-            }
+            })
             if self.parameter_get_artificial(func_param):
                 param_result[enums.ENUM_DW_AT['DW_AT_artificial']] = VALUE_PRESENT
             func_result['children'].append(param_result)
@@ -213,12 +242,14 @@ class DWARFStructurer:
         return func_result
 
     def process_variable(self, var):
-        return {
+        result = self.process_die_reference(var)
+        result.update({
             "tag": enums.ENUM_DW_TAG['DW_TAG_variable'],
             enums.ENUM_DW_AT['DW_AT_name']: self.variable_get_name(var),
             enums.ENUM_DW_AT['DW_AT_location']: self.variable_get_location(var),
             enums.ENUM_DW_AT['DW_AT_type']: self.process_type(self.variable_get_type(var)),
-        }
+        })
+        return result
 
     def process_lexical_block(self, block):
         result = {
@@ -231,12 +262,15 @@ class DWARFStructurer:
         return result
 
     def process_ranges(self, ranges):
+        # adjacent and overlapping ranges are merged, so a single range left is a low_pc/high_pc pair
         result = {}
+        ranges = normalize_ranges(resolve_ranges(ranges))
         if len(ranges) == 1:
-            result[enums.ENUM_DW_AT['DW_AT_low_pc']] = Address(ranges[0].begin_offset)
-            result[enums.ENUM_DW_AT['DW_AT_high_pc']] = int(ranges[0].end_offset - ranges[0].begin_offset)
+            result[enums.ENUM_DW_AT['DW_AT_low_pc']] = Address(ranges[0][0])
+            result[enums.ENUM_DW_AT['DW_AT_high_pc']] = ranges[0][1] - ranges[0][0]
         elif len(ranges) > 1:
-            result[enums.ENUM_DW_AT['DW_AT_ranges']] = ranges
+            result[enums.ENUM_DW_AT['DW_AT_ranges']] = [RangeEntry(None, None, begin, end, True)
+                                                        for begin, end in ranges]
         return result
 
     def process_abstract_origin(self, obj):
@@ -248,6 +282,37 @@ class DWARFStructurer:
             # note to self: this entails keeping another "pending references" list
         return {enums.ENUM_DW_AT['DW_AT_abstract_origin']: self.func_cache[id(obj)]}
 
+    def process_die_reference(self, obj):
+        # the dict a variable or parameter is, or will be, structured into, so that location expressions can refer to
+        # one before it is processed. if it never is, the reference is dropped at the end of the unit
+        return self.die_cache.setdefault(id(obj), {})
+
+    def drop_unresolved_references(self, unit):
+        # expressions referring to objects which were not structured, e.g. variables of inlined subroutines, are left
+        # out, as are the location list entries containing them
+        unresolved = {id(die) for die in self.die_cache.values() if 'tag' not in die}
+        if not unresolved:
+            return
+        def resolved(value):
+            return not any(id(args[index]) in unresolved for args, index in iter_die_operands(value))
+        dropped = 0
+        stack = [unit]
+        while stack:
+            die = stack.pop()
+            for attr, value in list(die.items()):
+                if type(attr) is not int or resolved(value):
+                    continue
+                if type(value[0]) is LocationEntry:
+                    kept = [entry for entry in value if resolved([entry])]
+                    dropped += len(value) - len(kept)
+                    die[attr] = kept or None
+                else:
+                    dropped += 1
+                    die[attr] = None
+            stack.extend(die.get('children', []))
+        l.warning("Dropped %d location expression(s) of unit %s referring to objects which were not structured",
+                  dropped, unit.get(enums.ENUM_DW_AT['DW_AT_name'], None))
+
     def process_type(self, ty):
         if self.type_is_void(ty):
             return None
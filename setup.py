@@ -2,7 +2,7 @@
 try:
     from setuptools import setup
     from setuptools import find_packages
-    packages = find_packages()
+    packages = find_packages(exclude=('benchmarks',))
 except ImportError:
     from distutils.core import setup
     import os
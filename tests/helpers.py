@@ -0,0 +1,55 @@
+# fixtures shared between test modules
+
+import archinfo
+from elftools.dwarf import enums, constants
+from elftools.dwarf.dwarf_expr import DWARFExprOp
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.serial import Address, LocationEntry, serialize
+
+def make_input(path, **options):
+    arch = archinfo.ArchAMD64()
+    int_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'int',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+        enums.ENUM_DW_AT['DW_AT_encoding']: constants.DW_ATE_signed,
+    }
+    def unit(name, low_pc):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            enums.ENUM_DW_AT['DW_AT_language']: constants.DW_LANG_C,
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low_pc),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+            'children': [
+                int_type,
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                    enums.ENUM_DW_AT['DW_AT_name']: name.split('.')[0] + '_func',
+                    enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low_pc),
+                    enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+                    enums.ENUM_DW_AT['DW_AT_type']: int_type,
+                    'children': [{
+                        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                        enums.ENUM_DW_AT['DW_AT_name']: 'x',
+                        enums.ENUM_DW_AT['DW_AT_type']: int_type,
+                        enums.ENUM_DW_AT['DW_AT_location']: [
+                            LocationEntry(low_pc, low_pc + 0x10, [DWARFExprOp(0x50, 'DW_OP_reg0', [], 0)]),
+                            LocationEntry(low_pc + 0x10, low_pc + 0x20, [DWARFExprOp(0x51, 'DW_OP_reg1', [], 0)]),
+                        ],
+                    }],
+                },
+            ],
+        }
+    units = [unit('a.c', 0x1000), unit('b.c', 0x2000)]
+    # each unit needs its own copy of the shared type
+    units[1]['children'][0] = dict(int_type)
+    units[1]['children'][1][enums.ENUM_DW_AT['DW_AT_type']] = units[1]['children'][0]
+    units[1]['children'][1]['children'][0][enums.ENUM_DW_AT['DW_AT_type']] = units[1]['children'][0]
+    dump_elf(serialize(units, arch, **options), arch, path)
+
+def read_section(path, name):
+    with open(path, 'rb') as fp:
+        return ELFFile(fp).get_section_by_name(name).data()
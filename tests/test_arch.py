@@ -0,0 +1,44 @@
+import os
+import sys
+import subprocess
+import tempfile
+
+import archinfo
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.arch import Arch
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.serial import serialize
+
+from .helpers import make_input
+
+def test_arch():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        for ai in (archinfo.ArchX86(), archinfo.ArchAMD64(), archinfo.ArchMIPS32(), archinfo.ArchPPC64()):
+            arch = Arch.from_archinfo(ai)
+            assert (arch.name, arch.bits, arch.bytes) == (ai.name, ai.bits, ai.bytes)
+            for size in (None, 1, 2, 4, 8):
+                for signed in (False, True):
+                    assert arch.struct_fmt(size, signed) == ai.struct_fmt(size, signed)
+
+            dump_elf({'.debug_str': b'\0abc\0'}, arch, elf)
+            with open(elf, 'rb') as fp:
+                read = Arch.from_elf(ELFFile(fp))
+            assert (read.name, read.bits, read.memory_endness) == (ai.name, ai.bits, ai.memory_endness)
+
+        make_input(elf)
+        with open(elf, 'rb') as fp:
+            units = [{'tag': 0x11, 3: cu.get_top_DIE().attributes['DW_AT_name'].value}
+                     for cu in ELFFile(fp).get_dwarf_info().iter_CUs()]
+        assert serialize(units, Arch('AMD64', 64, 'Iend_LE')) == serialize(units, archinfo.ArchAMD64())
+
+def test_light_import():
+    code = "import sys, dwarfwrite.serial, dwarfwrite.elf, dwarfwrite.restructure; " \
+           "print('archinfo' in sys.modules or 'cle' in sys.modules)"
+    assert subprocess.check_output([sys.executable, '-c', code]).strip() == b'False'
+
+
+if __name__ == '__main__':
+    test_arch()
+    test_light_import()
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.batch import rewrite_batch
+
+from .helpers import make_input
+
+def test_batch():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        elf3 = os.path.join(tmp, 'debug3.elf')
+        missing = os.path.join(tmp, 'does-not-exist.elf')
+        make_input(elf)
+        jobs = [(elf, elf2), (missing, elf3)]
+        for workers in (0, 2):
+            results = {result.in_path: result for result in rewrite_batch(jobs, workers=workers, collect_stats=True)}
+            assert results[elf].error is None
+            assert results[elf].stats['dies'] > 0
+            assert 'FileNotFoundError' in results[missing].error
+            with open(elf2, 'rb') as fp:
+                assert len(list(ELFFile(fp).get_dwarf_info().iter_CUs())) == 2
+
+
+if __name__ == '__main__':
+    test_batch()
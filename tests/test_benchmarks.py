@@ -0,0 +1,12 @@
+from benchmarks.suite import BENCHMARKS, run_benchmark
+
+def test_benchmarks():
+    # smoke test: every workload builds and runs at the smallest scale
+    for name in BENCHMARKS:
+        result = run_benchmark(name, 1, 1)
+        if result is not None:
+            assert result['seconds'] > 0 and result['items'] > 0
+
+
+if __name__ == '__main__':
+    test_benchmarks()
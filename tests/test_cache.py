@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+
+import archinfo
+from elftools.dwarf import enums
+from elftools.dwarf.dwarf_expr import DWARFExprOp
+
+from dwarfwrite.cache import UnitCache
+from dwarfwrite.serial import Address, LocationEntry, serialize
+
+def make_units():
+    units = []
+    for i in range(3):
+        int_type = {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'int',
+            enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+        }
+        units.append({
+            'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'unit%d.c' % i,
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000 * (i + 1)),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+            'children': [
+                int_type,
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                    enums.ENUM_DW_AT['DW_AT_name']: 'func%d' % i,
+                    enums.ENUM_DW_AT['DW_AT_type']: int_type,
+                },
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                    enums.ENUM_DW_AT['DW_AT_name']: 'x',
+                    # the type's offset is filled in after the location list is written
+                    enums.ENUM_DW_AT['DW_AT_location']: [LocationEntry(0x1000 * (i + 1), 0x1000 * (i + 1) + 0x10, [
+                        DWARFExprOp(0x50, 'DW_OP_reg0', [], 0),
+                        DWARFExprOp(0xf7, 'DW_OP_GNU_convert', [int_type], 0),
+                        DWARFExprOp(0x9f, 'DW_OP_stack_value', [], 0),
+                    ])],
+                },
+            ],
+        })
+    return units
+
+def test_cache():
+    arch = archinfo.ArchAMD64()
+    path = tempfile.mkdtemp()
+    try:
+        expected = serialize(make_units(), arch)
+
+        cache = UnitCache(path)
+        assert serialize(make_units(), arch, cache=cache) == expected
+        assert (cache.hits, cache.misses) == (0, 3)
+        assert serialize(make_units(), arch, cache=cache) == expected
+        assert (cache.hits, cache.misses) == (3, 3)
+
+        # a changed unit misses, the others still hit
+        units = make_units()
+        units[1]['children'][1][enums.ENUM_DW_AT['DW_AT_name']] = 'renamed'
+        serialize(units, arch, cache=cache)
+        assert (cache.hits, cache.misses) == (5, 4)
+
+        # entries which fail to load, here truncated or not entries at all, are misses and get replaced
+        for i, name in enumerate(sorted(os.listdir(path))):
+            with open(os.path.join(path, name), 'r+b') as fp:
+                if i == 0:
+                    fp.write(b'cdwarfwrite.serial\nNoSuchClass\n.')
+                fp.truncate(fp.seek(0, os.SEEK_END) - 1)
+        assert serialize(make_units(), arch, cache=cache) == expected
+        assert (cache.hits, cache.misses) == (5, 7)
+        assert serialize(make_units(), arch, cache=cache) == expected
+        assert (cache.hits, cache.misses) == (8, 7)
+
+        cache.max_size = 1
+        cache.evict()
+        assert os.listdir(path) == []
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    test_cache()
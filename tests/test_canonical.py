@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+import archinfo
+from elftools.dwarf import enums
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.canonical import canonicalize_types
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.serial import serialize
+from dwarfwrite.structure import DWARFStructurer
+
+class Ty:
+    # a fresh object for every use of a type, like a decompiler's type instances
+    def __init__(self, kind, sub=None):
+        self.kind = kind
+        self.sub = sub
+
+class TypeStructurer(DWARFStructurer):
+    def root_get_units(self):
+        return [1]
+    def unit_get_filename(self, unit):
+        return 'test.c'
+    def unit_get_variables(self, unit):
+        return ['a', 'b', 'c']
+    def variable_get_name(self, var):
+        return var
+    def variable_get_type(self, var):
+        return Ty('ptr', Ty('node')) if var != 'c' else Ty('int')
+    def type_ptr_of(self, ty):
+        return ty.sub if ty.kind == 'ptr' else None
+    def type_struct_name(self, ty):
+        return 'node' if ty.kind == 'node' else None
+    def type_struct_size(self, ty):
+        return 16 if ty.kind == 'node' else None
+    def type_struct_members(self, ty):
+        return [('next', ty), ('value', ty)]
+    def type_struct_member_name(self, member):
+        return member[0]
+    def type_struct_member_type(self, member):
+        # a fresh pointer handler back to the struct
+        return Ty('ptr', member[1]) if member[0] == 'next' else Ty('int')
+    def type_struct_member_offset(self, member):
+        return 0 if member[0] == 'next' else 8
+    def type_basic_name(self, ty):
+        return 'int' if ty.kind == 'int' else None
+    def type_basic_size(self, ty):
+        return 4
+    def type_basic_encoding(self, ty):
+        return 5
+
+def count_dies(path):
+    with open(path, 'rb') as fp:
+        return sum(1 for cu in ELFFile(fp).get_dwarf_info().iter_CUs() for die in cu.iter_DIEs() if not die.is_null())
+
+def test_canonicalize():
+    arch = archinfo.ArchAMD64()
+    units = TypeStructurer().run()
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(serialize(units, arch), arch, elf)
+        before = count_dies(elf)
+
+        eliminated = canonicalize_types(units)
+        assert eliminated['DW_TAG_structure_type'] > 0
+        dump_elf(serialize(units, arch), arch, elf)
+        assert count_dies(elf) == before - sum(eliminated.values())
+
+        # one int, one struct, one pointer and the three variables remain
+        tags = [die['tag'] for die in units[0]['children']]
+        assert len(tags) == 6
+        assert tags.count(enums.ENUM_DW_TAG['DW_TAG_structure_type']) == 1
+        variables = [die for die in units[0]['children'] if die['tag'] == enums.ENUM_DW_TAG['DW_TAG_variable']]
+        assert variables[0][enums.ENUM_DW_AT['DW_AT_type']] is variables[1][enums.ENUM_DW_AT['DW_AT_type']]
+
+
+if __name__ == '__main__':
+    test_canonicalize()
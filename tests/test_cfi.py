@@ -0,0 +1,61 @@
+import io
+import struct
+
+import archinfo
+from elftools.dwarf.callframe import CallFrameInfo, CFARule, RegisterRule, FDE
+from elftools.dwarf.structs import DWARFStructs
+
+from dwarfwrite.cfi_serial import FrameInfo, serialize_frames
+
+def make_frames():
+    def function(begin, size, push):
+        entry = {'pc': begin, 'cfa': CFARule(7, 8), 16: RegisterRule(RegisterRule.OFFSET, -8)}
+        rows = [entry]
+        if push:
+            rows.append({'pc': begin + 1, 'cfa': CFARule(7, 16), 16: RegisterRule(RegisterRule.OFFSET, -8),
+                         6: RegisterRule(RegisterRule.OFFSET, -16)})
+            rows.append({'pc': begin + 4, 'cfa': CFARule(6, 16), 16: RegisterRule(RegisterRule.OFFSET, -8),
+                         6: RegisterRule(RegisterRule.OFFSET, -16)})
+            rows.append(dict(entry, pc=begin + size - 1))
+        return FrameInfo(begin, begin + size, rows)
+    return [function(0x1000, 0x40, True), function(0x1040, 0x10, False), function(0x1050, 0x200, True)]
+
+def decoded(table):
+    return [{key: (value.reg, value.offset) if key == 'cfa' else
+             (value.type, value.arg) if type(key) is int else value for key, value in row.items()} for row in table]
+
+def test_debug_frame():
+    arch = archinfo.ArchAMD64()
+    frames = make_frames()
+    data = serialize_frames(arch, frames, 16)['.debug_frame']
+    cfi = CallFrameInfo(io.BytesIO(data), len(data), 0, DWARFStructs(True, 32, 8))
+    entries = cfi.get_entries()
+    fdes = [entry for entry in entries if isinstance(entry, FDE)]
+    # every function starts from the same state, so they share a CIE
+    assert len(entries) - len(fdes) == 1
+    for frame, fde in zip(frames, fdes):
+        assert fde['initial_location'] == frame.begin
+        assert fde['address_range'] == frame.end - frame.begin
+        assert decoded(fde.get_decoded().table) == decoded(frame.rows)
+
+def test_eh_frame():
+    arch = archinfo.ArchAMD64()
+    frames = make_frames()
+    result = serialize_frames(arch, frames[::-1], 16, eh_frame_address=0x3000, eh_frame_hdr_address=0x2000)
+    data = result['.eh_frame']
+    cfi = CallFrameInfo(io.BytesIO(data), len(data), 0x3000, DWARFStructs(True, 32, 8), for_eh_frame=True)
+    fdes = {entry.offset: entry for entry in cfi.get_entries() if isinstance(entry, FDE)}
+    assert sorted(fde['initial_location'] for fde in fdes.values()) == [frame.begin for frame in frames]
+
+    header = result['.eh_frame_hdr']
+    version, _, _, _, eh_frame_ptr, count = struct.unpack_from('<BBBBiI', header)
+    assert version == 1 and 0x2004 + eh_frame_ptr == 0x3000 and count == len(frames)
+    table = [struct.unpack_from('<ii', header, 12 + 8 * i) for i in range(count)]
+    assert [0x2000 + location for location, _ in table] == [frame.begin for frame in frames]
+    for location, fde in table:
+        assert fdes[0x2000 + fde - 0x3000]['initial_location'] == 0x2000 + location
+
+
+if __name__ == '__main__':
+    test_debug_frame()
+    test_eh_frame()
@@ -0,0 +1,92 @@
+import io
+import os
+import tempfile
+
+import archinfo
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.elf import dump_elf, elf_object
+
+def read_sections(path):
+    with open(path, 'rb') as fp:
+        elf = ELFFile(fp)
+        return {section.name: section.data() for section in elf.iter_sections() if section.name}
+
+def test_fresh():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'debug.elf')
+        for arch in (archinfo.ArchX86(), archinfo.ArchAMD64(), archinfo.ArchMIPS32()):
+            dump_elf({'.debug_info': b'info', '.debug_str': b'\0abc\0'}, arch, path)
+            with open(path, 'rb') as fp:
+                elf = ELFFile(fp)
+                assert elf.elfclass == arch.bits
+                assert elf.little_endian == (arch.memory_endness == 'Iend_LE')
+            sections = read_sections(path)
+            assert sections['.debug_info'] == b'info'
+            assert sections['.debug_str'] == b'\0abc\0'
+
+def test_update():
+    arch = archinfo.ArchAMD64()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'debug.elf')
+        path2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf({'.debug_info': b'info', '.debug_str': b'\0abc\0'}, arch, path)
+        dump_elf({'.debug_str': b'\0longer string\0', '.debug_line': b'line'}, arch, path2, path)
+        sections = read_sections(path2)
+        assert sections['.debug_info'] == b'info'
+        assert sections['.debug_str'] == b'\0longer string\0'
+        assert sections['.debug_line'] == b'line'
+
+        # in-place rewrite
+        dump_elf({'.debug_info': b'new info'}, arch, path2, path2)
+        sections = read_sections(path2)
+        assert sections['.debug_info'] == b'new info'
+        assert sections['.debug_line'] == b'line'
+
+def test_compressed():
+    arch = archinfo.ArchAMD64()
+    info = bytes(range(256)) * 64
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'debug.elf')
+        path2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf({'.debug_info': info, '.debug_str': b'\0abc\0'}, arch, path, compression='zlib',
+                 compression_level=9)
+        with open(path, 'rb') as fp:
+            section = ELFFile(fp).get_section_by_name('.debug_info')
+            assert section.compressed
+            assert section['sh_size'] < len(info)
+            assert section.data() == info
+
+        # replacing a compressed section with an uncompressed one must clear the flag
+        dump_elf({'.debug_info': b'info'}, arch, path2, path)
+        with open(path2, 'rb') as fp:
+            elf = ELFFile(fp)
+            assert not elf.get_section_by_name('.debug_info').compressed
+            assert elf.get_section_by_name('.debug_info').data() == b'info'
+            assert elf.get_section_by_name('.debug_str').data() == b'\0abc\0'
+
+def test_object():
+    for arch in (archinfo.ArchX86(), archinfo.ArchAMD64(), archinfo.ArchMIPS32()):
+        data = elf_object({'.debug_info': b'info', '.debug_str': b'\0abc\0'}, arch, text=(0x401000, 0x40),
+                          symbols=[('jitted', 0x401000, 0x40)])
+        elf = ELFFile(io.BytesIO(data))
+        assert elf.elfclass == arch.bits
+        text = elf.get_section_by_name('.text')
+        assert text['sh_addr'] == 0x401000 and text['sh_size'] == 0x40 and text['sh_type'] == 'SHT_NOBITS'
+        assert elf.get_section_by_name('.debug_info').data() == b'info'
+        assert elf.get_section_by_name('.debug_str').data() == b'\0abc\0'
+        symbol = elf.get_section_by_name('.symtab').get_symbol_by_name('jitted')[0]
+        assert symbol['st_value'] == 0x401000 and symbol['st_size'] == 0x40
+        assert symbol['st_info']['type'] == 'STT_FUNC' and symbol['st_shndx'] == elf.get_section_index('.text')
+
+    # without annotations only the given sections are present
+    elf = ELFFile(io.BytesIO(elf_object({'.debug_info': b'info'}, archinfo.ArchAMD64())))
+    assert [section.name for section in elf.iter_sections()] == ['', '.debug_info', '.shstrtab']
+    assert elf['e_machine'] == 'EM_X86_64'
+
+
+if __name__ == '__main__':
+    test_fresh()
+    test_update()
+    test_compressed()
+    test_object()
@@ -0,0 +1,53 @@
+import archinfo
+from elftools.dwarf import enums, constants
+
+from dwarfwrite.layout import order_by_address
+from dwarfwrite.serial import Address, serialize
+
+TAG = enums.ENUM_DW_TAG
+AT = enums.ENUM_DW_AT
+
+def make_unit(name, functions):
+    # functions: (name, low_pc) pairs; each function gets its own pointer type to a shared int
+    int_type = {'tag': TAG['DW_TAG_base_type'], AT['DW_AT_name']: 'int', AT['DW_AT_byte_size']: 4,
+                AT['DW_AT_encoding']: constants.DW_ATE_signed}
+    unused = {'tag': TAG['DW_TAG_base_type'], AT['DW_AT_name']: 'unused', AT['DW_AT_byte_size']: 1,
+              AT['DW_AT_encoding']: constants.DW_ATE_unsigned}
+    types = [int_type, unused]
+    children = []
+    for func_name, low_pc in functions:
+        pointer = {'tag': TAG['DW_TAG_pointer_type'], AT['DW_AT_type']: int_type}
+        types.insert(0, pointer)
+        children.append({
+            'tag': TAG['DW_TAG_subprogram'],
+            AT['DW_AT_name']: func_name,
+            AT['DW_AT_low_pc']: Address(low_pc),
+            AT['DW_AT_high_pc']: 0x10,
+            'children': [{'tag': TAG['DW_TAG_formal_parameter'], AT['DW_AT_name']: 'p', AT['DW_AT_type']: pointer}],
+        })
+    return {
+        'tag': TAG['DW_TAG_compile_unit'],
+        AT['DW_AT_name']: name,
+        AT['DW_AT_low_pc']: Address(min(low_pc for _, low_pc in functions)),
+        'children': types + children,
+    }
+
+def describe(unit):
+    return [child.get(AT['DW_AT_name'], child['tag']) for child in unit['children']]
+
+def test_layout():
+    pointer = TAG['DW_TAG_pointer_type']
+    units = [make_unit('b.c', [('f', 0x3000), ('g', 0x2000)]), make_unit('a.c', [('h', 0x1000)])]
+    ordered = order_by_address(units)
+    assert [unit[AT['DW_AT_name']] for unit in ordered] == ['a.c', 'b.c']
+    assert describe(ordered[1]) == ['unused', pointer, 'int', 'g', pointer, 'f']
+
+    units = [make_unit('b.c', [('f', 0x3000), ('g', 0x2000)])]
+    ordered = order_by_address(units, type_placement='block')
+    assert describe(ordered[0]) == ['unused', pointer, 'int', pointer, 'g', 'f']
+    # references still resolve
+    assert len(serialize(ordered, archinfo.ArchAMD64())['.debug_info']) > 0
+
+
+if __name__ == '__main__':
+    test_layout()
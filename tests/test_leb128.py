@@ -0,0 +1,21 @@
+from dwarfwrite.leb128 import decode_sleb128, decode_uleb128, encode_sleb128, encode_uleb128
+
+def test_leb128():
+    for value, encoded in ((0, b'\x00'), (63, b'\x3f'), (64, b'\x40'), (127, b'\x7f'), (128, b'\x80\x01'),
+                           (624485, b'\xe5\x8e\x26')):
+        assert encode_uleb128(value) == encoded
+        assert decode_uleb128(b'\xff' + encoded, 1) == (value, 1 + len(encoded))
+    for value, encoded in ((0, b'\x00'), (63, b'\x3f'), (64, b'\xc0\x00'), (-1, b'\x7f'), (-64, b'\x40'),
+                           (-65, b'\xbf\x7f'), (-123456, b'\xc0\xbb\x78')):
+        assert encode_sleb128(value) == encoded
+        assert decode_sleb128(encoded, 0) == (value, len(encoded))
+    try:
+        encode_uleb128(-1)
+    except ValueError:
+        pass
+    else:
+        assert False, "a negative value was encoded as unsigned"
+
+
+if __name__ == '__main__':
+    test_leb128()
@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+import archinfo
+from elftools.dwarf import enums, constants
+from elftools.dwarf.lineprogram import LineState
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.line_serial import compact_states, serialize_states
+from dwarfwrite.serial import serialize
+
+def make_states():
+    rows = [
+        # address, file, line, end_sequence
+        (0x1000, '/src/a.c', 1, False),
+        (0x1004, '/src/b.h', 10, False),
+        (0x1008, '/src/b.h', 10, False), # repeats the previous row
+        (0x100c, '/src/b.h', 11, False),
+        (0x1010, '/src/b.h', 12, False),
+        (0x1014, '/src/b.h', 13, False),
+        (0x1020, '/src/b.h', 12, True),
+        (0x2000, '/inc/c.h', 5, True), # covers nothing
+        (0x1800, '/src/a.c', 40, False), # below the previous sequence
+        (0x1880, '/src/a.c', 41, False),
+        (0x1900, '/src/a.c', 41, True),
+    ]
+    states = []
+    for address, path, line, end in rows:
+        state = LineState(True)
+        state.address = address
+        state.file = path
+        state.line = line
+        state.end_sequence = end
+        states.append(state)
+    return states
+
+def read_rows(path):
+    with open(path, 'rb') as fp:
+        dwarf = ELFFile(fp).get_dwarf_info()
+        cu = next(dwarf.iter_CUs())
+        program = dwarf.line_program_for_CU(cu)
+        names = [None] + [entry.name.decode() for entry in program['file_entry']]
+        return [(entry.state.address, names[entry.state.file], entry.state.line, entry.state.end_sequence)
+                for entry in program.get_entries() if entry.state is not None], names
+
+def test_lines():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        for arch in (archinfo.ArchX86(), archinfo.ArchAMD64()):
+            for compact in (False, True):
+                states = make_states()
+                unit = {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+                    enums.ENUM_DW_AT['DW_AT_name']: 'a.c',
+                    enums.ENUM_DW_AT['DW_AT_language']: constants.DW_LANG_C,
+                    enums.ENUM_DW_AT['DW_AT_stmt_list']: states,
+                }
+                dump_elf(serialize([unit], arch, compact_lines=compact), arch, elf)
+                rows, names = read_rows(elf)
+
+                expected = compact_states(states) if compact else states
+                assert rows == [(s.address, os.path.basename(s.file), s.line, s.end_sequence) for s in expected]
+                # b.h has the most rows
+                assert names[1] == 'b.h'
+                if compact:
+                    assert len(rows) == 9
+                    assert 0x1008 not in [row[0] for row in rows]
+                    assert 'c.h' not in [row[1] for row in rows]
+
+def test_deterministic():
+    # the file table must not depend on set or dict iteration order, i.e. on the hash seed
+    script = 'import archinfo, sys; from tests.test_line_serial import make_states; ' \
+             'from dwarfwrite.line_serial import serialize_states; ' \
+             'sys.stdout.write(serialize_states(archinfo.ArchAMD64(), make_states()).hex())'
+    outputs = set()
+    for seed in ('0', '1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.add(subprocess.check_output([sys.executable, '-c', script], env=env,
+                                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    assert len(outputs) == 1
+    assert bytes.fromhex(outputs.pop().decode()) == serialize_states(archinfo.ArchAMD64(), make_states())
+
+if __name__ == '__main__':
+    test_lines()
+    test_deterministic()
@@ -0,0 +1,37 @@
+import pickle
+
+from dwarfwrite.pipeline import prefetch, prefetch_process
+from dwarfwrite.serial import VALUE_PRESENT
+
+def numbers(count, fail_at=None):
+    for i in range(count):
+        if i == fail_at:
+            raise ValueError(i)
+        yield i
+
+def test_prefetch():
+    assert list(prefetch(numbers(100), depth=3)) == list(range(100))
+    assert list(prefetch_process(numbers, (100,), depth=3)) == list(range(100))
+
+    for stage in (lambda: prefetch(numbers(10, 5)), lambda: prefetch_process(numbers, (10, 5))):
+        seen = []
+        try:
+            for item in stage():
+                seen.append(item)
+        except ValueError as e:
+            assert e.args == (5,)
+        else:
+            assert False, "exception was not propagated"
+        assert seen == [0, 1, 2, 3, 4]
+
+    # stopping early must not hang
+    items = prefetch_process(numbers, (1000,), depth=1)
+    assert next(items) == 0
+    items.close()
+
+    # units cross into the parent pickled, and the serializer checks for this marker by identity
+    assert pickle.loads(pickle.dumps(VALUE_PRESENT)) is VALUE_PRESENT
+
+
+if __name__ == '__main__':
+    test_prefetch()
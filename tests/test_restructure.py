@@ -0,0 +1,361 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+import archinfo
+from elftools.dwarf import enums, constants
+from elftools.dwarf.dwarf_expr import DWARFExprOp, DWARFExprParser
+from elftools.dwarf.lineprogram import LineState
+from elftools.elf.elffile import ELFFile
+
+from dwarfwrite.cache import UnitCache
+from dwarfwrite.elf import dump_elf
+from dwarfwrite.serial import Address, LocationEntry, serialize
+from dwarfwrite.restructure import ReStructurer
+from dwarfwrite.stats import SerializerStats
+
+from .helpers import make_input, read_section
+
+def test_incremental():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        make_input(elf)
+
+        # nothing selected: every unit is copied through unchanged
+        ReStructurer.rewrite_dwarf(elf, elf2, rewrite_units=set())
+        for name in ('.debug_info', '.debug_abbrev', '.debug_loc', '.debug_str', '.debug_aranges'):
+            assert read_section(elf, name) == read_section(elf2, name)
+
+        # one unit restructured, the other copied with its offsets relocated
+        ReStructurer.rewrite_dwarf(elf, elf2, rewrite_units={'a.c'})
+        with open(elf2, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            names = []
+            for cu in dwarf.iter_CUs():
+                top = cu.get_top_DIE()
+                names.append(top.attributes['DW_AT_name'].value)
+                func = [die for die in top.iter_children() if die.tag == 'DW_TAG_subprogram'][0]
+                var = next(func.iter_children())
+                loclist = dwarf.location_lists().get_location_list_at_offset(var.attributes['DW_AT_location'].value)
+                assert len(loclist) == 2
+            assert names == [b'a.c', b'b.c']
+
+def test_streaming():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        elf3 = os.path.join(tmp, 'debug3.elf')
+        make_input(elf)
+        ReStructurer.rewrite_dwarf(elf, elf2)
+        ReStructurer.rewrite_dwarf(elf, elf3, streaming=True)
+        for name in ('.debug_info', '.debug_abbrev', '.debug_loc', '.debug_str', '.debug_aranges'):
+            assert read_section(elf2, name) == read_section(elf3, name)
+
+        try:
+            ReStructurer.rewrite_dwarf(elf, elf3, streaming=True, max_rss=1)
+        except MemoryError:
+            pass
+        else:
+            assert False, "memory budget was not enforced"
+
+def test_stale_sections():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        # name indexes of the input describe the old .debug_info, so they are dropped unless rebuilt
+        make_input(elf, debug_names=True, gdb_index=True)
+        ReStructurer.rewrite_dwarf(elf, elf2)
+        assert read_section(elf2, '.debug_names') == b''
+        assert read_section(elf2, '.gdb_index') == b''
+        ReStructurer.rewrite_dwarf(elf, elf2, gdb_index=True)
+        assert read_section(elf2, '.debug_names') == b''
+        assert read_section(elf2, '.gdb_index')[:4] == b'\x08\x00\x00\x00'
+
+def test_pipeline():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        elf3 = os.path.join(tmp, 'debug3.elf')
+        make_input(elf)
+        ReStructurer.rewrite_dwarf(elf, elf2, merge_types=True)
+        for pipeline in ('thread', 'process'):
+            stats = SerializerStats()
+            ReStructurer.rewrite_dwarf(elf, elf3, merge_types=True, pipeline=pipeline,
+                                       pipeline_depth=1, stats=stats)
+            assert stats.phases['canonicalize'] > 0
+            assert stats.peak_rss_kb > 0
+            if pipeline == 'process':
+                assert stats.phases['structure'] > 0
+            for name in ('.debug_info', '.debug_abbrev', '.debug_loc', '.debug_str', '.debug_aranges'):
+                assert read_section(elf2, name) == read_section(elf3, name)
+
+def unit_functions(path):
+    with open(path, 'rb') as fp:
+        result = {}
+        for cu in ELFFile(fp).get_dwarf_info().iter_CUs():
+            top = cu.get_top_DIE()
+            result[top.attributes['DW_AT_name'].value] = [die.attributes['DW_AT_name'].value
+                                                          for die in top.iter_children()
+                                                          if die.tag == 'DW_TAG_subprogram']
+        return result
+
+def test_select():
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        make_input(elf)
+        ReStructurer.rewrite_dwarf(elf, elf2, select_addresses=[(0x2010, 0x2011)])
+        assert unit_functions(elf2) == {b'b.c': [b'b_func']}
+        ReStructurer.rewrite_dwarf(elf, elf2, select_names={'a_func'}, streaming=True)
+        assert unit_functions(elf2) == {b'a.c': [b'a_func']}
+        ReStructurer.rewrite_dwarf(elf, elf2, select_addresses=[(0x3000, 0x4000)])
+        assert unit_functions(elf2) == {}
+
+def make_lines(path, address):
+    states = []
+    for i, (file, line) in enumerate([(path, 1), ('/usr/include/stdio.h', 30), (path, 2), (path, 2)]):
+        state = LineState(True)
+        state.address = address + i * 4
+        state.file = file
+        state.line = line
+        states.append(state)
+    states[-1].end_sequence = True
+    # as pyelftools decodes it
+    states[-1].is_stmt = False
+    return states
+
+def read_lines(path):
+    with open(path, 'rb') as fp:
+        dwarf = ELFFile(fp).get_dwarf_info()
+        return [[(entry.state.address, entry.state.file, entry.state.line) for entry in
+                 dwarf.line_program_for_CU(cu).get_entries() if entry.state is not None] for cu in dwarf.iter_CUs()]
+
+def test_lines():
+    arch = archinfo.ArchAMD64()
+    units = [{
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: name,
+        enums.ENUM_DW_AT['DW_AT_stmt_list']: make_lines('/src/' + name, address),
+    } for name, address in (('a.c', 0x1000), ('b.c', 0x2000))]
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf(serialize(units, arch), arch, elf)
+
+        with open(elf, 'rb') as fp:
+            restructurer = ReStructurer(fp)
+            tables = [restructurer.unit_get_lines(cu) for cu in restructurer.dwarf.iter_CUs()]
+            for table, unit in zip(tables, units):
+                expected = unit[enums.ENUM_DW_AT['DW_AT_stmt_list']]
+                for rows in (table, pickle.loads(pickle.dumps(table))):
+                    assert [vars(state) for state in rows] == [vars(state) for state in expected]
+            # the header both units include resolves to one string
+            assert list(tables[0])[1].file is list(tables[1])[1].file
+
+        for pipeline in (None, 'process'):
+            ReStructurer.rewrite_dwarf(elf, elf2, pipeline=pipeline)
+            assert read_lines(elf2) == read_lines(elf)
+
+        # cached units are keyed by the encoded programs
+        path = tempfile.mkdtemp()
+        try:
+            cache = UnitCache(path)
+            for _ in range(2):
+                ReStructurer.rewrite_dwarf(elf, elf2, cache=cache)
+                assert read_lines(elf2) == read_lines(elf)
+            assert (cache.hits, cache.misses) == (2, 2)
+        finally:
+            shutil.rmtree(path)
+
+def test_expr_refs():
+    arch = archinfo.ArchAMD64()
+    char_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'char',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 1,
+        enums.ENUM_DW_AT['DW_AT_encoding']: constants.DW_ATE_signed_char,
+    }
+    int_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'int',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+        enums.ENUM_DW_AT['DW_AT_encoding']: constants.DW_ATE_signed,
+    }
+    x = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'x',
+        enums.ENUM_DW_AT['DW_AT_type']: int_type,
+        enums.ENUM_DW_AT['DW_AT_location']: [
+            DWARFExprOp(0xf4, 'DW_OP_GNU_const_type', [int_type, [1, 0, 0, 0]], 0),
+            DWARFExprOp(0x9f, 'DW_OP_stack_value', [], 0),
+        ],
+    }
+    # p refers to x before it is restructured
+    p = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'p',
+        enums.ENUM_DW_AT['DW_AT_location']: [
+            LocationEntry(0x1000, 0x1010, [DWARFExprOp(0xf2, 'DW_OP_GNU_implicit_pointer', [x, 0], 0)]),
+        ],
+    }
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'a.c',
+        enums.ENUM_DW_AT['DW_AT_language']: constants.DW_LANG_C,
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+        'children': [
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'a_func',
+                enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+                enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+                'children': [p, x],
+            },
+            # not carried over, so int moves
+            char_type,
+            int_type,
+        ],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf(serialize([unit], arch), arch, elf)
+
+        for kwargs in ({}, {'merge_types': True}, {'decode_expressions': True}):
+            ReStructurer.rewrite_dwarf(elf, elf2, **kwargs)
+            with open(elf2, 'rb') as fp:
+                dwarf = ELFFile(fp).get_dwarf_info()
+                cu = next(dwarf.iter_CUs())
+                dies = {die.attributes['DW_AT_name'].value: die for die in cu.iter_DIEs()
+                        if 'DW_AT_name' in die.attributes}
+                assert b'char' not in dies
+                parser = DWARFExprParser(dwarf.structs)
+                const_type, _ = parser.parse_expr(dies[b'x'].attributes['DW_AT_location'].value)
+                assert cu.get_DIE_from_refaddr(cu.cu_offset + const_type.args[0]).offset == dies[b'int'].offset
+                location = dies[b'p'].attributes['DW_AT_location'].value
+                loclist = dwarf.location_lists().get_location_list_at_offset(location)
+                implicit_pointer, = parser.parse_expr(loclist[0].loc_expr)
+                assert implicit_pointer.args == [dies[b'x'].offset, 0]
+
+def test_unresolved_refs():
+    arch = archinfo.ArchAMD64()
+    # y belongs to an inlined subroutine, which is not restructured
+    y = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'y',
+        enums.ENUM_DW_AT['DW_AT_location']: [DWARFExprOp(0x50, 'DW_OP_reg0', [], 0)],
+    }
+    implicit_pointer = [DWARFExprOp(0xf2, 'DW_OP_GNU_implicit_pointer', [y, 0], 0)]
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'a.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+        'children': [{
+            'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'a_func',
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+            'children': [
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                    enums.ENUM_DW_AT['DW_AT_name']: 'p',
+                    enums.ENUM_DW_AT['DW_AT_location']: implicit_pointer,
+                },
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                    enums.ENUM_DW_AT['DW_AT_name']: 'q',
+                    enums.ENUM_DW_AT['DW_AT_location']: [
+                        LocationEntry(0x1000, 0x1010, implicit_pointer),
+                        LocationEntry(0x1010, 0x1020, [DWARFExprOp(0x50, 'DW_OP_reg0', [], 0)]),
+                    ],
+                },
+                {
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_inlined_subroutine'],
+                    'children': [y],
+                },
+            ],
+        }],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf(serialize([unit], arch), arch, elf)
+
+        ReStructurer.rewrite_dwarf(elf, elf2)
+        with open(elf2, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            dies = {die.attributes['DW_AT_name'].value: die for die in next(dwarf.iter_CUs()).iter_DIEs()
+                    if 'DW_AT_name' in die.attributes}
+            assert b'y' not in dies
+            assert 'DW_AT_location' not in dies[b'p'].attributes
+            loclist = dwarf.location_lists().get_location_list_at_offset(dies[b'q'].attributes['DW_AT_location'].value)
+            assert [(entry.begin_offset, entry.end_offset) for entry in loclist] == [(0x10, 0x20)]
+
+def test_expr_calls():
+    arch = archinfo.ArchAMD64()
+    proc = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_dwarf_procedure'],
+        enums.ENUM_DW_AT['DW_AT_location']: [DWARFExprOp(0x9c, 'DW_OP_call_frame_cfa', [], 0)],
+    }
+    def unit(name, low_pc, children):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low_pc),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+            'children': children,
+        }
+    def function(name, low_pc, location):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low_pc),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+            'children': [{
+                'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                enums.ENUM_DW_AT['DW_AT_name']: name + '_var',
+                enums.ENUM_DW_AT['DW_AT_location']: location,
+            }],
+        }
+    f = function('f', 0x1000, [DWARFExprOp(0x9a, 'DW_OP_call_ref', [proc], 0)])
+    f[enums.ENUM_DW_AT['DW_AT_frame_base']] = [DWARFExprOp(0x99, 'DW_OP_call4', [proc], 0)]
+    # 0xb is the first unit's top DIE
+    g = function('g', 0x2000, [DWARFExprOp(0xf2, 'DW_OP_GNU_implicit_pointer', [0xb, 0], 0)])
+    units = [unit('a.c', 0x1000, [proc, f]), unit('b.c', 0x2000, [g])]
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        elf2 = os.path.join(tmp, 'debug2.elf')
+        dump_elf(serialize(units, arch), arch, elf)
+
+        ReStructurer.rewrite_dwarf(elf, elf2)
+        with open(elf2, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            parser = DWARFExprParser(dwarf.structs)
+            cu_a, cu_b = dwarf.iter_CUs()
+            dies = {die.attributes['DW_AT_name'].value: die for die in cu_a.iter_DIEs()
+                    if 'DW_AT_name' in die.attributes}
+            procs = [die for die in cu_a.iter_DIEs() if die.tag == 'DW_TAG_dwarf_procedure']
+            assert len(procs) == 1
+            assert parser.parse_expr(procs[0].attributes['DW_AT_location'].value)[0].op_name == 'DW_OP_call_frame_cfa'
+            for die, attr in ((dies[b'f'], 'DW_AT_frame_base'), (dies[b'f_var'], 'DW_AT_location')):
+                call, = parser.parse_expr(die.attributes[attr].value)
+                assert call.op_name == 'DW_OP_call4'
+                assert cu_a.cu_offset + call.args[0] == procs[0].offset
+            g_var, = [die for die in cu_b.iter_DIEs() if die.tag == 'DW_TAG_variable']
+            assert 'DW_AT_location' not in g_var.attributes
+
+
+if __name__ == '__main__':
+    test_incremental()
+    test_streaming()
+    test_stale_sections()
+    test_pipeline()
+    test_select()
+    test_lines()
+    test_expr_refs()
+    test_unresolved_refs()
+    test_expr_calls()
@@ -1,8 +1,16 @@
+import os
+import struct
+import tempfile
+
 import archinfo
 from elftools.dwarf import enums, constants
+from elftools.dwarf.dwarf_expr import DWARFExprOp, DWARFExprParser
+from elftools.dwarf.ranges import RangeEntry, BaseAddressEntry
+from elftools.elf.elffile import ELFFile
 
 from dwarfwrite.elf import dump_elf
-from dwarfwrite.serial import Address, serialize
+from dwarfwrite.serial import Address, LocationEntry, RawExpr, serialize
+from dwarfwrite.stats import SerializerStats
 
 def test_basic():
     arch = archinfo.ArchX86()
@@ -24,7 +32,9 @@ def test_basic():
     }
 
     result = serialize([unit], arch)
-    dump_elf(result, arch, '/tmp/debug.elf')
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(result, arch, elf)
 
 def test_children():
     arch = archinfo.ArchX86()
@@ -64,8 +74,424 @@ def test_children():
   'tag': 17}]
 
     result = serialize(units, arch)
-    dump_elf(result, arch, '/tmp/debug.elf')
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(result, arch, elf)
+
+def test_split():
+    arch = archinfo.ArchAMD64()
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_comp_dir']: '/tmp',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x20,
+        'children': [
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'main',
+                enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1010),
+                enums.ENUM_DW_AT['DW_AT_high_pc']: 0x10,
+            },
+        ],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dwo = os.path.join(tmp, 'debug.dwo')
+        result = serialize([unit], arch, dwo_name=dwo)
+        assert '.debug_info.dwo' in result and '.debug_addr' in result
+        assert b'main' not in result['.debug_str'] and b'main' in result['.debug_str.dwo']
+        dump_elf(result, arch, elf, dwo_file=dwo)
+
+        with open(elf, 'rb') as fp:
+            skeleton = next(ELFFile(fp).get_dwarf_info().iter_CUs()).get_top_DIE()
+            assert skeleton.attributes['DW_AT_GNU_dwo_name'].value == dwo.encode()
+            assert skeleton.attributes['DW_AT_low_pc'].value == 0x1000
+            dwo_id = skeleton.attributes['DW_AT_GNU_dwo_id'].value
+        with open(dwo, 'rb') as fp:
+            info = ELFFile(fp).get_section_by_name('.debug_info.dwo').data()
+            assert dwo_id.to_bytes(8, 'little') in info
+
+def test_aranges():
+    arch = archinfo.ArchAMD64()
+    def unit(name, *funcs):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            'children': [{
+                'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low),
+                enums.ENUM_DW_AT['DW_AT_high_pc']: high - low,
+            } for low, high in funcs],
+        }
+
+    result = serialize([unit('a.c', (0x1000, 0x1010), (0x1010, 0x1020)), unit('b.c', (0x2000, 0x2100))], arch)
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(result, arch, elf)
+        with open(elf, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            aranges = dwarf.get_aranges()
+            offsets = [cu.cu_offset for cu in dwarf.iter_CUs()]
+            # the two adjacent functions of a.c are coalesced into one tuple
+            assert len(aranges.entries) == 2
+            assert aranges.cu_offset_at_addr(0x1018) == offsets[0]
+            assert aranges.cu_offset_at_addr(0x2080) == offsets[1]
+
+def test_name_index():
+    arch = archinfo.ArchAMD64()
+    int_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'int',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+    }
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        'children': [
+            int_type,
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'main',
+                enums.ENUM_DW_AT['DW_AT_type']: int_type,
+                enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+                enums.ENUM_DW_AT['DW_AT_high_pc']: 0x10,
+            },
+        ],
+    }
+
+    result = serialize([unit], arch, debug_names=True, gdb_index=True)
+    names = result['.debug_names']
+    version, _, cu_count, _, _, bucket_count, name_count = struct.unpack_from('<HHIIIII', names, 4)
+    assert (version, cu_count, name_count) == (5, 1, 2)
+
+    index = result['.gdb_index']
+    version, cu_list, _, address_area, symbol_table, _ = struct.unpack_from('<6I', index)
+    assert version == 8
+    assert struct.unpack_from('<QQ', index, cu_list) == (0, len(result['.debug_info']))
+    assert struct.unpack_from('<QQI', index, address_area) == (0x1000, 0x1010, 0)
+
+def test_raw_expr():
+    arch = archinfo.ArchAMD64()
+    # DW_OP_implicit_value 4 bytes, copied through as read from the input
+    expr = RawExpr(bytes([0x9e, 0x04, 0x01, 0x00, 0x00, 0x00]))
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0),
+        'children': [
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'x',
+                enums.ENUM_DW_AT['DW_AT_location']: expr,
+            },
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'y',
+                enums.ENUM_DW_AT['DW_AT_location']: [LocationEntry(0x10, 0x20, expr)],
+            },
+        ],
+    }
+
+    result = serialize([unit], arch)
+    assert bytes([len(expr)]) + expr in result['.debug_info']
+    assert struct.pack('<H', len(expr)) + expr in result['.debug_loc']
+
+def test_expr_refs():
+    arch = archinfo.ArchAMD64()
+    int_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'int',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+        enums.ENUM_DW_AT['DW_AT_encoding']: constants.DW_ATE_signed,
+    }
+    x = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'x',
+        enums.ENUM_DW_AT['DW_AT_location']: [
+            DWARFExprOp(0xf4, 'DW_OP_GNU_const_type', [int_type, [1, 0, 0, 0]], 0),
+            DWARFExprOp(0x9f, 'DW_OP_stack_value', [], 0),
+        ],
+    }
+    p = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'p',
+        enums.ENUM_DW_AT['DW_AT_location']: [
+            LocationEntry(0x10, 0x20, [DWARFExprOp(0xf2, 'DW_OP_GNU_implicit_pointer', [x, 4], 0)]),
+            LocationEntry(0x20, 0x30, [DWARFExprOp(0x50, 'DW_OP_reg0', [], 0),
+                                       DWARFExprOp(0xf7, 'DW_OP_GNU_convert', [int_type], 0),
+                                       DWARFExprOp(0x9f, 'DW_OP_stack_value', [], 0)]),
+        ],
+    }
+    # referred to before and after the DIEs are written, and from a second unit so that section offsets differ
+    other = {'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'], enums.ENUM_DW_AT['DW_AT_name']: 'other.c'}
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0),
+        'children': [p, int_type, x],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(serialize([other, unit], arch), arch, elf)
+
+        with open(elf, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            cu = list(dwarf.iter_CUs())[1]
+            dies = {die.attributes['DW_AT_name'].value: die for die in cu.get_top_DIE().iter_children()}
+            parser = DWARFExprParser(dwarf.structs)
+            const_type, _ = parser.parse_expr(dies[b'x'].attributes['DW_AT_location'].value)
+            assert const_type.args == [dies[b'int'].offset - cu.cu_offset, [1, 0, 0, 0]]
+            loclist = dwarf.location_lists().get_location_list_at_offset(dies[b'p'].attributes['DW_AT_location'].value)
+            implicit_pointer, = parser.parse_expr(loclist[0].loc_expr)
+            assert implicit_pointer.args == [dies[b'x'].offset, 4]
+            convert = parser.parse_expr(loclist[1].loc_expr)[1]
+            assert convert.args == [dies[b'int'].offset - cu.cu_offset]
+
+def test_stats():
+    arch = archinfo.ArchAMD64()
+    int_type = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'int',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 4,
+    }
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        'children': [
+            {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                enums.ENUM_DW_AT['DW_AT_name']: 'int',
+                enums.ENUM_DW_AT['DW_AT_type']: int_type,
+            },
+            int_type,
+        ],
+    }
+
+    stats = SerializerStats()
+    result = serialize([unit], arch, stats=stats)
+    info = stats.as_dict()
+    assert info['section_sizes'] == {name: len(data) for name, data in result.items()}
+    assert info['dies'] == 3
+    assert info['dies_by_tag']['DW_TAG_variable'] == 1
+    assert info['attributes_by_form']['DW_FORM_strp'] == 3
+    assert info['string_hit_rate'] == 1 / 3
+    assert (info['references'], info['forward_references']) == (1, 1)
+    assert info['abbrev_bytes'] == len(result['.debug_abbrev'])
+    assert 'serialize' in info['phases']
+    stats.to_json()
+
+def test_sibling():
+    arch = archinfo.ArchAMD64()
+    def block(depth):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_lexical_block'],
+            'children': [block(depth - 1)] if depth else [],
+        }
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        'children': [block(1), block(3), block(0)],
+    }
+
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        for sibling, expected in (('always', 2), ('never', 0), (2, 1)):
+            result = serialize([unit], arch, sibling=sibling)
+            sizes[sibling] = len(result['.debug_info'])
+            dump_elf(result, arch, elf)
+            with open(elf, 'rb') as fp:
+                top = next(ELFFile(fp).get_dwarf_info().iter_CUs()).get_top_DIE()
+                assert len(list(top.iter_children())) == 3
+                assert sum('DW_AT_sibling' in die.attributes for die in top.iter_children()) == expected
+        assert sizes['never'] < sizes[2] < sizes['always']
+
+def test_loclist_compaction():
+    arch = archinfo.ArchAMD64()
+    reg0 = [DWARFExprOp(0x50, 'DW_OP_reg0', [], 0)]
+    reg1 = [DWARFExprOp(0x51, 'DW_OP_reg1', [], 0)]
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1008),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+        'children': [{
+            'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'x',
+            enums.ENUM_DW_AT['DW_AT_location']: [
+                LocationEntry(0x1010, 0x1020, reg0),
+                LocationEntry(0x1030, 0x1030, reg1),
+                LocationEntry(0x1020, 0x1030, reg0),
+                LocationEntry(0x1040, 0x1050, reg1),
+                LocationEntry(0x1038, 0x1048, reg1),
+                # below the unit's low_pc
+                LocationEntry(0x1004, 0x1010, reg1),
+            ],
+        }],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(serialize([unit], arch), arch, elf)
+        with open(elf, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            var = next(next(dwarf.iter_CUs()).get_top_DIE().iter_children())
+            loclist = dwarf.location_lists().get_location_list_at_offset(var.attributes['DW_AT_location'].value)
+            assert loclist[0].base_address == 0x1004
+            assert [(entry.begin_offset, entry.end_offset, entry.loc_expr) for entry in loclist[1:]] == [
+                (0, 0xc, [0x51]),
+                (0xc, 0x2c, [0x50]),
+                (0x34, 0x4c, [0x51]),
+            ]
+
+def test_ranges():
+    arch = archinfo.ArchAMD64()
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x1000,
+        'children': [{
+            'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'f',
+            enums.ENUM_DW_AT['DW_AT_ranges']: [
+                RangeEntry(None, None, 0x1800, 0x1900, True),
+                RangeEntry(None, None, 0x1100, 0x1200, True),
+                RangeEntry(None, None, 0x1180, 0x1280, True),
+            ],
+        }, {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+            enums.ENUM_DW_AT['DW_AT_name']: 'g',
+            enums.ENUM_DW_AT['DW_AT_ranges']: [
+                BaseAddressEntry(None, 0xf00),
+                RangeEntry(None, None, 0, 0x10, False),
+                RangeEntry(None, None, 0x200, 0x210, False),
+            ],
+        }],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        dump_elf(serialize([unit], arch), arch, elf)
+        with open(elf, 'rb') as fp:
+            dwarf = ELFFile(fp).get_dwarf_info()
+            f, g = next(dwarf.iter_CUs()).get_top_DIE().iter_children()
+            # merged and relative to the unit's low_pc
+            assert [(entry.begin_offset, entry.end_offset) for entry in
+                    dwarf.range_lists().get_range_list_at_offset(f.attributes['DW_AT_ranges'].value)] == \
+                [(0x100, 0x280), (0x800, 0x900)]
+            # partly below the unit's low_pc, needing a base address entry
+            base, first, second = dwarf.range_lists().get_range_list_at_offset(g.attributes['DW_AT_ranges'].value)
+            assert base.base_address == 0xf00
+            assert [(first.begin_offset, first.end_offset), (second.begin_offset, second.end_offset)] == \
+                [(0, 0x10), (0x200, 0x210)]
+
+def test_encoder_output():
+    # references in both directions, siblings over nested children, and an exprloc referring to a type
+    def base_type(name, size):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_base_type'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            enums.ENUM_DW_AT['DW_AT_byte_size']: size,
+            enums.ENUM_DW_AT['DW_AT_encoding']: constants.DW_ATE_signed,
+        }
+    int_type = base_type('int', 4)
+    long_type = base_type('long', 8)
+    node = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_structure_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'node',
+        enums.ENUM_DW_AT['DW_AT_byte_size']: 16,
+        'children': [],
+    }
+    node_ptr = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_pointer_type'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'node_ptr',
+        enums.ENUM_DW_AT['DW_AT_type']: node,
+    }
+    node['children'] = [{
+        'tag': enums.ENUM_DW_TAG['DW_TAG_member'],
+        enums.ENUM_DW_AT['DW_AT_name']: name,
+        enums.ENUM_DW_AT['DW_AT_type']: ty,
+        enums.ENUM_DW_AT['DW_AT_data_member_location']: offset,
+    } for name, ty, offset in (('value', int_type, 0), ('next', node_ptr, 8))]
+    def function(name, low_pc):
+        return {
+            'tag': enums.ENUM_DW_TAG['DW_TAG_subprogram'],
+            enums.ENUM_DW_AT['DW_AT_name']: name,
+            enums.ENUM_DW_AT['DW_AT_low_pc']: Address(low_pc),
+            enums.ENUM_DW_AT['DW_AT_high_pc']: 0x10,
+            enums.ENUM_DW_AT['DW_AT_type']: long_type,
+            'children': [{
+                'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                enums.ENUM_DW_AT['DW_AT_name']: name + '_var',
+                enums.ENUM_DW_AT['DW_AT_type']: node_ptr,
+                enums.ENUM_DW_AT['DW_AT_location']: [
+                    DWARFExprOp(0x50, 'DW_OP_reg0', [], 0),
+                    DWARFExprOp(0xf7, 'DW_OP_GNU_convert', [long_type], 0),
+                    DWARFExprOp(0x9f, 'DW_OP_stack_value', [], 0),
+                ],
+            }, {
+                'tag': enums.ENUM_DW_TAG['DW_TAG_lexical_block'],
+                'children': [{
+                    'tag': enums.ENUM_DW_TAG['DW_TAG_variable'],
+                    enums.ENUM_DW_AT['DW_AT_name']: name + '_inner',
+                    enums.ENUM_DW_AT['DW_AT_type']: int_type,
+                }],
+            }],
+        }
+    expected_types = {b'f': b'long', b'g': b'long', b'f_var': b'node_ptr', b'g_var': b'node_ptr', b'f_inner': b'int',
+                      b'g_inner': b'int', b'value': b'int', b'next': b'node_ptr', b'node_ptr': b'node'}
+    unit = {
+        'tag': enums.ENUM_DW_TAG['DW_TAG_compile_unit'],
+        enums.ENUM_DW_AT['DW_AT_name']: 'test.c',
+        enums.ENUM_DW_AT['DW_AT_low_pc']: Address(0x1000),
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x100,
+        # node_ptr refers to node ahead of it, and the functions to types behind them or, long, ahead
+        'children': [int_type, node_ptr, node, function('f', 0x1000), function('g', 0x1010), long_type],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        elf = os.path.join(tmp, 'debug.elf')
+        for arch in (archinfo.ArchAMD64(), archinfo.ArchX86()):
+            dump_elf(serialize([unit], arch), arch, elf)
+            with open(elf, 'rb') as fp:
+                dwarf = ELFFile(fp).get_dwarf_info()
+                cu = next(dwarf.iter_CUs())
+                abbrevs = cu.get_abbrev_table()
+                dies = list(cu.iter_DIEs())
+                by_name = {die.attributes['DW_AT_name'].value: die for die in dies if 'DW_AT_name' in die.attributes}
+                for die in dies:
+                    if die.is_null():
+                        continue
+                    abbrev = abbrevs.get_abbrev(die.abbrev_code)
+                    assert abbrev['tag'] == die.tag
+                    assert abbrev.has_children() == die.has_children
+                    assert [spec.name for spec in abbrev['attr_spec']] == list(die.attributes)
+                    if 'DW_AT_type' in die.attributes:
+                        target = cu.get_DIE_from_refaddr(cu.cu_offset + die.attributes['DW_AT_type'].value)
+                        name = die.attributes['DW_AT_name'].value
+                        assert target.attributes['DW_AT_name'].value == expected_types[name]
+                    children = list(die.iter_children())
+                    for child, next_child in zip(children, children[1:]):
+                        if 'DW_AT_sibling' in child.attributes:
+                            assert cu.cu_offset + child.attributes['DW_AT_sibling'].value == next_child.offset
+                # every DIE with children and a sibling after it has DW_AT_sibling
+                assert sum('DW_AT_sibling' in die.attributes for die in dies) == 3
+                # DIEs of the same shape share an abbreviation
+                assert by_name[b'f'].abbrev_code == by_name[b'g'].abbrev_code
+                assert by_name[b'int'].abbrev_code == by_name[b'long'].abbrev_code
+                assert len({die.abbrev_code for die in dies if not die.is_null()}) == 9
+                location = by_name[b'f_var'].attributes['DW_AT_location'].value
+                convert = DWARFExprParser(dwarf.structs).parse_expr(location)[1]
+                assert cu.cu_offset + convert.args[0] == by_name[b'long'].offset
 
 
 if __name__ == '__main__':
     test_children()
+    test_stats()
+    test_sibling()
+    test_loclist_compaction()
+    test_ranges()
+    test_encoder_output()
@@ -1,3 +1,6 @@
+from elftools.dwarf import enums
+from elftools.dwarf.ranges import RangeEntry
+
 from dwarfwrite.structure import DWARFStructurer
 
 class TestStructurer(DWARFStructurer):
@@ -23,5 +26,17 @@ def test_structurer():
     result = TestStructurer().run()
     import pprint; pprint.pprint(result)
 
+def test_ranges():
+    structurer = DWARFStructurer()
+    adjacent = [RangeEntry(None, None, 0x20, 0x30, False), RangeEntry(None, None, 0x10, 0x20, False)]
+    assert structurer.process_ranges(adjacent) == {
+        enums.ENUM_DW_AT['DW_AT_low_pc']: 0x10,
+        enums.ENUM_DW_AT['DW_AT_high_pc']: 0x20,
+    }
+    split = adjacent + [RangeEntry(None, None, 0x40, 0x50, False)]
+    assert [(entry.begin_offset, entry.end_offset) for entry in
+            structurer.process_ranges(split)[enums.ENUM_DW_AT['DW_AT_ranges']]] == [(0x10, 0x30), (0x40, 0x50)]
+
 if __name__ == '__main__':
-    test_structurer()
\ No newline at end of file
+    test_structurer()
+    test_ranges()
\ No newline at end of file